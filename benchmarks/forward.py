@@ -0,0 +1,122 @@
+"""Measures the throughput of :class:`remand.net.forward.Forwarder`.
+
+Unlike the plan benchmarks, this is a standalone script::
+
+    python benchmarks/forward.py [MIB]
+
+A local server either swallows or produces ``MIB`` megabytes (default: 256)
+per connection. Connections are forwarded to it through a forwarder using
+plain TCP connections instead of a remote, measuring the overhead of the
+event loop itself. Every direction is run with a single connection and with
+several concurrent ones.
+"""
+
+import socket
+import sys
+import threading
+import time
+
+import logbook
+
+from remand import _context, keep_context
+from remand.net.forward import Forwarder
+
+CHUNK_SIZE = 65536
+CONCURRENCY = (1, 8, 32)
+
+
+def _sink(conn, total):
+    while conn.recv(CHUNK_SIZE):
+        pass
+    conn.close()
+
+
+def _source(conn, total):
+    chunk = b'\0' * CHUNK_SIZE
+    for _ in xrange(total // CHUNK_SIZE):
+        conn.sendall(chunk)
+    conn.close()
+
+
+def _server(handler, total):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+
+    def serve():
+        while True:
+            conn, _ = sock.accept()
+            t = threading.Thread(target=handler, args=(conn, total))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=serve)
+    t.daemon = True
+    t.start()
+    return sock.getsockname()
+
+
+def _upload(addr, total):
+    conn = socket.create_connection(addr)
+    chunk = b'\0' * CHUNK_SIZE
+    for _ in xrange(total // CHUNK_SIZE):
+        conn.sendall(chunk)
+    conn.shutdown(socket.SHUT_WR)
+    conn.recv(1)
+    conn.close()
+
+
+def _download(addr, total):
+    conn = socket.create_connection(addr)
+    while conn.recv(CHUNK_SIZE):
+        pass
+    conn.close()
+
+
+def measure(handler, client, total, n):
+    server_addr = _server(handler, total)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    forwarder = Forwarder(
+        listener, lambda: socket.create_connection(server_addr), CHUNK_SIZE)
+
+    loop = threading.Thread(target=keep_context(forwarder.serve))
+    loop.start()
+
+    clients = [
+        threading.Thread(target=client, args=(listener.getsockname(), total))
+        for _ in xrange(n)
+    ]
+
+    start = time.time()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.time() - start
+
+    forwarder.stop()
+    loop.join()
+    listener.close()
+
+    return n * total / elapsed / (1024 * 1024)
+
+
+def main():
+    total = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 256 << 20
+
+    _context.push({'log': logbook.Logger('forward')})
+
+    print('{:<10} {:>11} {:>10}'.format('direction', 'connections',
+                                        'MiB/s'))
+    for name, handler, client in (('upload', _sink, _upload),
+                                  ('download', _source, _download)):
+        for n in CONCURRENCY:
+            rate = measure(handler, client, total, n)
+            print('{:<10} {:>11} {:>10.1f}'.format(name, n, rate))
+
+
+if __name__ == '__main__':
+    main()
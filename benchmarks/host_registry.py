@@ -0,0 +1,102 @@
+"""Measures host configuration lookups on a large generated inventory.
+
+Unlike the plan benchmarks, this is a standalone script::
+
+    python benchmarks/host_registry.py [HOSTS [SECTIONS]]
+
+Generates ``SECTIONS`` (default: 2000) ``Host:`` and ``Match:`` sections on
+top of ``defaults.cfg`` and resolves the configuration of ``HOSTS`` (default:
+10000) host names, then reads a few values for each of them. The same is done
+by trying every section's expression in turn, as remand did before sections
+were indexed.
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+from remand.configfiles import HostRegistry
+from remand.util import ConfigParser, TypeConversionChainMap
+
+#: values read from each host's configuration
+KEYS = ('buffer_size', 'sftp_command', 'ssh_connect_timeout', 'user')
+
+#: number of times each value is read
+READS = 10
+
+
+def generate(num_hosts, num_sections):
+    cfg = ConfigParser(allow_no_value=True)
+    cfg.read(os.path.join(os.path.dirname(__file__), '..', 'remand',
+                          'defaults.cfg'))
+
+    rnd = random.Random(0)
+    for i in xrange(num_sections):
+        if rnd.random() < 0.8:
+            name = 'Host:host{}.example.com'.format(
+                rnd.randrange(num_hosts))
+        else:
+            name = r'Match:host{}\d*\.example\.com'.format(i)
+        if not cfg.has_section(name):
+            cfg.add_section(name)
+        cfg.set(name, 'user', 'user{}'.format(i))
+
+    hosts = ['host{}.example.com'.format(i) for i in xrange(num_hosts)]
+    return cfg, hosts
+
+
+class LinearRegistry(object):
+    # tries every section, as HostRegistry did before
+
+    def __init__(self, cfg):
+        self.host_res = []
+        for name, sect in cfg.items():
+            if name.startswith(HostRegistry.HOST_PREFIX):
+                pattern = re.escape(name[len(HostRegistry.HOST_PREFIX):])
+            elif name.startswith(HostRegistry.MATCH_PREFIX):
+                pattern = name[len(HostRegistry.MATCH_PREFIX):]
+            else:
+                continue
+            self.host_res.append((re.compile(pattern + '$'), sect))
+
+    def get_config_for_host(self, hostname):
+        return TypeConversionChainMap(*reversed(
+            [sect for exp, sect in self.host_res if exp.match(hostname)]))
+
+
+def measure(registry_cls, cfg, hosts):
+    start = time.time()
+    registry = registry_cls(cfg)
+    setup = time.time() - start
+
+    start = time.time()
+    configs = [registry.get_config_for_host(host) for host in hosts]
+    resolve = time.time() - start
+
+    start = time.time()
+    for c in configs:
+        for _ in xrange(READS):
+            for key in KEYS:
+                c[key]
+    lookup = time.time() - start
+
+    return setup, resolve, lookup
+
+
+def main():
+    num_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_sections = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    cfg, hosts = generate(num_hosts, num_sections)
+
+    print('{:<10} {:>10} {:>10} {:>10}'.format('registry', 'setup',
+                                              'resolve', 'lookups'))
+    for name, registry_cls in (('linear', LinearRegistry),
+                               ('indexed', HostRegistry)):
+        print('{:<10} {:>9.3f}s {:>9.3f}s {:>9.3f}s'.format(
+            name, *measure(registry_cls, cfg, hosts)))
+
+
+if __name__ == '__main__':
+    main()
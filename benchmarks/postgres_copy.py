@@ -0,0 +1,98 @@
+"""Compares loading and dumping table data with ``Manager.copy_in`` and
+``Manager.copy_out`` to uploading a file and running ``psql`` remotely.
+
+Requires a PostgreSQL server on the remote, reachable through the default
+socket by the ``postgres`` user::
+
+    remand run benchmarks/postgres_copy.py ssh://root@host
+
+Results are logged at notice level. A table named ``remand_benchmark`` is
+created in the ``postgres`` database and dropped afterwards.
+"""
+
+from shutil import copyfileobj
+import os
+import tempfile
+import time
+
+from remand import Plan, remote, config, log
+from remand.lib import fs, proc
+from remand.lib.postgres import PostgreSQL
+
+plan = Plan(__name__)
+
+#: approximate size of the generated CSV data
+DATA_SIZE = 256 * 1024 * 1024
+
+TABLE = 'remand_benchmark'
+
+PSQL = 'psql'
+
+
+def _report(name, seconds, nbytes):
+    log.notice('{}: {:.2f} s ({:.1f} MiB/s)'.format(
+        name, seconds, nbytes / seconds / (1024 * 1024)))
+
+
+def _write_csv(f):
+    row_data = os.urandom(48).encode('hex')
+    i = 0
+    while f.tell() < DATA_SIZE:
+        f.write('{},{}\n'.format(i, row_data))
+        i += 1
+    f.flush()
+    return f.tell()
+
+
+def _psql(*commands):
+    args = [PSQL]
+    for cmd in commands:
+        args.extend(['-c', cmd])
+    proc.run(args)
+
+
+@plan.objective()
+def benchmark():
+    remote_path = remote.path.join(config['fs_fallback_tmpdir'],
+                                   'remand-benchmark-{}.csv'.format(
+                                       os.getpid()))
+
+    with tempfile.NamedTemporaryFile() as src,\
+            PostgreSQL().manager() as m:
+        size = _write_csv(src)
+        m.engine.execute('CREATE TABLE {} (id bigint, data text)'.format(
+            TABLE))
+
+        try:
+            # streamed through the forward
+            src.seek(0)
+            start = time.time()
+            m.copy_in(TABLE, src)
+            _report('copy_in', time.time() - start, size)
+
+            with tempfile.TemporaryFile() as dst:
+                start = time.time()
+                m.copy_out(TABLE, dst)
+                _report('copy_out', time.time() - start, size)
+
+            m.engine.execute('DELETE FROM {}'.format(TABLE))
+
+            # the manager runs everything as the postgres user, who owns the
+            # uploaded file and can hand it to psql
+            start = time.time()
+            fs.upload_file(src.name, remote_path)
+            _psql("\\copy {} FROM '{}' CSV".format(TABLE, remote_path))
+            _report('upload + psql', time.time() - start, size)
+
+            remote.unlink(remote_path)
+
+            with tempfile.TemporaryFile() as dst:
+                start = time.time()
+                _psql("\\copy {} TO '{}' CSV".format(TABLE, remote_path))
+                with remote.file(remote_path, 'rb') as rf:
+                    copyfileobj(rf, dst, remote.buffer_size())
+                _report('psql + download', time.time() - start, size)
+        finally:
+            if remote.lstat(remote_path):
+                remote.unlink(remote_path)
+            m.engine.execute('DROP TABLE {}'.format(TABLE))
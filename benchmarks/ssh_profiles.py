@@ -0,0 +1,108 @@
+"""Measures the throughput of each SSH profile against a local paramiko
+server.
+
+Unlike the other benchmarks, this is not a plan, but a standalone script::
+
+    python benchmarks/ssh_profiles.py [MIB]
+
+For every profile in ``remand.remotes.ssh.SSH_PROFILES``, ``MIB`` megabytes
+(default: 64) of random and of highly compressible data are sent from the
+server to the client over a single channel, similar to a download. Both ends
+run on this machine, so the results show the CPU cost of each profile. Run
+it on the device in question (e.g. a Raspberry Pi) to pick a profile for it.
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+import paramiko
+
+from remand.remotes.ssh import SSH_PROFILES, apply_ssh_profile
+
+CHUNK_SIZE = 32768
+
+
+class _Server(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'none'
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        return True
+
+
+def _serve(sock, host_key, chunk, count):
+    t = paramiko.Transport(sock)
+    t.add_server_key(host_key)
+    t.use_compression(True)
+    t.start_server(server=_Server())
+
+    chan = t.accept(30)
+    for _ in xrange(count):
+        chan.sendall(chunk)
+    chan.send_exit_status(0)
+    chan.close()
+
+
+def measure(profile, host_key, chunk, count):
+    server_sock, client_sock = socket.socketpair()
+    server = threading.Thread(
+        target=_serve, args=(server_sock, host_key, chunk, count))
+    server.daemon = True
+    server.start()
+
+    t = paramiko.Transport(client_sock)
+    apply_ssh_profile(t, profile)
+    t.use_compression(profile.get('compress', False))
+    t.start_client()
+    t.auth_none('benchmark')
+
+    chan = t.open_session()
+    chan.exec_command('send')
+
+    start = time.time()
+    received = 0
+    while True:
+        buf = chan.recv(CHUNK_SIZE)
+        if not buf:
+            break
+        received += len(buf)
+    elapsed = time.time() - start
+
+    chan.recv_exit_status()
+    t.close()
+    server.join()
+
+    return received / elapsed / (1024 * 1024), t.remote_cipher, t.remote_mac
+
+
+def main():
+    total = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 64 << 20
+    count = total // CHUNK_SIZE
+    host_key = paramiko.RSAKey.generate(2048)
+
+    samples = [
+        ('random', os.urandom(CHUNK_SIZE)),
+        ('text', (open(__file__).read() * CHUNK_SIZE)[:CHUNK_SIZE]),
+    ]
+
+    print('{:<16} {:<8} {:>10}  {}'.format('profile', 'data', 'MiB/s',
+                                          'cipher/mac'))
+    for name in sorted(SSH_PROFILES):
+        for data_name, chunk in samples:
+            rate, cipher, mac = measure(SSH_PROFILES[name], host_key, chunk,
+                                        count)
+            print('{:<16} {:<8} {:>10.1f}  {}/{}'.format(name, data_name, rate,
+                                                         cipher, mac))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Measures latency and throughput of a transport.
+
+Run against the same host once per transport to compare them, e.g.::
+
+    remand run benchmarks/transport.py ssh://root@host openssh://root@host
+
+Results are logged at notice level. The remote scratch file is placed in
+``fs_fallback_tmpdir`` and removed afterwards.
+"""
+
+from shutil import copyfileobj
+import os
+import tempfile
+import time
+
+from remand import Plan, remote, config, log
+from remand.lib import proc
+
+plan = Plan(__name__)
+
+#: number of round trips timed for each latency measurement
+ROUND_TRIPS = 50
+
+#: size of the file transferred in each direction
+TRANSFER_SIZE = 128 * 1024 * 1024
+
+
+def _timed(f, n=1):
+    start = time.time()
+    for _ in xrange(n):
+        f()
+    return (time.time() - start) / n
+
+
+def _report(name, seconds, nbytes=None):
+    msg = '{} [{}]: {:.2f} ms'.format(name, config['uri'].transport,
+                                      seconds * 1000)
+    if nbytes is not None:
+        msg += ' ({:.1f} MiB/s)'.format(nbytes / seconds / (1024 * 1024))
+    log.notice(msg)
+
+
+def _connect():
+    # a second connection, as later runs through the same transport would
+    # open it. multiplexing transports reuse their master here
+    transport = type(remote._get_current_object())()
+    transport.close()
+
+
+@plan.objective()
+def benchmark():
+    _report('connect', _timed(_connect, 5))
+    _report('command', _timed(lambda: proc.run(['true']), ROUND_TRIPS))
+    _report('stat', _timed(lambda: remote.stat('/'), ROUND_TRIPS))
+
+    bufsize = remote.buffer_size()
+    remote_path = remote.path.join(config['fs_fallback_tmpdir'],
+                                   'remand-benchmark-{}'.format(os.getpid()))
+
+    with tempfile.NamedTemporaryFile() as src:
+        chunk = os.urandom(1024 * 1024)
+        for _ in xrange(TRANSFER_SIZE // len(chunk)):
+            src.write(chunk)
+        src.flush()
+
+        def upload():
+            src.seek(0)
+            with remote.file(remote_path, 'wb') as dst:
+                copyfileobj(src, dst, bufsize)
+
+        def download():
+            with remote.file(remote_path, 'rb') as rf,\
+                    tempfile.TemporaryFile() as dst:
+                copyfileobj(rf, dst, bufsize)
+
+        try:
+            _report('upload', _timed(upload), TRANSFER_SIZE)
+            _report('download', _timed(download), TRANSFER_SIZE)
+        finally:
+            remote.unlink(remote_path)
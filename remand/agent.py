@@ -0,0 +1,291 @@
+"""Local agent keeping connections to remote hosts open between runs.
+
+The agent listens on a unix socket. Each connection carries a single
+invocation of the command line interface, which the agent executes in its
+own process, reusing transports left over from earlier invocations.
+
+The protocol consists of JSON objects, one per line. The client sends a
+request of the form ``{"argv": [...], "cwd": "...", "env": {...}}``. The agent
+answers with any number of ``{"stream": "stdout"|"stderr", "data": "..."}``
+messages, followed by ``{"exit": <status>}``.
+
+Invocations are executed one at a time, as they change process-wide state
+like the working directory and ``sys.stdout``.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import click
+import logbook
+
+from .configfiles import app_dirs
+from .exc import RemandError
+from .uri import Uri
+
+log = logbook.Logger('agent')
+
+#: environment variables passed on from the client to the agent
+FORWARDED_ENV = ('REMAND_PKG_PATH', 'REMAND_CONFIG')
+
+
+def default_socket_path():
+    if 'REMAND_AGENT_SOCKET' in os.environ:
+        return os.environ['REMAND_AGENT_SOCKET']
+    return os.path.join(app_dirs.user_cache_dir, 'agent.sock')
+
+
+class TransportPool(object):
+    """Holds idle transports for reuse.
+
+    Only transports whose class has the ``reusable`` attribute set are kept.
+
+    :param idle_timeout: Number of seconds after which an unused transport is
+                         closed.
+    """
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(uri):
+        return tuple(getattr(uri, attr) for attr in Uri.ATTRIBS)
+
+    def acquire(self, transport_cls, uri):
+        """Returns an idle transport for ``uri`` or creates a new one.
+
+        ``uri`` is the one given on the command line, before transports
+        rewrite the configured one when connecting."""
+        if getattr(transport_cls, 'reusable', False):
+            with self._lock:
+                entry = self._idle.pop(self._key(uri), None)
+
+            if entry is not None:
+                transport, _ = entry
+                if transport.is_active():
+                    log.debug('Reusing connection to {}'.format(uri))
+                    return transport
+
+                log.debug('Connection to {} went away'.format(uri))
+                transport.close()
+
+        return transport_cls()
+
+    def release(self, uri, transport, healthy=True):
+        """Returns ``transport`` to the pool.
+
+        :param healthy: If ``False``, the transport is closed instead.
+        """
+        if not getattr(transport, 'reusable', False):
+            return
+
+        if not healthy:
+            transport.close()
+            return
+
+        with self._lock:
+            prev = self._idle.pop(self._key(uri), None)
+            self._idle[self._key(uri)] = (transport, time.time())
+
+        if prev is not None and prev[0] is not transport:
+            prev[0].close()
+
+    def expire(self):
+        """Closes all transports idle for longer than ``idle_timeout``."""
+        now = time.time()
+        with self._lock:
+            expired = [
+                key for key, (_, last_used) in self._idle.items()
+                if now - last_used > self.idle_timeout
+            ]
+            transports = [self._idle.pop(key)[0] for key in expired]
+
+        for transport in transports:
+            log.debug('Closing idle connection {}'.format(transport))
+            transport.close()
+
+    def close_all(self):
+        with self._lock:
+            transports = [t for t, _ in self._idle.values()]
+            self._idle.clear()
+
+        for transport in transports:
+            transport.close()
+
+
+class _StreamWriter(object):
+    # file-like object sending everything written to it to the client
+
+    def __init__(self, conn, name, lock):
+        self.conn = conn
+        self.name = name
+        self.lock = lock
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf8', 'replace')
+
+        msg = json.dumps({'stream': self.name, 'data': data}) + '\n'
+        with self.lock:
+            self.conn.sendall(msg)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+@contextmanager
+def _redirected(conn, request):
+    lock = threading.Lock()
+    prev_streams = sys.stdout, sys.stderr
+    prev_cwd = os.getcwd()
+    prev_env = {k: os.environ.get(k) for k in FORWARDED_ENV}
+
+    sys.stdout = _StreamWriter(conn, 'stdout', lock)
+    sys.stderr = _StreamWriter(conn, 'stderr', lock)
+    for k in FORWARDED_ENV:
+        os.environ.pop(k, None)
+    os.environ.update(request.get('env', {}))
+    os.chdir(request['cwd'])
+
+    try:
+        yield
+    finally:
+        sys.stdout, sys.stderr = prev_streams
+        os.chdir(prev_cwd)
+        for k, v in prev_env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+def _execute(conn, pool):
+    from .cli import cli
+
+    request = json.loads(conn.makefile('rb').readline())
+    log.info('Running remand {}'.format(' '.join(request['argv'])))
+
+    status = 0
+    with _redirected(conn, request):
+        try:
+            cli.main(
+                args=request['argv'],
+                prog_name='remand',
+                standalone_mode=False,
+                obj={'transports': pool})
+        except click.ClickException as e:
+            e.show()
+            status = e.exit_code
+        except click.Abort:
+            status = 1
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            sys.stderr.write('Error in agent: {}\n'.format(e))
+            status = 1
+
+    conn.sendall(json.dumps({'exit': status}) + '\n')
+
+
+def serve(socket_path, idle_timeout):
+    """Runs the agent until interrupted."""
+    pool = TransportPool(idle_timeout)
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            log.debug('Removing stale socket {}'.format(socket_path))
+            os.unlink(socket_path)
+        else:
+            raise RemandError(
+                'Agent already running on {}'.format(socket_path))
+        finally:
+            probe.close()
+
+    sock_dir = os.path.dirname(socket_path)
+    if sock_dir and not os.path.exists(sock_dir):
+        os.makedirs(sock_dir, 0o700)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # only the current user may connect
+    prev_umask = os.umask(0o177)
+    try:
+        sock.bind(socket_path)
+    finally:
+        os.umask(prev_umask)
+    sock.listen(5)
+
+    def reap():
+        while True:
+            time.sleep(min(idle_timeout, 30))
+            pool.expire()
+
+    reaper = threading.Thread(target=reap)
+    reaper.daemon = True
+    reaper.start()
+
+    log.notice('Agent listening on {}'.format(socket_path))
+    try:
+        while True:
+            conn, _ = sock.accept()
+            try:
+                _execute(conn, pool)
+            except Exception as e:
+                log.error('Failed to handle request: {}'.format(e))
+            finally:
+                conn.close()
+    finally:
+        pool.close_all()
+        sock.close()
+        os.unlink(socket_path)
+
+
+def forward(socket_path, argv):
+    """Runs a command line invocation through the agent.
+
+    :return: The exit status of the invocation.
+    :raises socket.error: If the agent cannot be reached.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+
+    try:
+        f = sock.makefile('rwb')
+        f.write(
+            json.dumps({
+                'argv': argv,
+                'cwd': os.getcwd(),
+                'env': {k: os.environ[k]
+                        for k in FORWARDED_ENV if k in os.environ},
+            }) + '\n')
+        f.flush()
+
+        for line in f:
+            msg = json.loads(line)
+            if 'exit' in msg:
+                return msg['exit']
+
+            stream = sys.stdout if msg['stream'] == 'stdout' else sys.stderr
+            stream.write(msg['data'].encode('utf8'))
+            stream.flush()
+    finally:
+        sock.close()
+
+    raise RemandError('Agent closed the connection unexpectedly')
@@ -1,5 +1,6 @@
 import hashlib
 import os
+import socket
 import time
 import sys
 
@@ -9,20 +10,24 @@ from logbook.more import ColorizedStderrHandler
 import requests
 from six.moves.urllib.parse import urlparse
 
-from . import _context
+from . import _context, agent
 from .configfiles import HostRegistry, load_configuration
-from .exc import RemandError, TransportError, ReconnectNeeded
+from .exc import (RemandError, TransportError, ReconnectNeeded,
+                  RebootInProgress)
 from .plan import Plan
-from .lib import InfoManager, proc
+from .lib import InfoManager, proc, posix
 from .remotes.chroot import ChrootRemote
 from .remotes.ssh import SSHRemote
 from .remotes.local import LocalRemote
+from .remotes.openssh import OpenSSHRemote
+from .remotes.sftp import SFTPRemote
 from .remotes.vagrant import VagrantRemote
 from .uri import Uri
 
 # medium-term, this could become a plugin-based solution, if there's need
 all_transports = {
     'ssh': SSHRemote,
+    'openssh': OpenSSHRemote,
     'local': LocalRemote,
     'vagrant': VagrantRemote,
     'chroot': ChrootRemote,
@@ -63,8 +68,16 @@ APP_NAME = 'remand'
     multiple=True,
     type=click.Tuple((str, str)),
     help='Set configuration values directly')
+@click.option(
+    '--agent',
+    'use_agent',
+    is_flag=True,
+    default=False,
+    envvar='REMAND_AGENT',
+    help='Run plans through a running `remand agent`, reusing connections')
 @click.pass_context
-def cli(context, pkg_path, configfiles, debug, confvars, debug_ssh):
+def cli(context, pkg_path, configfiles, debug, confvars, debug_ssh,
+        use_agent):
     pkg_path = list(pkg_path)
     if 'REMAND_PKG_PATH' in os.environ:
         pkg_path.extend(os.environ['REMAND_PKG_PATH'].split(os.pathsep))
@@ -78,18 +91,32 @@ def cli(context, pkg_path, configfiles, debug, confvars, debug_ssh):
     import pluginbase
     plugin_base = pluginbase.PluginBase(package='remand.ext')
 
-    obj = context.obj = {}
+    # the agent passes in its transport pool
+    obj = context.ensure_object(dict)
     handler = ColorizedStderrHandler(level=logbook.DEBUG
                                      if debug else logbook.INFO)
 
     # setup logging
     logbook.compat.redirect_logging()
     handler.push_application()
+    context.call_on_close(handler.pop_application)
 
     if not debug_ssh:
-        logbook.NullHandler(
-            filter=lambda r, h: r.channel.startswith('paramiko')
-        ).push_application()
+        null_handler = logbook.NullHandler(
+            filter=lambda r, h: r.channel.startswith('paramiko'))
+        null_handler.push_application()
+        context.call_on_close(null_handler.pop_application)
+
+    if (use_agent and context.invoked_subcommand == 'run' and
+            'transports' not in obj):
+        socket_path = agent.default_socket_path()
+        try:
+            context.exit(
+                agent.forward(socket_path,
+                              [a for a in sys.argv[1:] if a != '--agent']))
+        except socket.error as e:
+            log.warning('Could not reach agent on {} ({}), running locally'
+                        .format(socket_path, e))
 
     # read configuration and host registry
     obj['config'] = load_configuration(APP_NAME, configfiles)
@@ -106,6 +133,74 @@ def cli(context, pkg_path, configfiles, debug, confvars, debug_ssh):
     obj['plugin_source'] = plugin_source
 
 
+def _port_open(addr, timeout):
+    try:
+        socket.create_connection(addr, timeout).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+def _wait_for_reboot(cfg, transport_cls, prev_boot_id):
+    # polls the host until it is back with a new boot id, returning a
+    # transport connected to it. the delay between attempts grows
+    # exponentially up to ``reboot_poll_max``. as long as the ssh port does
+    # not accept connections, no connection attempt is made
+    uri = cfg['uri']
+    delay = float(cfg['reboot_poll_min'])
+    max_delay = float(cfg['reboot_poll_max'])
+    timeout = float(cfg['reboot_timeout'])
+    probe_addr = None
+    if issubclass(transport_cls, SFTPRemote):
+        probe_addr = (uri.host, uri.port or 22)
+
+    # every poll makes a single attempt, retrying is done here
+    _context.top['config'] = cfg.new_child({'ssh_connect_retries': '1'})
+
+    start = time.time()
+    went_down = False
+    while time.time() - start < timeout:
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+        if probe_addr and not _port_open(probe_addr, max_delay):
+            went_down = True
+            continue
+
+        # a host going down may drop the connection at any point, every
+        # failure to connect or read the boot id means it is not ready yet
+        transport = None
+        try:
+            transport = transport_cls()
+            boot_id = posix.read_boot_id(transport)
+        except Exception as e:
+            log.debug('Host not ready yet: {}'.format(e))
+            went_down = True
+            if transport is not None:
+                try:
+                    transport.close()
+                except Exception:
+                    pass
+            continue
+
+        if boot_id != prev_boot_id or (boot_id is None and went_down):
+            elapsed = time.time() - start
+            log.notice('{} is back after {:.1f} seconds'.format(uri.host,
+                                                                 elapsed))
+            transport.timings.add('reboot', elapsed)
+            return transport
+
+        log.debug('{} has not rebooted yet'.format(uri.host))
+        transport.close()
+
+    if not went_down:
+        raise TransportError(
+            'Reboot of {} did not happen within {} seconds, the host is still '
+            'running with boot id {}'.format(uri.host, timeout, prev_boot_id))
+    raise TransportError('{} did not come back within {} seconds of '
+                         'rebooting'.format(uri.host, timeout))
+
+
 @cli.command(help='Runs a plan on a number of servers')
 @click.argument('plan', type=click.Path(exists=True))
 @click.argument('uris', default=None, nargs=-1, type=Uri.from_string)
@@ -113,6 +208,7 @@ def cli(context, pkg_path, configfiles, debug, confvars, debug_ssh):
 @click.pass_obj
 def run(obj, plan, uris, objective):
     failures = False
+    pool = obj.get('transports')
 
     with obj['plugin_source']:
         plan = Plan.load_from_file(plan)
@@ -121,8 +217,11 @@ def run(obj, plan, uris, objective):
     for uri in uris:
         retry = True
         config_overlay = {}
+        rebooted = None
         while retry:
             _context.push({})
+            transport = None
+            healthy = True
             try:
                 retry = False
                 # lookup host
@@ -147,6 +246,9 @@ def run(obj, plan, uris, objective):
                 _context.top['info'] = InfoManager()
                 _context.top['current_plan'] = plan
 
+                # typed settings are checked once, before connecting
+                cfg.snapshot()
+
                 transport_cls = all_transports.get(cfg['uri'].transport, None)
                 if not transport_cls:
                     raise TransportError(
@@ -154,8 +256,16 @@ def run(obj, plan, uris, objective):
 
                 log.notice('Executing {} on {}'.format(plan, cfg['uri']))
 
-                # instantiate remote
-                transport = transport_cls()
+                # instantiate remote, or reuse one kept by the agent or
+                # connected while waiting for a reboot
+                if rebooted is not None:
+                    transport, rebooted = rebooted, None
+                elif pool is not None:
+                    # pooled by the uri as given, transports such as vagrant
+                    # rewrite cfg['uri'] when connecting
+                    transport = pool.acquire(transport_cls, uri)
+                else:
+                    transport = transport_cls()
                 _context.top['remote'] = transport
 
                 use_sudo = False
@@ -171,7 +281,21 @@ def run(obj, plan, uris, objective):
                         plan.execute(objective)
                 else:
                     plan.execute(objective)
+            except RebootInProgress as e:
+                healthy = False
+
+                if cfg.get_bool('auto_reconnect'):
+                    try:
+                        rebooted = _wait_for_reboot(cfg, transport_cls,
+                                                    e.boot_id)
+                        retry = True
+                    except TransportError as e:
+                        log.error(str(e))
+                        failures = True
+                else:
+                    log.error('Automatic reconnects disabled, cannot continue')
             except ReconnectNeeded as e:
+                healthy = False
                 log.notice('A reconnect has been requested by {}'.format(e))
 
                 if cfg.get_bool('auto_reconnect'):
@@ -183,9 +307,19 @@ def run(obj, plan, uris, objective):
                 else:
                     log.error('Automatic reconnects disabled, cannot continue')
             except RemandError as e:
+                healthy = not isinstance(e, TransportError)
                 log.error(str(e))
                 failures = True
             finally:
+                if transport is not None and transport.timings:
+                    log.info('Timings for {}: {}'.format(
+                        cfg['uri'], transport.timings))
+                    transport.timings.clear()
+                if transport is not None and transport.link:
+                    log.info('Link to {}: {}'.format(cfg['uri'],
+                                                     transport.link))
+                if pool is not None and transport is not None:
+                    pool.release(uri, transport, healthy)
                 _context.pop()
 
     if not uris:
@@ -195,6 +329,26 @@ def run(obj, plan, uris, objective):
         sys.exit(1)
 
 
+@cli.command('agent', help='Keeps connections open for `remand --agent run`')
+@click.option(
+    '--socket',
+    'socket_path',
+    type=click.Path(),
+    default=None,
+    help='Socket to listen on (default: $REMAND_AGENT_SOCKET or a socket in '
+    'the user cache directory)')
+@click.option(
+    '--idle-timeout',
+    default=600,
+    help='Close connections unused for this many seconds')
+def run_agent(socket_path, idle_timeout):
+    try:
+        agent.serve(socket_path or agent.default_socket_path(), idle_timeout)
+    except RemandError as e:
+        log.error(str(e))
+        sys.exit(1)
+
+
 FILE_PY_TPL = """{project}.webfiles.add_url(
     {fn!r},
     {url!r},
@@ -36,30 +36,119 @@ def load_configuration(app_name, configfiles=[]):
 
 
 class HostRegistry(object):
+    """Resolves the configuration for hosts from ``Host:`` and ``Match:``
+    sections.
+
+    ``Host:`` sections are looked up by name, ``Match:`` patterns are tried
+    through a few combined regular expressions. The values of all sections
+    matching a host are merged once and cached.
+    """
     MATCH_PREFIX = 'Match:'
     HOST_PREFIX = 'Host:'
 
+    # python 2 limits regular expressions to 100 groups
+    MAX_GROUPS = 99
+
+    # patterns that cannot be combined with others: inline flags apply to the
+    # whole expression, numbered references depend on the groups before them
+    _UNCOMBINABLE_RE = re.compile(r'\(\?[iLmsux]+\)|\\\d|\(\?P=|\(\?\(')
+
     def __init__(self, cfg):
+        # maps host names to (position, section)
+        self.hosts = {}
+        # lists of (combined expression, [(group name, position, section)])
+        self.matchers = []
+        # list of (expression, position, section)
         self.host_res = []
+        self._cache = {}
+        # values of individual sections by position, as reading them through
+        # the parser is slow
+        self._values = {}
+
+        batch = []
+        batch_groups = 0
 
-        for name, sect in cfg.items():
+        for pos, (name, sect) in enumerate(cfg.items()):
             if name.startswith(self.HOST_PREFIX):
-                pattern = re.escape(name[len(self.HOST_PREFIX):])
+                self.hosts[name[len(self.HOST_PREFIX):]] = (pos, sect)
+                continue
 
-            elif name.startswith(self.MATCH_PREFIX):
-                pattern = name[len(self.MATCH_PREFIX):]
-                if 'match' in sect:
-                    pattern = sect['match']
-            else:
+            if not name.startswith(self.MATCH_PREFIX):
                 continue
 
-            self.host_res.append((re.compile(pattern + '$'), sect))
+            pattern = name[len(self.MATCH_PREFIX):]
+            if 'match' in sect:
+                pattern = sect['match']
+
+            # the '$' is kept inside the group, as it was appended to the
+            # pattern itself before
+            exp = re.compile(pattern + '$')
+            if self._UNCOMBINABLE_RE.search(pattern):
+                self.host_res.append((exp, pos, sect))
+                continue
+
+            if batch and batch_groups + exp.groups + 1 > self.MAX_GROUPS:
+                self._add_matcher(batch)
+                batch = []
+                batch_groups = 0
+
+            batch.append((pattern, pos, sect))
+            batch_groups += exp.groups + 1
+
+        if batch:
+            self._add_matcher(batch)
+
+    def _add_matcher(self, batch):
+        # every pattern becomes an optional lookahead, which captures the
+        # host name if the pattern matches, independent of all others
+        groups = []
+        parts = []
+        for i, (pattern, pos, sect) in enumerate(batch):
+            group = 'm{}'.format(i)
+            parts.append('(?=(?P<{}>{}$))?'.format(group, pattern))
+            groups.append((group, pos, sect))
+
+        try:
+            exp = re.compile(''.join(parts))
+        except re.error:
+            # e.g. group names used by more than one pattern
+            self.host_res.extend((re.compile(pattern + '$'), pos, sect)
+                                 for pattern, pos, sect in batch)
+        else:
+            self.matchers.append((exp, groups))
+
+    def _matching_sections(self, hostname):
+        matching = []
+
+        if hostname in self.hosts:
+            matching.append(self.hosts[hostname])
+
+        for exp, groups in self.matchers:
+            m = exp.match(hostname)
+            matching.extend((pos, sect) for group, pos, sect in groups
+                            if m.group(group) is not None)
+
+        matching.extend((pos, sect) for exp, pos, sect in self.host_res
+                        if exp.match(hostname))
+
+        # sections further down overwrite those defined earlier
+        matching.sort(key=lambda item: item[0])
+        return matching
+
+    def _section_values(self, pos, sect):
+        values = self._values.get(pos)
+        if values is None:
+            values = self._values[pos] = dict(sect.items())
+        return values
 
     def get_config_for_host(self, hostname):
-        matching_sects = [
-            sect for exp, sect in self.host_res if exp.match(hostname)
-        ]
+        values = self._cache.get(hostname)
+
+        if values is None:
+            values = {}
+            for pos, sect in self._matching_sections(hostname):
+                values.update(self._section_values(pos, sect))
+            self._cache[hostname] = values
 
-        # use sections in reverse so that sections further down overwrite
-        # those defined earlier
-        return TypeConversionChainMap(*reversed(matching_sects))
+        # changes go to the empty front map, leaving the cached values intact
+        return TypeConversionChainMap({}, values)
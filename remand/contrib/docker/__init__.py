@@ -12,8 +12,8 @@ docker = Plan(__name__, os.path.dirname(__file__))
 def install_docker_compose():
     # docker: install docker compose
     ch = fs.upload_file(docker.webfiles['docker-compose-Linux-x86_64'],
-                        '/usr/local/bin/docker-compose').changed
-    ch |= fs.chmod('/usr/local/bin/docker-compose', mode=0o755).changed
+                        '/usr/local/bin/docker-compose',
+                        mode=0o755).changed
 
     if ch:
         return Changed(msg='Installed docker-compose')
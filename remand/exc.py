@@ -10,6 +10,17 @@ class ReconnectNeeded(RemandError):
     """A reconnect has been request."""
 
 
+class RebootInProgress(ReconnectNeeded):
+    """A reboot has been issued, reconnecting must wait for it to finish.
+
+    :param boot_id: The boot id before rebooting, if known.
+    """
+
+    def __init__(self, msg, boot_id=None):
+        super(RebootInProgress, self).__init__(msg)
+        self.boot_id = boot_id
+
+
 class TransportError(RemandError):
     """Indicates an error with the transport, which is non-recoverable."""
 
@@ -45,7 +45,7 @@ def memoize(key=None):
         @wraps(f)
         def _(*args):
             sig = (name, ) + args
-            if config.get_bool('info_cache') and sig in info.cache:
+            if config.snapshot().info_cache and sig in info.cache:
                 v = info.cache[sig]
                 log.debug('Memoize cache hit {}'.format(sig))
             else:
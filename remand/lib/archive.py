@@ -1,4 +1,5 @@
 from . import proc, fs
+from .fs import upload
 from remand import remote
 from remand.operation import Changed
 
@@ -11,8 +12,14 @@ TAR_DECOMP_FLAGS = {
     '.tar.xz': 'J',
 }
 
+# codecs usable to compress uncompressed tarballs in transit
+TAR_CODEC_FLAGS = {
+    'gzip': 'z',
+    'xz': 'J',
+}
+
 
-def extract(fn, remote_dest):
+def extract(fn, remote_dest, compress=True):
     # FIXME: should check if remote_dest is an existing directory or create it
     # FIXME: add a way to extract arbitrary archives locally and send?
     if fn.endswith('.zip'):
@@ -33,9 +40,22 @@ def extract(fn, remote_dest):
                 'Unsupported archive type (determined by file ending): {}'
                 .format(fn))
 
-        args = ['tar', decomp_flag + 'xf', '-', '-C', remote_dest]
+        # uncompressed tarballs are compressed on the fly, if possible
+        codec = None
+        if compress and not decomp_flag:
+            codec = upload.select_codec(TAR_CODEC_FLAGS)
 
         with open(fn, 'rb') as inp:
-            proc.run(args, input=inp)
+            if codec is None:
+                args = ['tar', decomp_flag + 'xf', '-', '-C', remote_dest]
+                proc.run(args, input=inp)
+            else:
+                args = [
+                    'tar', TAR_CODEC_FLAGS[codec] + 'xf', '-', '-C',
+                    remote_dest
+                ]
+                level = upload.select_level(codec)
+                with upload.compressed_input(codec, level, inp) as stream:
+                    proc.run(args, input=stream)
 
     return Changed(msg='Extracted archive {} to {}'.format(fn, remote_dest))
@@ -3,7 +3,7 @@ from contextlib import contextmanager
 import os
 from stat import S_ISDIR, S_ISLNK, S_ISREG
 
-from remand import remote, config, log
+from remand import remote, config, log, info
 from remand.lib import proc
 from remand.exc import (
     ConfigurationError, RemoteFailureError, RemoteFileDoesNotExistError,
@@ -12,6 +12,7 @@ from remand.exc import (
 from remand.operation import operation, Changed, Unchanged
 import volatile
 
+from . import release, store, transfer, tree
 from .edit import EditableFile
 from .verify import Verifier
 from .upload import Uploader
@@ -53,6 +54,45 @@ def _expand_remote_dest(local_path, remote_path):
     return st, remote_path
 
 
+def _resolve_uid(user):
+    if user is None or isinstance(user, (int, long)):
+        return user
+    return info['posix.users'][user].uid
+
+
+def _resolve_gid(group):
+    if group is None or isinstance(group, (int, long)):
+        return group
+    return info['posix.groups'][group].gid
+
+
+def _attr_changes(st, mode=None, uid=None, gid=None, atime=None,
+                  mtime=None):
+    # returns the arguments for remote.setstat needed to bring a file with
+    # stat result st in line with the requested attributes
+    changes = {}
+
+    if mode is not None:
+        if mode > 0o7777:
+            raise ValueError('Modes above 0o7777 are not supported')
+        if st.st_mode & 0o7777 != mode:
+            changes['mode'] = mode
+
+    if uid is not None and st.st_uid != uid:
+        changes['uid'] = uid
+
+    if gid is not None and st.st_gid != gid:
+        changes['gid'] = gid
+
+    if ((mtime is not None and int(st.st_mtime) != int(mtime)) or
+            (atime is not None and int(st.st_atime) != int(atime))):
+        # times are always set in pairs
+        changes['mtime'] = st.st_mtime if mtime is None else mtime
+        changes['atime'] = st.st_atime if atime is None else atime
+
+    return changes
+
+
 @operation()
 def chown(remote_path, uid=None, gid=None, recursive=False):
     new_owner = ':'
@@ -146,6 +186,197 @@ def create_dir(path, mode=0777):
     return Unchanged('Already exists: {}'.format(path))
 
 
+@operation()
+def deploy_release(local_tree, base_dir, keep=5):
+    """Deploys ``local_tree`` as a new release below ``base_dir``.
+
+    Each release is uploaded into a new directory inside ``base_dir/releases``.
+    Files unchanged since the active release are hardlinked from it, only
+    changed files are transferred. Afterwards, the ``base_dir/current`` link
+    is switched to the new release atomically and old releases are removed.
+
+    Files of a release must never be modified in place, as they are shared
+    with other releases.
+
+    :param local_tree: Local directory to deploy.
+    :param base_dir: Remote directory holding the releases.
+    :param keep: Number of releases to keep, including the new one.
+    :param return: ``False`` if the active release already matches
+                   ``local_tree``, ``True`` otherwise.
+    """
+    local_entries = tree.local_entries(local_tree)
+
+    prev = release.current_release(base_dir)
+    prev_entries = {}
+    if prev is not None:
+        prev_entries = tree.load_manifest(prev, release.manifest_path(prev))
+        if prev_entries is None:
+            prev_entries = tree.remote_entries(prev)
+
+    if prev_entries == local_entries:
+        return Unchanged(msg=u'Release {} already up-to-date'.format(prev))
+
+    create_dir(release.releases_dir(base_dir))
+    new = remote.path.join(
+        release.releases_dir(base_dir), release.new_release_name(base_dir))
+    remote.mkdir(new)
+
+    dirs, unchanged, changed = {}, [], []
+    for rel, entry in local_entries.items():
+        if entry[0] == tree.DIR:
+            dirs[rel] = entry[2]
+        elif prev_entries.get(rel) == entry:
+            unchanged.append(rel)
+        else:
+            changed.append(rel)
+
+    release.make_dirs(new, dirs)
+    release.link_unchanged(prev, new, sorted(unchanged))
+
+    for rel in changed:
+        upload_file(
+            os.path.join(local_tree, *rel.split('/')),
+            remote.path.join(new, rel),
+            mode=local_entries[rel][2],
+            follow_symlink=False)
+
+    tree.save_manifest(new, local_entries, release.manifest_path(new))
+    release.switch(base_dir, new)
+    log.info('Deployed release {}: {} entries transferred, {} linked'.format(
+        new, len(changed), len(unchanged)))
+
+    old = release.old_releases(base_dir, keep, new)
+    if old:
+        proc.run([config['cmd_rm'], '-rf', '--'] + old +
+                 [release.manifest_path(path) for path in old])
+
+    return Changed(msg=u'Deployed {} to {}'.format(local_tree, new))
+
+
+def _expand_local_dest(remote_path, local_path):
+    if local_path is None:
+        local_path = remote_path
+
+    if os.path.isdir(local_path):
+        local_path = os.path.join(local_path,
+                                  remote.path.basename(remote_path))
+        log.debug('Expanded local_path to {!r}'.format(local_path))
+
+    return local_path
+
+
+def _needs_download(verifier, st, remote_path, local_path):
+    if not os.path.lexists(local_path):
+        return True
+
+    if os.path.islink(local_path) or not os.path.isfile(local_path):
+        raise ConfigurationError(
+            'Not a regular file: {!r}'.format(local_path))
+
+    return not verifier.verify_file(st, local_path, remote_path)
+
+
+@operation()
+def download_file(remote_path, local_path=None, create_parent=False):
+    """Downloads a remote file, if it does not exist locally or differs from
+    the local version.
+
+    The counterpart of :func:`~remand.lib.fs.upload_file`. Local files are
+    compared using the method configured in ``fs_local_file_verify``, which
+    accepts the same values as ``fs_remote_file_verify``.
+
+    :param remote_path: Remote file to download.
+    :param local_path: Local name for the file. If ``None``, same as
+                       ``remote_path``. If it points to a directory, the file
+                       will be downloaded into the directory.
+    :param return: ``False`` if no download was necessary, ``True`` otherwise.
+    """
+    local_path = _expand_local_dest(remote_path, local_path)
+
+    st = remote.stat(remote_path)
+    if st is None:
+        raise RemoteFileDoesNotExistError(remote_path)
+
+    if not S_ISREG(st.st_mode):
+        raise RemoteFailureError(
+            'Not a regular file: {!r}'.format(remote_path))
+
+    verifier = Verifier._by_short_name(config['fs_local_file_verify'])()
+
+    if not _needs_download(verifier, st, remote_path, local_path):
+        return Unchanged(msg='File up-to-date: {}'.format(local_path))
+
+    if create_parent and not os.path.isdir(os.path.dirname(local_path)):
+        os.makedirs(os.path.dirname(local_path))
+
+    transfer.download(remote, remote_path, local_path, st)
+    return Changed(msg='Download {} -> {}'.format(remote_path, local_path))
+
+
+@operation()
+def download_tree(remote_path, local_path):
+    """Downloads a remote directory tree.
+
+    The counterpart of :func:`~remand.lib.fs.upload_tree`. Files that need
+    to be downloaded are transferred concurrently.
+
+    :param remote_path: Remote directory to download.
+    :param local_path: Local directory to download into. Will be created if
+                       it does not exist.
+    """
+    verifier = Verifier._by_short_name(config['fs_local_file_verify'])()
+
+    changed = False
+    pending = []
+    dirs = ['']
+
+    while dirs:
+        rel = dirs.pop()
+        rem = remote.path.join(remote_path, rel)
+        loc = os.path.join(local_path, *rel.split(remote.path.sep))
+
+        if not os.path.isdir(loc):
+            os.makedirs(loc)
+            changed = True
+
+        for name in remote.listdir(rem):
+            remote_fn = remote.path.join(rem, name)
+            local_fn = os.path.join(loc, name)
+            st = remote.lstat(remote_fn)
+
+            if S_ISDIR(st.st_mode):
+                dirs.append(remote.path.join(rel, name))
+            elif S_ISLNK(st.st_mode):
+                target = remote.readlink(remote_fn)
+                if (os.path.islink(local_fn) and
+                        os.readlink(local_fn) == target):
+                    continue
+
+                if os.path.lexists(local_fn):
+                    os.unlink(local_fn)
+                os.symlink(target, local_fn)
+                changed = True
+            elif S_ISREG(st.st_mode):
+                if _needs_download(verifier, st, remote_fn, local_fn):
+                    pending.append((remote_fn, local_fn, st))
+            else:
+                log.warning('Not downloading special file {}'.format(
+                    remote_fn))
+
+    if pending:
+        log.debug('Downloading {} files from {}'.format(
+            len(pending), remote_path))
+        transfer.download_many(pending)
+        changed = True
+
+    if changed:
+        return Changed(msg='Downloaded tree {} => {}'.format(
+            remote_path, local_path))
+
+    return Unchanged(msg='Tree already downloaded: {} => {}'.format(
+        remote_path, local_path))
+
+
 @contextmanager
 def edit(remote_path, create=True):
     with volatile.file() as tmp:
@@ -228,16 +459,88 @@ def remove_dir(remote_path, recursive=True):
         raise RemotePathIsNotADirectoryError(remote_path)
 
     if recursive:
-        for dirpath, dirnames, filenames in walk(remote_path, topdown=False):
-            for fn in filenames:
-                remote.unlink(remote.path.join(dirpath, fn))
-            remote.rmdir(dirpath)
+        try:
+            # a single command is much faster than unlinking entry by entry
+            proc.run([config['cmd_rm'], '-rf', '--', remote_path])
+        except (RemoteFailureError, NotImplementedError) as e:
+            log.debug('Removing {} with {} failed, walking tree instead: {}'
+                      .format(remote_path, config['cmd_rm'], e))
+
+            for dirpath, dirnames, filenames in walk(remote_path,
+                                                     topdown=False):
+                for fn in filenames:
+                    remote.unlink(remote.path.join(dirpath, fn))
+                remote.rmdir(dirpath)
     else:
-        remote.rmdir(dirpath)
+        remote.rmdir(remote_path)
 
     return Changed(msg=u'Removed directory: {}'.format(remote_path))
 
 
+@operation()
+def set_attrs(remote_path, mode=None, uid=None, gid=None, mtime=None,
+              atime=None):
+    """Sets mode, ownership and timestamps of a remote file.
+
+    All changes are applied at once, using a single request on transports
+    that support it.
+
+    :param remote_path: Path to change. Symbolic links are followed.
+    :param mode: New mode, e.g. ``0o644``.
+    :param uid: New owner, either a user name or a numeric uid.
+    :param gid: New group, either a group name or a numeric gid.
+    :param mtime: New modification time.
+    :param atime: New access time. If only ``mtime`` is given, the access time
+                  is left unchanged.
+    :param return: ``False`` if all attributes already had the requested
+                   values, ``True`` otherwise.
+    """
+    st = remote.stat(remote_path)
+    if st is None:
+        raise RemoteFileDoesNotExistError(remote_path)
+
+    changes = _attr_changes(st, mode, _resolve_uid(uid), _resolve_gid(gid),
+                            atime, mtime)
+
+    if not changes:
+        return Unchanged(
+            msg=u'Attributes of {} already set'.format(remote_path))
+
+    remote.setstat(remote_path, **changes)
+    return Changed(msg=u'Changed {} of {}'.format(', '.join(
+        sorted(changes)), remote_path))
+
+
+@operation()
+def store_gc(keep_runs=None):
+    """Removes blobs from the remote blob store that have not been used by
+    any of the last ``keep_runs`` runs.
+
+    :param keep_runs: Number of runs to keep. Defaults to the
+                      ``fs_store_keep_runs`` configuration setting.
+    """
+    if keep_runs is None:
+        keep_runs = int(config['fs_store_keep_runs'])
+
+    runs = store.list_runs()
+    if keep_runs < 1 or len(runs) <= keep_runs:
+        return Unchanged(msg=u'Blob store has {} runs, nothing to remove'
+                         .format(len(runs)))
+
+    old, kept = runs[:-keep_runs], runs[-keep_runs:]
+
+    in_use = set()
+    for run in kept:
+        in_use |= store.read_run(run)
+
+    unused = [d for d in store.list_blobs() if d not in in_use]
+    store.remove([store.blob_path(d) for d in unused] +
+                 [remote.path.join(store.runs_dir(), run) for run in old])
+
+    return Changed(msg=u'Removed {} blobs and {} runs from blob store'.format(
+        len(unused), len(old)))
+
+
 @operation()
 def symlink(src, dst):
     if dst.endswith('/'):
@@ -298,7 +601,10 @@ def touch(remote_path, mtime=None, atime=None):
 def upload_file(local_path,
                 remote_path=None,
                 follow_symlink=True,
-                create_parent=False):
+                create_parent=False,
+                mode=None,
+                owner=None,
+                group=None):
     """Uploads a local file to a remote and if does not exist or differs
     from the local version, uploads it.
 
@@ -312,11 +618,17 @@ def upload_file(local_path,
                         ``local_path``. If it points to a directory, the file
                         will be uploaded to the directory. Symbolic links not
                         pointing to a directory are an error.
+    :param mode: If not ``None``, the mode to set on the remote file.
+    :param owner: If not ``None``, the owner to set on the remote file. See
+                  :func:`~remand.lib.fs.set_attrs`.
+    :param group: If not ``None``, the group to set on the remote file.
 
-    :param return: ``False`` if no upload was necessary, ``True`` otherwise.
+    :param return: ``False`` if neither an upload nor a change of attributes
+                   was necessary, ``True`` otherwise.
     """
     st, remote_path = _expand_remote_dest(local_path, remote_path)
     lst = os.stat(local_path) if follow_symlink else os.lstat(local_path)
+    uid, gid = _resolve_uid(owner), _resolve_gid(group)
 
     verifier = Verifier._by_short_name(config['fs_remote_file_verify'])()
     uploader = Uploader._by_short_name(config['fs_remote_file_upload'])()
@@ -348,28 +660,54 @@ def upload_file(local_path,
         if create_parent:
             create_dir(remote.path.dirname(remote_path))
 
+        attrs = {'mode': mode, 'uid': uid, 'gid': gid}
+        if config.snapshot().fs_update_mtime:
+            attrs['atime'] = attrs['mtime'] = lst.st_mtime
+            log.debug('Updating atime/mtime: {}'.format(lst.st_mtime))
+        set_attrs = any(v is not None for v in attrs.values())
+
+        uploader.exclusive = set_attrs
         uploader.upload_file(local_path, remote_path)
 
-        if config.get_bool('fs_update_mtime'):
-            times = (lst.st_mtime, lst.st_mtime)
-            remote.utime(remote_path, times)
-            log.debug('Updated atime/mtime: {}'.format(times))
+        # times, mode and ownership are set in one go
+        if set_attrs:
+            remote.setstat(remote_path, **attrs)
+
+        verifier.record_file(local_path, remote_path)
         return Changed(msg='Upload {} -> {}'.format(local_path, remote_path))
 
+    changes = _attr_changes(st, mode, uid, gid)
+    if changes:
+        # the file may have been placed as a hardlink to a blob earlier
+        store.unshare(remote_path)
+        remote.setstat(remote_path, **changes)
+        return Changed(msg='Changed {} of {}'.format(', '.join(
+            sorted(changes)), remote_path))
+
     return Unchanged(msg='File up-to-date: {}'.format(remote_path))
 
 
 @operation()
-def upload_string(buf, remote_path, create_parent=False):
+def upload_string(buf,
+                  remote_path,
+                  create_parent=False,
+                  mode=None,
+                  owner=None,
+                  group=None):
     """Similar to :func:`~remand.lib.fs.upload_file`, but uploads a
     buffer instead of a file-like object.
 
     :param buf: Data to send. Can be string or unicode.
     :param remote_path: Remote name for the file. See
                         :func:`~remand.lib.fs.upload_file` for details.
-    :param return: ``False`` if no upload was necessary, ``True`` otherwise.
+    :param mode: See :func:`~remand.lib.fs.upload_file`.
+    :param owner: See :func:`~remand.lib.fs.upload_file`.
+    :param group: See :func:`~remand.lib.fs.upload_file`.
+    :param return: ``False`` if neither an upload nor a change of attributes
+                   was necessary, ``True`` otherwise.
     """
     st, remote_path = _expand_remote_dest(None, remote_path)
+    uid, gid = _resolve_uid(owner), _resolve_gid(group)
 
     verifier = Verifier._by_short_name(config['fs_remote_string_verify'])()
     uploader = Uploader._by_short_name(config['fs_remote_string_upload'])()
@@ -377,31 +715,102 @@ def upload_string(buf, remote_path, create_parent=False):
     if not st or not verifier.verify_buffer(st, buf, remote_path):
         if create_parent:
             create_dir(remote.path.dirname(remote_path))
+        set_attrs = mode is not None or uid is not None or gid is not None
+        uploader.exclusive = set_attrs
         uploader.upload_buffer(buf, remote_path)
+
+        if set_attrs:
+            remote.setstat(remote_path, mode=mode, uid=uid, gid=gid)
+
+        verifier.record_buffer(buf, remote_path)
         return Changed(msg='Upload buffer ({}) -> {}'.format(
             len(buf), remote_path))
 
+    changes = _attr_changes(st, mode, uid, gid)
+    if changes:
+        # the file may have been placed as a hardlink to a blob earlier
+        store.unshare(remote_path)
+        remote.setstat(remote_path, **changes)
+        return Changed(msg='Changed {} of {}'.format(', '.join(
+            sorted(changes)), remote_path))
+
     return Unchanged(msg='File up-to-date: {}'.format(remote_path))
 
 
+def _upload_tree_digests(local_path, remote_path, use_manifest):
+    local_entries = tree.local_entries(local_path)
+
+    remote_entries = None
+    if use_manifest:
+        remote_entries = tree.load_manifest(remote_path)
+    if remote_entries is None:
+        remote_entries = tree.remote_entries(remote_path)
+
+    changed = False
+    for rel in tree.diff(local_entries, remote_entries):
+        rem = remote.path.join(remote_path, rel) if rel else remote_path
+
+        kind, value, mode = local_entries[rel]
+        if kind == tree.DIR:
+            changed |= create_dir(rem).changed
+            changed |= set_attrs(rem, mode=mode).changed
+        elif kind == tree.LINK:
+            # links are replaced as they are, remote links must not be
+            # followed like upload_file does
+            rst = remote.lstat(rem)
+            if rst and S_ISDIR(rst.st_mode):
+                remove_dir(rem)
+            elif rst:
+                remote.unlink(rem)
+            remote.symlink(value, rem)
+            changed = True
+        else:
+            local_fn = os.path.join(local_path, *rel.split('/'))
+            changed |= upload_file(
+                local_fn, rem, mode=mode, follow_symlink=False).changed
+
+    if use_manifest and (changed or remote_entries != local_entries):
+        tree.save_manifest(remote_path, local_entries)
+
+    return changed
+
+
 @operation()
 def upload_tree(local_path, remote_path):
+    """Uploads a local directory tree.
+
+    How unchanged parts of the tree are detected can be configured using the
+    ``fs_remote_tree_verify`` configuration variable.
+
+    :param local_path: Local directory to upload.
+    :param remote_path: Remote directory to upload to. Will be created if it
+                        does not exist.
+    """
     # FIXME: think about implications regarding ownership, other attributes
     # FIXME: allow removing (sync)
-    create_dir(remote_path)
-    changed = False
+    method = config['fs_remote_tree_verify']
+    if method not in ('files', 'merkle', 'manifest'):
+        raise ConfigurationError(
+            'Unknown tree verification method: {!r}'.format(method))
 
-    for dirpath, dirnames, filenames in os.walk(local_path):
-        rel = os.path.relpath(dirpath, local_path)
-        rem = remote.path.join(remote_path, rel)
+    if method != 'files':
+        changed = _upload_tree_digests(local_path, remote_path,
+                                       method == 'manifest')
+    else:
+        create_dir(remote_path)
+        changed = False
 
-        changed |= create_dir(rem).changed
-        for fn in filenames:
-            local_fn = os.path.join(dirpath, fn)
-            remote_fn = remote.path.join(rem, fn)
+        for dirpath, dirnames, filenames in os.walk(local_path):
+            rel = os.path.relpath(dirpath, local_path)
+            rem = remote.path.join(remote_path, rel)
 
-            changed |= upload_file(
-                local_fn, remote_fn, follow_symlink=False).changed
+            changed |= create_dir(rem).changed
+            for fn in filenames:
+                local_fn = os.path.join(dirpath, fn)
+                remote_fn = remote.path.join(rem, fn)
+
+                changed |= upload_file(
+                    local_fn, remote_fn, follow_symlink=False).changed
 
     if changed:
         return Changed(msg='Uploaded tree {} => {}'.format(
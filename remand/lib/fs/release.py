@@ -0,0 +1,128 @@
+"""Helpers for :func:`~remand.lib.fs.deploy_release`.
+
+Releases are kept in the ``releases`` directory below the base directory,
+named after the time of their deployment. ``current`` is a symbolic link to
+the active release.
+"""
+
+from collections import defaultdict
+import time
+
+from remand import remote, config, log
+from remand.lib import proc
+from .util import remote_tmp_name
+
+# creates the directories passed on stdin below $0, using the xargs and mkdir
+# commands passed as $1 and $2
+_MKDIRS_SCRIPT = 'cd "$0" && "$1" -0 "$2" -p --'
+
+# sets the mode of the paths passed on stdin below $0 to $3, using the xargs
+# and chmod commands passed as $1 and $2
+_CHMOD_SCRIPT = 'cd "$0" && "$1" -0 "$2" "$3" --'
+
+# hardlinks the files and links passed on stdin from $0 into $1, creating
+# parent directories as needed. $2 and $3 are the xargs and cp commands
+_LINK_SCRIPT = 'cd "$0" && "$2" -0 "$3" -lP --parents -t "$1" --'
+
+
+def releases_dir(base_dir):
+    return remote.path.join(base_dir, 'releases')
+
+
+def current_link(base_dir):
+    return remote.path.join(base_dir, 'current')
+
+
+def manifest_path(release):
+    """Returns the path of the manifest describing ``release``. It is kept
+    next to the release, hidden from listings."""
+    head, tail = remote.path.split(release)
+    return remote.path.join(head, '.{}.manifest'.format(tail))
+
+
+def current_release(base_dir):
+    """Returns the path of the active release or ``None``."""
+    link = current_link(base_dir)
+    if not remote.lstat(link):
+        return None
+
+    target = remote.readlink(link)
+    return remote.path.normpath(remote.path.join(base_dir, target))
+
+
+def new_release_name(base_dir):
+    name = time.strftime('%Y%m%d%H%M%S')
+
+    # deploying twice within a second should not clobber the first release
+    rdir = releases_dir(base_dir)
+    candidate, n = name, 0
+    while remote.lstat(remote.path.join(rdir, candidate)):
+        n += 1
+        candidate = '{}-{}'.format(name, n)
+    return candidate
+
+
+def make_dirs(release, modes):
+    """Creates directories below ``release`` and sets their modes, using a
+    single command per distinct mode.
+
+    :param modes: A dictionary mapping paths relative to ``release`` to
+                  modes. ``''`` stands for ``release`` itself.
+    """
+    paths = sorted(path for path in modes if path)
+    if paths:
+        proc.run(['sh', '-c', _MKDIRS_SCRIPT, release, config['cmd_xargs'],
+                  config['cmd_mkdir']], input='\0'.join(paths))
+
+    by_mode = defaultdict(list)
+    for path, mode in modes.items():
+        by_mode[mode].append(path or '.')
+
+    for mode, paths in sorted(by_mode.items()):
+        proc.run(['sh', '-c', _CHMOD_SCRIPT, release, config['cmd_xargs'],
+                  config['cmd_chmod'], '{:o}'.format(mode)],
+                 input='\0'.join(sorted(paths)))
+
+
+def link_unchanged(prev_release, release, paths):
+    """Hardlinks ``paths`` from ``prev_release`` into ``release``, using a
+    single command."""
+    if paths:
+        log.debug('Linking {} unchanged entries from {}'.format(
+            len(paths), prev_release))
+        proc.run(['sh', '-c', _LINK_SCRIPT, prev_release, release,
+                  config['cmd_xargs'], config['cmd_cp']],
+                 input='\0'.join(paths))
+
+
+def switch(base_dir, release):
+    """Atomically points the ``current`` link at ``release``."""
+    link = current_link(base_dir)
+    tmp_link = remote_tmp_name(link)
+
+    remote.symlink(remote.path.relpath(release, base_dir), tmp_link)
+    try:
+        remote.rename(tmp_link, link)
+    except Exception:
+        remote.unlink(tmp_link)
+        raise
+
+
+def _release_key(name):
+    # releases deployed within the same second are numbered, plain string
+    # order would put "-10" before "-2"
+    stamp, _, n = name.partition('-')
+    return stamp, int(n) if n.isdigit() else 0
+
+
+def old_releases(base_dir, keep, active):
+    """Returns all releases but the ``keep`` newest ones and ``active``."""
+    names = sorted((name for name in remote.listdir(releases_dir(base_dir))
+                    if not name.startswith('.')),
+                   key=_release_key)
+    old = names[:-keep] if keep > 0 else names
+
+    return [
+        remote.path.join(releases_dir(base_dir), name) for name in old
+        if remote.path.join(releases_dir(base_dir), name) != active
+    ]
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import stat
+
+from remand import remote, config, log
+from remand.exc import RemoteFailureError
+from remand.lib import proc
+from . import transfer
+
+# hashes the first $1 bytes of $2, using the hash command passed as $0
+_PREFIX_HASH_SCRIPT = 'head -c "$1" "$2" | "$0"'
+
+# overwrites $1 with the contents of $0, keeping its inode
+_OVERWRITE_SCRIPT = 'cat "$0" > "$1"'
+
+
+def sidecar_paths(remote_path):
+    """Returns the paths of the partial file and the progress record used
+    while uploading to ``remote_path``."""
+    head, tail = remote.path.split(remote_path)
+    return (remote.path.join(head, '.{}.remand-partial'.format(tail)),
+            remote.path.join(head, '.{}.remand-progress'.format(tail)))
+
+
+def _source_record(lst):
+    return {'size': lst.st_size, 'mtime': int(lst.st_mtime)}
+
+
+def _read_progress(progress_path):
+    if not remote.lstat(progress_path):
+        return None
+
+    try:
+        with remote.file(progress_path, 'rb') as f:
+            return json.loads(f.read())
+    except ValueError:
+        log.warning('Ignoring corrupt progress record {}'.format(
+            progress_path))
+        return None
+
+
+def _write_progress(progress_path, record):
+    with remote.file(progress_path, 'wb') as f:
+        f.write(json.dumps(record))
+
+
+def _hash_local_prefix(local_path, length):
+    m = hashlib.sha1()
+    bufsize = remote.buffer_size()
+
+    with open(local_path, 'rb') as f:
+        while length:
+            buf = f.read(min(bufsize, length))
+            if not buf:
+                break
+            m.update(buf)
+            length -= len(buf)
+    return m.hexdigest()
+
+
+def _hash_remote_prefix(remote_path, length):
+    stdout, _, _ = proc.run([
+        'sh', '-c', _PREFIX_HASH_SCRIPT, config['cmd_sha1sum'], str(length),
+        remote_path
+    ])
+    return stdout.split(None, 1)[0]
+
+
+def _resume_offset(local_path, lst, partial_path, progress_path):
+    record = _read_progress(progress_path)
+
+    if record is None:
+        return 0
+
+    if record.get('source') != _source_record(lst):
+        log.debug('Local file changed since the partial upload, restarting')
+        return 0
+
+    pst = remote.stat(partial_path)
+    if not pst or pst.st_size != lst.st_size:
+        log.debug('Partial file missing or of wrong size, restarting')
+        return 0
+
+    done = record.get('done', 0)
+    if not done:
+        return 0
+
+    local_hash = _hash_local_prefix(local_path, done)
+    remote_hash = _hash_remote_prefix(partial_path, done)
+    log.debug('Prefix of {} bytes: local hash {}, remote hash {}'.format(
+        done, local_hash, remote_hash))
+
+    if local_hash != remote_hash:
+        log.warning('Partial upload {} does not match {}, restarting'.format(
+            partial_path, local_path))
+        return 0
+
+    return done
+
+
+def _replace(partial_path, remote_path):
+    # moves the partial file into place, keeping the mode and owner of an
+    # existing destination. attributes given to the upload are applied
+    # afterwards by the caller
+    st = remote.stat(remote_path)
+    if st:
+        try:
+            remote.setstat(partial_path,
+                           mode=stat.S_IMODE(st.st_mode),
+                           uid=st.st_uid,
+                           gid=st.st_gid)
+        except RemoteFailureError as e:
+            log.debug('Cannot carry over attributes of {} ({}), overwriting '
+                      'it in place'.format(remote_path, e))
+            proc.run(['sh', '-c', _OVERWRITE_SCRIPT, partial_path,
+                      remote_path])
+            remote.unlink(partial_path)
+            return
+
+    remote.rename(partial_path, remote_path)
+
+
+def use_resumable_upload(size):
+    """Checks whether a file of ``size`` bytes should be uploaded resumably.
+    """
+    threshold = config['fs_resume_threshold']
+    return bool(threshold) and size >= int(threshold)
+
+
+def upload_resumable(local_path, remote_path):
+    """Uploads a file through a partial file next to ``remote_path``.
+
+    Progress is recorded in a sidecar file. If an earlier attempt was
+    interrupted, the already transferred prefix is verified by hash and the
+    upload continues where it left off. Once complete, the partial file is
+    moved into place atomically, taking over the mode and owner of an
+    existing destination.
+    """
+    lst = os.stat(local_path)
+    partial_path, progress_path = sidecar_paths(remote_path)
+
+    done = _resume_offset(local_path, lst, partial_path, progress_path)
+    if done:
+        log.info('Resuming upload of {} at {} of {} bytes'.format(
+            local_path, done, lst.st_size))
+
+    record = {'source': _source_record(lst), 'done': done}
+
+    def on_progress(contiguous):
+        record['done'] = contiguous
+        _write_progress(progress_path, record)
+
+    # the record is written before any data, to make sure the partial file
+    # is never mistaken for a complete one of another version
+    _write_progress(progress_path, record)
+    transfer.upload_ranges(local_path, partial_path, lst.st_size, done,
+                           on_progress)
+
+    pst = remote.stat(partial_path)
+    if pst.st_size != lst.st_size:
+        raise RemoteFailureError(
+            'Partial upload {} has size {}, expected {}'.format(
+                partial_path, pst.st_size, lst.st_size))
+
+    # make sure the data is on disk before it replaces the destination
+    with remote.file(partial_path, 'r+b') as f:
+        remote.fsync(f)
+    _replace(partial_path, remote_path)
+    remote.unlink(progress_path)
@@ -0,0 +1,200 @@
+"""Content-addressed blob store on the remote.
+
+Blobs are kept in ``fs_store_dir``, named after the SHA1 digest of their
+contents. Every run that places or adds a blob records its digest in a usage
+list of its own, which allows removing blobs not used by any of the last few
+runs (see :func:`~remand.lib.fs.store_gc`).
+"""
+
+from binascii import hexlify
+import os
+import stat
+import time
+
+from remand import _context, remote, config, log
+from remand.exc import RemoteFailureError
+from remand.lib import proc
+from .util import remote_tmp_name
+
+# exit status of ``_PLACE_SCRIPT`` if the blob is not in the store
+BLOB_MISSING = 3
+
+# copies or links blob $0 to $2 through a temporary file ($1), then records
+# digest $4 in the usage list $3. $5 is the placement mode, $6 to ${11} are
+# the cp, ln, mv, chown, chmod and rm commands. copies take over the owner
+# (where permitted) and mode of an existing destination, hardlinks share the
+# attributes of the blob. the destination is never written to, it may be
+# linked to a blob itself
+_PLACE_SCRIPT = """
+[ -f "$0" ] || exit 3
+if ! { [ "$5" = hardlink ] && "$7" -f "$0" "$1" 2>/dev/null; }; then
+    "$6" "$0" "$1" || { "${11}" -f "$1"; exit 1; }
+    if [ -e "$2" ]; then
+        "$9" --reference="$2" "$1" 2>/dev/null
+        "${10}" --reference="$2" "$1" || { "${11}" -f "$1"; exit 1; }
+    fi
+fi
+"$8" -f "$1" "$2" && echo "$4" >> "$3" || { "${11}" -f "$1"; exit 1; }
+"""
+
+# replaces $0 with a copy of itself (through temporary file $1) if it has
+# more than one link, so it no longer shares its inode with the store
+_UNSHARE_SCRIPT = ('[ "$(stat -c %h "$0")" -gt 1 ] || exit 0; '
+                   'cp -p "$0" "$1" && mv -f "$1" "$0" || '
+                   '{ rm -f "$1"; exit 1; }')
+
+# copies $0 into the store as blob $3 (through temporary file $2 in blob
+# directory $1), then records digest $5 in the usage list $4
+_INSERT_SCRIPT = ('mkdir -p "$1" "$(dirname "$4")" && cp "$0" "$2" && '
+                  'mv -f "$2" "$3" && echo "$5" >> "$4" || '
+                  '{ rm -f "$2"; exit 1; }')
+
+
+def store_run():
+    """Identifies the current run. Ids sort chronologically.
+
+    The id is kept in the run's state, so it stays the same for the whole
+    run, whether or not info functions are cached."""
+    state = _context.top['state']
+    if 'store_run' not in state:
+        state['store_run'] = '{}-{}'.format(
+            time.strftime('%Y%m%d%H%M%S'), hexlify(os.urandom(2)))
+    return state['store_run']
+
+
+def blobs_dir():
+    return remote.path.join(config['fs_store_dir'], 'blobs')
+
+
+def runs_dir():
+    return remote.path.join(config['fs_store_dir'], 'runs')
+
+
+def blob_path(digest):
+    return remote.path.join(blobs_dir(), digest[:2], digest[2:])
+
+
+def _run_list():
+    return remote.path.join(runs_dir(), store_run())
+
+
+def place(digest, remote_path, link=True):
+    """Places the blob ``digest`` at ``remote_path``.
+
+    Depending on ``fs_store_mode``, the blob is either copied or hardlinked.
+    Hardlinked files share their contents and attributes with the store,
+    they must not be modified in place and their attributes must not be
+    changed. Copies take over the mode and owner of an existing
+    ``remote_path``.
+
+    :param link: If ``False``, the blob is always copied. Must be ``False``
+                 if attributes will be applied to ``remote_path``.
+    :return: ``False`` if the blob is not in the store, ``True`` otherwise.
+    """
+    blob = blob_path(digest)
+    mode = config['fs_store_mode'] if link else 'copy'
+    _, _, returncode = proc.run([
+        'sh', '-c', _PLACE_SCRIPT, blob, remote_tmp_name(remote_path),
+        remote_path, _run_list(), digest, mode, config['cmd_cp'],
+        config['cmd_ln'], config['cmd_mv'], config['cmd_chown'],
+        config['cmd_chmod'], config['cmd_rm']
+    ], status_ok=(0, BLOB_MISSING))
+
+    if returncode == BLOB_MISSING:
+        log.debug('Blob {} not in store'.format(digest))
+        return False
+
+    log.debug('Placed blob {} at {}'.format(digest, remote_path))
+    return True
+
+
+def unshare(remote_path):
+    """Makes sure ``remote_path`` does not share its inode with a blob.
+
+    Files placed as hardlinks are replaced by a copy, so their attributes
+    can be changed without affecting the store. Only has an effect if
+    ``fs_store_mode`` is ``hardlink``."""
+    if config['fs_store_mode'] != 'hardlink':
+        return
+
+    proc.run([
+        'sh', '-c', _UNSHARE_SCRIPT, remote_path, remote_tmp_name(remote_path)
+    ])
+
+
+def upload_path(remote_path):
+    """Returns the path files missing from the store are uploaded to before
+    being moved to ``remote_path``. The name does not change between runs,
+    so interrupted uploads can be resumed."""
+    head, tail = remote.path.split(remote_path)
+    return remote.path.join(head, '.{}.remand-upload'.format(tail))
+
+
+def replace(tmp_path, remote_path):
+    """Moves the freshly written file ``tmp_path`` to ``remote_path``.
+
+    The mode and owner of an existing ``remote_path`` are carried over
+    where possible. Unlike other uploads, the destination is never
+    overwritten in place, as it may be linked to a blob."""
+    st = remote.stat(remote_path)
+    if st:
+        try:
+            remote.setstat(tmp_path,
+                           mode=stat.S_IMODE(st.st_mode),
+                           uid=st.st_uid,
+                           gid=st.st_gid)
+        except RemoteFailureError as e:
+            log.warning('Cannot carry over attributes of {}: {}'.format(
+                remote_path, e))
+
+    remote.rename(tmp_path, remote_path)
+
+
+def insert(digest, remote_path):
+    """Adds the remote file ``remote_path`` to the store as ``digest``.
+
+    The file is copied, so later changes to it do not affect the store."""
+    blob = blob_path(digest)
+    proc.run([
+        'sh', '-c', _INSERT_SCRIPT, remote_path, remote.path.dirname(blob),
+        remote_tmp_name(blob), blob, _run_list(), digest
+    ])
+    log.debug('Stored {} as blob {}'.format(remote_path, digest))
+
+
+def list_runs():
+    """Returns the ids of all runs that used the store, oldest first."""
+    if not remote.lstat(runs_dir()):
+        return []
+    return sorted(remote.listdir(runs_dir()))
+
+
+def list_blobs():
+    """Returns the digests of all blobs in the store."""
+    if not remote.lstat(blobs_dir()):
+        return []
+
+    stdout, _, _ = proc.run(['find', blobs_dir(), '-type', 'f'])
+
+    digests = []
+    for line in stdout.splitlines():
+        head, tail = remote.path.split(line)
+        name = remote.path.basename(head) + tail
+
+        # skips temporary files left behind by interrupted inserts
+        if len(name) == 40 and not tail.startswith('.'):
+            digests.append(name)
+    return digests
+
+
+def read_run(run):
+    """Returns the set of digests used by ``run``."""
+    with remote.file(remote.path.join(runs_dir(), run), 'rb') as f:
+        return set(f.read().split())
+
+
+def remove(paths):
+    """Removes the remote files ``paths`` using a single command."""
+    if paths:
+        proc.run(['xargs', '-0', config['cmd_rm'], '-f', '--'],
+                 input='\0'.join(paths))
@@ -0,0 +1,306 @@
+from contextlib import closing
+from Queue import Queue, Empty
+from shutil import copyfileobj
+import os
+import tempfile
+import threading
+import time
+
+import contextlib2
+
+from remand import remote, config, log, keep_context
+from remand.exc import RemandError
+
+
+def _format_rate(nbytes, elapsed):
+    mib = nbytes / float(1024 * 1024)
+    rate = mib / elapsed if elapsed > 0 else float('inf')
+    return '{:.1f} MiB in {:.1f}s ({:.1f} MiB/s)'.format(mib, elapsed, rate)
+
+
+class RangedTransfer(object):
+    """Copies a file in ranges, using multiple workers concurrently.
+
+    Each worker is handed its own file session and opens its own pair of
+    source and destination files, then copies ranges of ``chunk_size`` bytes
+    at their respective offsets until all ranges are done.
+
+    :param size: Total size of the file.
+    :param chunk_size: Size of a single range.
+    :param bufsize: Size of individual reads and writes.
+    :param start: Offset to start at. Data before it is not transferred.
+    """
+
+    def __init__(self, size, chunk_size, bufsize, start=0):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.bufsize = bufsize
+
+        self.ranges = Queue()
+        for offset in xrange(start, size, chunk_size):
+            self.ranges.put((offset, min(chunk_size, size - offset)))
+
+        #: all data before this offset has been transferred
+        self.contiguous = start
+        self._finished = {}
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def _range_done(self, offset, length):
+        with self._lock:
+            self._finished[offset] = length
+            while self.contiguous in self._finished:
+                self.contiguous += self._finished.pop(self.contiguous)
+
+    def _worker(self, session, open_src, open_dst):
+        try:
+            with closing(open_src(session)) as src,\
+                    closing(open_dst(session)) as dst:
+                while not self._errors:
+                    try:
+                        offset, length = self.ranges.get_nowait()
+                    except Empty:
+                        return
+
+                    src.seek(offset)
+                    dst.seek(offset)
+
+                    remaining = length
+                    while remaining:
+                        buf = src.read(min(self.bufsize, remaining))
+                        if not buf:
+                            raise RemandError(
+                                'Unexpected end of file at offset {}'.format(
+                                    offset + length - remaining))
+                        dst.write(buf)
+                        remaining -= len(buf)
+
+                    # push out buffered data before reporting the range as
+                    # done. resumed uploads verify the prefix regardless
+                    dst.flush()
+                    self._range_done(offset, length)
+        except Exception as e:
+            self._errors.append(e)
+
+    def run(self, sessions, open_src, open_dst, on_progress=None):
+        """Runs the transfer, using one worker thread per session.
+
+        :param sessions: File sessions, see
+                         :func:`~remand.remotes.Remote.file_session`.
+        :param open_src: Called with a session, must return the opened source
+                         file.
+        :param open_dst: Called with a session, must return the opened
+                         destination file.
+        :param on_progress: Called from the calling thread with the number of
+                            bytes transferred contiguously from the start of
+                            the file, whenever that number changes.
+        :return: The number of seconds the transfer took.
+        """
+        start = time.time()
+        threads = []
+        for session in sessions:
+            t = threading.Thread(
+                target=keep_context(self._worker),
+                args=(session, open_src, open_dst))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        reported = self.contiguous
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+
+                if on_progress and self.contiguous != reported:
+                    reported = self.contiguous
+                    on_progress(reported)
+
+        if self._errors:
+            raise self._errors[0]
+
+        return time.time() - start
+
+
+def _num_workers(size):
+    settings = config.snapshot()
+    chunk_size = settings.fs_transfer_chunk_size
+    # no point in starting more workers than there are chunks
+    return max(1, min(settings.fs_transfer_workers,
+                      (size + chunk_size - 1) // chunk_size))
+
+
+def use_ranged_transfer(size):
+    """Checks whether a file of ``size`` bytes should be transferred in
+    parallel ranges."""
+    settings = config.snapshot()
+    return (size >= settings.fs_transfer_threshold and
+            settings.fs_transfer_workers > 1)
+
+
+def _ranged(size, open_src, open_dst, desc, start=0, on_progress=None):
+    xfer = RangedTransfer(size,
+                          config.snapshot().fs_transfer_chunk_size,
+                          remote.buffer_size(), start)
+    size -= start
+
+    with contextlib2.ExitStack() as stack:
+        sessions = [
+            stack.enter_context(remote.file_session())
+            for _ in xrange(_num_workers(size))
+        ]
+
+        log.debug('{}: {} bytes using {} workers'.format(desc, size,
+                                                         len(sessions)))
+        elapsed = xfer.run(sessions, open_src, open_dst, on_progress)
+
+    remote.link.record_transfer(size, elapsed)
+    log.info('{}: {}'.format(desc, _format_rate(size, elapsed)))
+    return elapsed
+
+
+def upload_ranges(local_path, remote_path, size, start=0, on_progress=None):
+    """Uploads ``local_path`` to ``remote_path`` in parallel ranges.
+
+    If ``start`` is given, ``remote_path`` must already exist and have the
+    correct size; only data after ``start`` is sent."""
+    if not start:
+        # create the file at full size, so that workers can write anywhere
+        with remote.file(remote_path, 'wb') as dst:
+            dst.truncate(size)
+
+    return _ranged(size,
+                   lambda session: open(local_path, 'rb'),
+                   lambda session: session.file(remote_path, 'r+b'),
+                   'Upload {} -> {}'.format(local_path, remote_path), start,
+                   on_progress)
+
+
+def download_ranges(remote_path, local_path, size):
+    """Downloads ``remote_path`` to ``local_path`` in parallel ranges."""
+    with open(local_path, 'wb') as dst:
+        dst.truncate(size)
+
+    return _ranged(size,
+                   lambda session: session.file(remote_path, 'rb'),
+                   lambda session: open(local_path, 'r+b'),
+                   'Download {} -> {}'.format(remote_path, local_path))
+
+
+def prefetch(rf, size=None):
+    """Enables read-ahead on remote files that support it.
+
+    The number of concurrent read requests can be limited through the
+    ``fs_prefetch_requests`` setting. If set to ``auto``, it is derived from
+    the bandwidth-delay product of the link, once known."""
+    if not hasattr(rf, 'prefetch'):
+        return
+
+    kwargs = {}
+    if size is not None:
+        kwargs['file_size'] = size
+
+    requests = config.snapshot().fs_prefetch_requests
+    if requests == 'auto':
+        requests = remote.link.window_requests(rf.MAX_REQUEST_SIZE)
+        log.debug('Prefetching with {} concurrent requests'.format(
+            requests or 'unlimited'))
+    if requests:
+        kwargs['max_concurrent_requests'] = requests
+
+    try:
+        rf.prefetch(**kwargs)
+    except TypeError:
+        # older paramiko versions do not support all arguments
+        log.debug('Prefetch options {} not supported'.format(kwargs))
+        rf.prefetch()
+
+
+def download(session, remote_path, local_path, st):
+    """Downloads ``remote_path`` to ``local_path``.
+
+    Data is streamed into a temporary file next to ``local_path``, which is
+    renamed once complete. Large files are downloaded in parallel ranges.
+
+    :param session: A file session or remote used to open the remote file.
+    :param st: Stat result of the remote file.
+    """
+    head, tail = os.path.split(local_path)
+    fd, tmp_path = tempfile.mkstemp(dir=head or '.',
+                                    prefix='.{}.remand-'.format(tail))
+    os.close(fd)
+
+    try:
+        if use_ranged_transfer(st.st_size):
+            download_ranges(remote_path, tmp_path, st.st_size)
+        else:
+            start = time.time()
+            with closing(session.file(remote_path, 'rb')) as src,\
+                    open(tmp_path, 'wb') as dst:
+                prefetch(src, st.st_size)
+                copyfileobj(src, dst, remote.buffer_size())
+            elapsed = time.time() - start
+            remote.link.record_transfer(st.st_size, elapsed)
+            log.debug('Download {} -> {}: {}'.format(
+                remote_path, local_path, _format_rate(st.st_size, elapsed)))
+
+        os.chmod(tmp_path, st.st_mode & 0o777)
+        if config.snapshot().fs_update_mtime:
+            os.utime(tmp_path, (st.st_atime, st.st_mtime))
+        os.rename(tmp_path, local_path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def download_many(items):
+    """Downloads several files concurrently, using up to
+    ``fs_transfer_workers`` workers with a file session each.
+
+    Files large enough for a ranged transfer are downloaded first, one after
+    another, before the workers are started. That way, no more than
+    ``fs_transfer_workers`` sessions are open at any time.
+
+    :param items: A list of ``(remote_path, local_path, st)`` tuples, see
+                  :func:`download`.
+    """
+    pending = Queue()
+    for remote_path, local_path, st in items:
+        if use_ranged_transfer(st.st_size):
+            download(remote, remote_path, local_path, st)
+        else:
+            pending.put((remote_path, local_path, st))
+
+    if pending.empty():
+        return
+
+    errors = []
+
+    def worker(session):
+        while not errors:
+            try:
+                remote_path, local_path, st = pending.get_nowait()
+            except Empty:
+                return
+
+            try:
+                download(session, remote_path, local_path, st)
+            except Exception as e:
+                errors.append(e)
+
+    num_workers = max(1, min(config.snapshot().fs_transfer_workers,
+                             pending.qsize()))
+
+    with contextlib2.ExitStack() as stack:
+        threads = []
+        for _ in xrange(num_workers):
+            session = stack.enter_context(remote.file_session())
+            t = threading.Thread(target=keep_context(worker), args=(session, ))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,248 @@
+"""Merkle digests of directory trees.
+
+A tree is described by a dictionary of entries, mapping paths relative to
+the tree's root (using ``/`` as the separator, the root itself being ``''``)
+to ``(kind, value, mode)`` tuples. ``kind`` is one of ``DIR``, ``FILE`` and
+``LINK``; ``value`` is the SHA1 hexdigest of a file's contents, the target of
+a link and ``None`` for directories. ``mode`` holds the permission bits of
+files and directories and is ``None`` for links.
+
+The digest of an entry covers its mode, the digest of a directory also the
+names and digests of all its children, so two trees with equal root digests
+have the same contents and modes.
+"""
+
+from collections import defaultdict
+import hashlib
+import json
+import os
+import posixpath
+import stat
+
+from remand import remote, config, log, util
+from remand.lib import proc
+
+DIR = 'd'
+FILE = 'f'
+LINK = 'l'
+
+# lists directories, links and the modes of files, then hashes all files below
+# $1, using the hash command passed as $0. links are never followed, links to
+# directories are listed with their targets like any other link
+_LIST_SCRIPT = ('cd "$1" && '
+                'find -P . \\( -type d -printf "d %m %P\\n" \\) '
+                '-o \\( -type l -printf "l %P\\t%l\\n" \\) '
+                '-o \\( -type f -printf "m %m %P\\n" \\) && '
+                'find -P . -type f -exec "$0" {} +')
+
+
+def _mode(fn):
+    return stat.S_IMODE(os.lstat(fn).st_mode)
+
+
+def local_entries(local_path):
+    """Collects the entries of a local tree.
+
+    Only regular files, links and directories are included. Links, including
+    those pointing to directories, are recorded with their targets and not
+    followed, as on the remote side."""
+    entries = {'': (DIR, None, _mode(local_path))}
+
+    for dirpath, dirnames, filenames in os.walk(local_path):
+        rel = os.path.relpath(dirpath, local_path)
+        rel = '' if rel == os.curdir else rel.replace(os.sep, '/')
+
+        for name in dirnames:
+            fn = os.path.join(dirpath, name)
+            if os.path.islink(fn):
+                entries[posixpath.join(rel, name)] = (LINK, os.readlink(fn),
+                                                      None)
+            else:
+                entries[posixpath.join(rel, name)] = (DIR, None, _mode(fn))
+
+        for name in filenames:
+            fn = os.path.join(dirpath, name)
+            if os.path.islink(fn):
+                entries[posixpath.join(rel, name)] = (LINK, os.readlink(fn),
+                                                      None)
+            else:
+                with open(fn, 'rb') as f:
+                    digest = util.hash_file(f).hexdigest()
+                entries[posixpath.join(rel, name)] = (FILE, digest, _mode(fn))
+
+    return entries
+
+
+def remote_entries(remote_path):
+    """Collects the entries of a remote tree using a single command.
+
+    Files are hashed on the remote side. If ``remote_path`` does not exist,
+    an empty dictionary is returned."""
+    if not remote.lstat(remote_path):
+        return {}
+
+    stdout, _, _ = proc.run(
+        ['sh', '-c', _LIST_SCRIPT, config['cmd_sha1sum'], remote_path])
+
+    entries = {}
+    modes = {}
+    for line in stdout.splitlines():
+        if line.startswith('d '):
+            _, mode, path = line.split(' ', 2)
+            entries[path] = (DIR, None, int(mode, 8))
+        elif line.startswith('l '):
+            path, target = line[2:].split('\t', 1)
+            entries[path] = (LINK, target, None)
+        elif line.startswith('m '):
+            _, mode, path = line.split(' ', 2)
+            modes[path] = int(mode, 8)
+        elif line.startswith('\\'):
+            # sha1sum escapes unusual filenames, these are left out and
+            # treated as missing
+            log.debug('Skipping escaped filename in listing: {}'.format(line))
+        else:
+            digest, path = line.split('  ', 1)
+            if path.startswith('./'):
+                path = path[2:]
+            entries[path] = (FILE, digest, modes.get(path))
+
+    return entries
+
+
+def digests(entries):
+    """Computes the Merkle digest of every entry.
+
+    :return: A dictionary mapping paths to hexdigests.
+    """
+    children = defaultdict(list)
+    for path in entries:
+        if path:
+            children[posixpath.dirname(path)].append(path)
+
+    rv = {}
+
+    # process deepest paths first, so children are always done before their
+    # parents
+    for path in sorted(entries, key=lambda p: p.count('/') + bool(p),
+                       reverse=True):
+        kind, value, mode = entries[path]
+        m = hashlib.sha1('{}\0{}\0'.format(
+            kind, '' if mode is None else '{:o}'.format(mode)))
+
+        if kind == DIR:
+            for child in sorted(children[path]):
+                m.update(posixpath.basename(child) + '\0' + rv[child] + '\n')
+        else:
+            m.update(value)
+
+        rv[path] = m.hexdigest()
+
+    return rv
+
+
+def diff(local, remote_):
+    """Finds local entries that differ from their remote counterparts.
+
+    Subtrees whose digests match are skipped entirely. Directories are only
+    included if they are missing on the remote or their mode differs.
+
+    :param local: Entries of the local tree.
+    :param remote_: Entries of the remote tree.
+    :return: A sorted list of paths, parents come before their children.
+    """
+    local_digests = digests(local)
+    remote_digests = digests(remote_) if remote_ else {}
+
+    children = defaultdict(list)
+    for path in local:
+        if path:
+            children[posixpath.dirname(path)].append(path)
+
+    todo = []
+    stack = ['']
+    while stack:
+        path = stack.pop()
+
+        if remote_digests.get(path) == local_digests[path]:
+            continue
+
+        kind, _, mode = local[path]
+        if kind == DIR:
+            rkind, _, rmode = remote_.get(path, (None, None, None))
+            if rkind != DIR or rmode != mode:
+                todo.append(path)
+            stack.extend(children[path])
+        else:
+            todo.append(path)
+
+    return sorted(todo)
+
+
+def _encode(value):
+    # json returns unicode strings, entries use utf8-encoded ones
+    return value.encode('utf8') if isinstance(value, unicode) else value
+
+
+def _normalize(remote_path):
+    # the remote cannot resolve paths that do not exist (yet), those are
+    # resolved through their closest existing parent instead
+    if remote.stat(remote_path):
+        return remote.normalize(remote_path)
+
+    head, tail = remote.path.split(remote.path.normpath(remote_path))
+    if not tail:
+        return remote.normalize(remote_path)
+    return remote.path.join(_normalize(head or '.'), tail)
+
+
+def _manifest_path(remote_path):
+    name = hashlib.sha1(_normalize(remote_path)).hexdigest() + '.json'
+    return remote.path.join(config['fs_tree_manifest_dir'], name)
+
+
+def load_manifest(remote_path, path=None):
+    """Loads the stored entries of the tree at ``remote_path``.
+
+    :param path: Location of the manifest. Defaults to a file in
+                 ``fs_tree_manifest_dir``.
+    :return: The entries or ``None``, if there is no valid manifest.
+    """
+    path = path or _manifest_path(remote_path)
+    if not remote.lstat(path):
+        return None
+
+    try:
+        with remote.file(path, 'rb') as f:
+            data = json.loads(f.read())
+        return {
+            _encode(k): (_encode(kind), _encode(value), mode)
+            for k, (kind, value, mode) in data['entries'].items()
+        }
+    except (ValueError, KeyError, TypeError):
+        log.warning('Ignoring corrupt tree manifest {}'.format(path))
+        return None
+
+
+def save_manifest(remote_path, entries, path=None):
+    """Stores ``entries`` as the manifest of the tree at ``remote_path``.
+
+    :param path: See :func:`load_manifest`.
+    """
+    from . import create_dir
+
+    if path is None:
+        create_dir(config['fs_tree_manifest_dir'], mode=0o700)
+        path = _manifest_path(remote_path)
+
+    with remote.file(path, 'wb') as f:
+        f.write(json.dumps({'path': remote_path, 'entries': entries}))
+
+
+def remove_manifest(remote_path, path=None):
+    """Removes the manifest of the tree at ``remote_path``, if any.
+
+    :param path: See :func:`load_manifest`.
+    """
+    path = path or _manifest_path(remote_path)
+    if remote.lstat(path):
+        remote.unlink(path)
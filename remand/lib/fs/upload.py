@@ -1,13 +1,198 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+from io import BytesIO
 from shutil import copyfileobj
+import hashlib
+import os
+import subprocess
+import time
+import zlib
 
-from remand import remote
-from remand.exc import ConfigurationError
-from .util import RegistryBase
+from remand import remote, config, log, util
+from remand.exc import ConfigurationError, RemandError
+from remand.lib import memoize, proc
+from . import resume, store, transfer
+from .util import RegistryBase, remote_tmp_name
+
+#: compression levels used on fast, average and slow links
+CODEC_LEVELS = OrderedDict([
+    ('zstd', (1, 3, 12)),
+    ('xz', (0, 3, 6)),
+    ('gzip', (1, 6, 9)),
+])
+
+#: files with these extensions are already compressed and sent as-is
+INCOMPRESSIBLE_EXTS = (
+    '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.lzma', '.Z',
+    '.zip', '.7z', '.rar', '.deb', '.rpm', '.apk', '.jar', '.whl', '.jpg',
+    '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.ogg', '.webm',
+    '.woff', '.woff2', '.pdf', '.squashfs')
+
+# decompresses stdin into a temporary file ($1), then moves it to $2. the
+# decompressor is passed in as $0, mv, chmod, chown and rm as $3 to $6.
+# an existing target's mode and owner are carried over to the temporary
+# file. if that is not possible, the target is overwritten in place instead,
+# keeping its inode and attributes
+_DECOMPRESS_SCRIPT = """
+"$0" -dc > "$1" || { "$6" -f "$1"; exit 1; }
+if [ -e "$2" ] && ! { "$4" --reference="$2" "$1" &&
+                      "$5" --reference="$2" "$1"; } 2>/dev/null; then
+    cat "$1" > "$2"; status=$?; "$6" -f "$1"; exit $status
+fi
+"$3" -f "$1" "$2" || { "$6" -f "$1"; exit 1; }
+"""
+
+_PROBE_SCRIPT = 'for c; do command -v "$c" >/dev/null 2>&1 && echo "$c"; done'
+
+
+@memoize()
+def info_remote_codecs():
+    cmds = OrderedDict((config['cmd_' + codec], codec)
+                       for codec in CODEC_LEVELS if config['cmd_' + codec])
+
+    stdout, _, _ = proc.run(
+        ['sh', '-c', _PROBE_SCRIPT, 'sh'] + list(cmds), status_ok='any')
+
+    return [cmds[line] for line in stdout.splitlines() if line in cmds]
+
+
+@memoize()
+def info_link_throughput():
+    # unknown until the first compressed transfer has been timed, see
+    # ``_record_throughput``
+    return None
+
+
+def _local_codec_available(codec):
+    # gzip is handled in-process by zlib
+    return codec == 'gzip' or find_executable(codec) is not None
+
+
+def select_codec(candidates=None):
+    """Selects the first configured codec available on both ends.
+
+    :param candidates: If given, restrict the selection to these codecs.
+    :return: A codec name or ``None``.
+    """
+    remote_codecs = info_remote_codecs()
+
+    for codec in config['fs_compress_codecs'].split(','):
+        codec = codec.strip()
+        if codec not in CODEC_LEVELS:
+            raise ConfigurationError('Unknown compression codec: {!r}'
+                                     .format(codec))
+        if candidates is not None and codec not in candidates:
+            continue
+        if codec in remote_codecs and _local_codec_available(codec):
+            return codec
+
+
+def select_level(codec):
+    """Picks a compression level for ``codec``, based on the throughput
+    measured during earlier transfers to the same host."""
+    fast, average, best = CODEC_LEVELS[codec]
+    throughput = info_link_throughput()
+
+    if throughput is None:
+        return average
+    settings = config.snapshot()
+    if throughput < settings.fs_compress_slow_link:
+        return best
+    if throughput > settings.fs_compress_fast_link:
+        return fast
+    return average
+
+
+def _record_throughput(nbytes, elapsed):
+    if elapsed > 0:
+        throughput = nbytes / elapsed
+        log.debug('Measured link throughput: {:.0f} bytes/s'.format(
+            throughput))
+        info_link_throughput.update_cache(throughput)
+        remote.link.record_transfer(nbytes, elapsed)
+
+
+class _GzipReader(object):
+    """Compresses a file-like object on the fly, producing gzip output."""
+
+    def __init__(self, src, level, bufsize=None):
+        self.src = src
+        self.bufsize = bufsize or remote.buffer_size()
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                            16 + zlib.MAX_WBITS)
+        self._buf = b''
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            chunk = self.src.read(self.bufsize)
+            if chunk:
+                self._buf += self._compressor.compress(chunk)
+            else:
+                self._buf += self._compressor.flush()
+                self._eof = True
+
+        if size < 0:
+            rv, self._buf = self._buf, b''
+        else:
+            rv, self._buf = self._buf[:size], self._buf[size:]
+        return rv
+
+
+class _CountingReader(object):
+    def __init__(self, src):
+        self.src = src
+        self.count = 0
+
+    def read(self, size=-1):
+        buf = self.src.read(size)
+        self.count += len(buf)
+        return buf
+
+
+@contextmanager
+def compressed_input(codec, level, src):
+    """Compresses ``src`` locally while it is being read.
+
+    Yields a file-like object whose ``read`` method returns compressed data.
+    Once the context is left, the number of bytes read is recorded to adapt
+    compression levels of future transfers.
+    """
+    if codec == 'gzip':
+        stream, p = _GzipReader(src, level), None
+    else:
+        p = subprocess.Popen(
+            [find_executable(codec), '-c', '-{}'.format(level)],
+            stdin=src,
+            stdout=subprocess.PIPE)
+        stream = p.stdout
+
+    counter = _CountingReader(stream)
+    start = time.time()
+    try:
+        yield counter
+    except Exception:
+        if p is not None:
+            p.kill()
+            p.wait()
+        raise
+
+    if p is not None:
+        p.stdout.close()
+        if p.wait() != 0:
+            raise RemandError('Local {} exited with status {}'.format(
+                codec, p.returncode))
+    _record_throughput(counter.count, time.time() - start)
 
 
 class Uploader(RegistryBase):
     registry = {}
 
+    #: set if attributes will be applied to uploaded files, which must then
+    #: not share their inode with any other file
+    exclusive = False
+
     def upload_file(self, local_path, remote_path):
         raise ConfigurationError('{} does not support file uploads.'.format(
             self.__class__.__name__))
@@ -27,10 +212,111 @@ class UploaderWrite(Uploader):
     short_name = 'write'
 
     def upload_file(self, local_path, remote_path):
+        size = os.stat(local_path).st_size
+        if resume.use_resumable_upload(size):
+            resume.upload_resumable(local_path, remote_path)
+            return
+
+        if transfer.use_ranged_transfer(size):
+            transfer.upload_ranges(local_path, remote_path, size)
+            return
+
+        start = time.time()
         with file(local_path, 'rb') as src,\
                 remote.file(remote_path, 'wb') as dst:
-            copyfileobj(src, dst)
+            copyfileobj(src, dst, remote.buffer_size())
+        remote.link.record_transfer(size, time.time() - start)
 
     def upload_buffer(self, buf, remote_path):
         with remote.file(remote_path, 'wb') as dst:
             dst.write(buf)
+
+
+@Uploader._registered
+class UploaderCompress(UploaderWrite):
+    """Compresses data locally and decompresses it on the remote.
+
+    Small and already compressed files are written without compression."""
+    short_name = 'compress'
+
+    def _send(self, codec, level, src, remote_path):
+        tmp_path = remote_tmp_name(remote_path)
+        log.debug('Sending {} ({} level {}) via {}'.format(
+            remote_path, codec, level, tmp_path))
+
+        args = [
+            'sh', '-c', _DECOMPRESS_SCRIPT, config['cmd_' + codec], tmp_path,
+            remote_path, config['cmd_mv'], config['cmd_chmod'],
+            config['cmd_chown'], config['cmd_rm']
+        ]
+        with compressed_input(codec, level, src) as stream:
+            proc.run(args, input=stream)
+
+    def upload_file(self, local_path, remote_path):
+        codec = None
+        if (not local_path.endswith(INCOMPRESSIBLE_EXTS) and
+                os.stat(local_path).st_size >=
+                config.snapshot().fs_compress_min_size):
+            codec = select_codec()
+
+        if codec is None:
+            return super(UploaderCompress, self).upload_file(local_path,
+                                                             remote_path)
+
+        with open(local_path, 'rb') as src:
+            self._send(codec, select_level(codec), src, remote_path)
+
+    def upload_buffer(self, buf, remote_path):
+        # buffers are compressed in-process, which is only possible for gzip
+        codec = None
+        if len(buf) >= config.snapshot().fs_compress_min_size:
+            codec = select_codec(['gzip'])
+
+        if codec is None:
+            return super(UploaderCompress, self).upload_buffer(buf,
+                                                               remote_path)
+
+        self._send(codec, select_level(codec), BytesIO(buf), remote_path)
+
+
+@Uploader._registered
+class UploaderStore(Uploader):
+    """Looks up files in the remote blob store before sending them.
+
+    If a blob with the same digest is found, it is copied or linked into
+    place on the remote. Otherwise the file is sent to a temporary file using
+    the uploader configured as ``fs_store_upload``, added to the store and
+    moved into place. An existing destination may be linked to a blob and is
+    therefore never written to."""
+    short_name = 'store'
+
+    def __init__(self):
+        self.fallback = Uploader._by_short_name(config['fs_store_upload'])()
+
+    def _worth_storing(self, size):
+        return size >= config.snapshot().fs_store_min_size
+
+    def upload_file(self, local_path, remote_path):
+        if not self._worth_storing(os.stat(local_path).st_size):
+            return self.fallback.upload_file(local_path, remote_path)
+
+        with open(local_path, 'rb') as f:
+            digest = util.hash_file(f).hexdigest()
+
+        if not store.place(digest, remote_path, link=not self.exclusive):
+            tmp_path = store.upload_path(remote_path)
+            self.fallback.upload_file(local_path, tmp_path)
+            store.insert(digest, tmp_path)
+            store.replace(tmp_path, remote_path)
+
+    def upload_buffer(self, buf, remote_path):
+        if not self._worth_storing(len(buf)):
+            return self.fallback.upload_buffer(buf, remote_path)
+
+        digest = hashlib.sha1(buf).hexdigest()
+
+        if not store.place(digest, remote_path, link=not self.exclusive):
+            tmp_path = store.upload_path(remote_path)
+            self.fallback.upload_buffer(buf, tmp_path)
+            store.insert(digest, tmp_path)
+            store.replace(tmp_path, remote_path)
@@ -1,4 +1,7 @@
-from remand import log
+from binascii import hexlify
+import os
+
+from remand import log, remote
 from remand.exc import ConfigurationError
 
 
@@ -23,3 +26,11 @@ class RegistryBase(object):
 
     def __str__(self):
         return '{}'.format(self.__class__.__name__)
+
+
+def remote_tmp_name(remote_path, tag='tmp', randbytes=4):
+    """Returns a hidden sibling path of ``remote_path``, suitable for writing
+    a file that is later renamed into place."""
+    head, tail = remote.path.split(remote_path)
+    return remote.path.join(head, '.{}.remand-{}-{}'.format(
+        tail, tag, hexlify(os.urandom(randbytes))))
@@ -1,11 +1,17 @@
 import hashlib
+import json
 import os
 
 from remand import remote, config, log, util
-from remand.exc import ConfigurationError
+from remand.exc import ConfigurationError, RemoteFailureError
 from remand.lib import proc
 
-from .util import RegistryBase
+from .util import RegistryBase, remote_tmp_name
+
+# writes stdin to a temporary file ($1) in the manifest directory ($0), then
+# moves it over the entry ($2)
+_WRITE_ENTRY_SCRIPT = ('mkdir -p "$0" && cat > "$1" && mv -f "$1" "$2" || '
+                       '{ rm -f "$1"; exit 1; }')
 
 
 class Verifier(RegistryBase):
@@ -19,6 +25,13 @@ class Verifier(RegistryBase):
         raise ConfigurationError(
             '{} does not verify buffers.'.format(self.__class__.__name__))
 
+    def record_file(self, local_path, remote_path):
+        """Called after ``local_path`` has been uploaded to ``remote_path``.
+        """
+
+    def record_buffer(self, buf, remote_path):
+        """Called after ``buf`` has been uploaded to ``remote_path``."""
+
 
 @Verifier._registered
 class VerifierIgnore(Verifier):
@@ -41,7 +54,7 @@ class VerifierRead(Verifier):
             if hasattr(rf, 'prefetch'):
                 rf.prefetch()
 
-            bufsize = int(config['buffer_size'])
+            bufsize = remote.buffer_size()
             while True:
                 rbuf = rf.read(bufsize)
                 lbuf = lf.read(bufsize)
@@ -71,11 +84,8 @@ class VerifierSHA(Verifier):
     hashfunc = hashlib.sha1
 
     def _get_remote_hash(self, remote_path):
-        # get remote hash
-        stdout, _, _ = proc.run([config['cmd_sha1sum'], remote_path])
-        remote_hash = stdout.split(None, 1)[0]
-
-        return remote_hash
+        # uses server-side hashing if available, sha1sum otherwise
+        return remote.hash(remote_path, self.hashfunc().name.lower())
 
     def verify_file(self, st, local_path, remote_path):
         # hash local file
@@ -98,6 +108,117 @@ class VerifierSHA(Verifier):
         return remote_hash == m.hexdigest()
 
 
+@Verifier._registered
+class VerifierManifest(VerifierSHA):
+    """Like :class:`VerifierSHA`, but trusts digests recorded in a manifest
+    on the remote while the remote file's stat info still matches.
+
+    Entries are stored in ``fs_manifest_dir``, one file per remote path, and
+    are replaced atomically, so concurrent runs never see partial entries.
+    If entries cannot be written (e.g. because the directory is not writable
+    by the current user), files are hashed every time, like
+    :class:`VerifierSHA` does.
+    """
+    short_name = 'manifest'
+
+    def __init__(self):
+        self._local_hashes = {}
+        self._writable = True
+
+    def _hash_local_file(self, local_path):
+        if local_path not in self._local_hashes:
+            with open(local_path, 'rb') as lfile:
+                self._local_hashes[local_path] = util.hash_file(
+                    lfile, self.hashfunc).hexdigest()
+        return self._local_hashes[local_path]
+
+    def _entry_path(self, remote_path):
+        name = self.hashfunc(remote.normalize(remote_path)).hexdigest()
+        return remote.path.join(config['fs_manifest_dir'], name)
+
+    @staticmethod
+    def _stat_record(st):
+        record = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+
+        # SFTP does not report these, local remotes do
+        for field in ('st_ino', 'st_ctime'):
+            value = getattr(st, field, None)
+            if value is not None:
+                record[field[3:]] = int(value)
+        return record
+
+    def _read_entry(self, remote_path):
+        entry_path = self._entry_path(remote_path)
+        try:
+            with remote.file(entry_path, 'rb') as f:
+                data = f.read()
+        except RemoteFailureError:
+            # missing or unreadable entries are cache misses
+            return None
+
+        try:
+            return json.loads(data)
+        except ValueError:
+            log.warning('Ignoring corrupt manifest entry for {}'.format(
+                remote_path))
+
+    def _write_entry(self, remote_path, digest, st=None):
+        if not self._writable:
+            return
+
+        st = st or remote.stat(remote_path)
+        entry = {
+            'path': remote_path,
+            'stat': self._stat_record(st),
+            'digest': digest,
+        }
+
+        entry_path = self._entry_path(remote_path)
+        try:
+            proc.run([
+                'sh', '-c', _WRITE_ENTRY_SCRIPT, config['fs_manifest_dir'],
+                remote_tmp_name(entry_path), entry_path
+            ], input=json.dumps(entry))
+        except RemoteFailureError as e:
+            log.warning('Cannot write manifest entries to {}, files will be '
+                        'hashed every time: {}'.format(
+                            config['fs_manifest_dir'], e))
+            self._writable = False
+
+    def _manifest_hash(self, remote_path, st):
+        entry = self._read_entry(remote_path)
+
+        if entry and entry.get('stat') == self._stat_record(st):
+            log.debug('Using manifest digest for {}'.format(remote_path))
+            return entry['digest']
+
+        remote_hash = self._get_remote_hash(remote_path)
+        self._write_entry(remote_path, remote_hash, st)
+        return remote_hash
+
+    def verify_file(self, st, local_path, remote_path):
+        local_hash = self._hash_local_file(local_path)
+        remote_hash = self._manifest_hash(remote_path, st)
+        log.debug('Local hash: {} Remote hash: {}'.format(local_hash,
+                                                           remote_hash))
+
+        return remote_hash == local_hash
+
+    def verify_buffer(self, st, buf, remote_path):
+        local_hash = self.hashfunc(buf).hexdigest()
+        remote_hash = self._manifest_hash(remote_path, st)
+        log.debug('Local hash: {} Remote hash: {}'.format(local_hash,
+                                                           remote_hash))
+
+        return remote_hash == local_hash
+
+    def record_file(self, local_path, remote_path):
+        self._write_entry(remote_path, self._hash_local_file(local_path))
+
+    def record_buffer(self, buf, remote_path):
+        self._write_entry(remote_path, self.hashfunc(buf).hexdigest())
+
+
 @Verifier._registered
 class VerifierStat(Verifier):
     short_name = 'stat'
@@ -105,7 +226,7 @@ class VerifierStat(Verifier):
     def verify_file(self, st, local_path, remote_path):
         lst = os.stat(local_path)
 
-        mul = int(config['fs_mtime_multiplier'])
+        mul = config.snapshot().fs_mtime_multiplier
 
         # we cast to int, to avoid into issues with different mtime resolutions
         l = (int(lst.st_mtime * mul), lst.st_size)
@@ -1,4 +1,5 @@
 from collections import namedtuple, OrderedDict
+from contextlib import closing
 from crypt import crypt
 import hashlib
 import os
@@ -32,6 +33,9 @@ _USERDEL_STATUS_CODES = {
     12: 'can\'t remove home directory',
 }
 
+# changes on every boot of a linux kernel
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
 PasswdEntry = namedtuple('PasswdEntry', 'name,passwd,uid,gid,gecos,home,shell')
 GroupEntry = namedtuple('GroupEntry', 'name,passwd,gid,user_list')
 
@@ -60,6 +64,25 @@ def info_groups():
     return groups
 
 
+def read_boot_id(transport):
+    """Reads the current boot id through ``transport``.
+
+    :return: The boot id or ``None``, if the remote does not provide one.
+    """
+    try:
+        f = transport.file(BOOT_ID_PATH, 'r')
+    except RemoteFailureError:
+        return None
+
+    with closing(f):
+        return f.read().strip()
+
+
+@memoize()
+def info_boot_id():
+    return read_boot_id(remote)
+
+
 @memoize()
 def info_system():
     FLAG_LIST = {
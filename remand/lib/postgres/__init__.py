@@ -4,6 +4,7 @@
 
 from contextlib import contextmanager, closing
 import os
+import re
 import warnings
 
 from contextlib2 import ExitStack
@@ -14,7 +15,7 @@ from sqlalchemy.orm import sessionmaker
 import sqlalchemy_pgcatalog as sc
 import volatile
 
-from remand import operation, Changed, Unchanged
+from remand import operation, Changed, Unchanged, remote
 from .. import proc
 from ... import net
 
@@ -43,12 +44,18 @@ class PostgreSQL(object):
         operations to `postgres`; for this reason it is important to not
         perform any other operation while inside this contextmanager.
 
-        Furthermore, establishing a connection requires that OpenBSD-style
-        netcat is installed on the target system. Be aware that most
-        debian-systems install a "traditional" netcat by default (package
-        `netcat-traditional` instead of `netcat-openbsd`). Using traditional
-        netcat will result in errors proclaiming unexpected closing of the
-        socket.
+        If ``ident`` is set, the server is connected to as that user through
+        sudo. The unix socket is then always forwarded through netcat (see
+        :meth:`~remand.remotes.ssh.SSHRemote.unix_connect`), which requires
+        that OpenBSD-style netcat is installed on the target system. With an
+        empty ``ident``, the socket is opened as the login user, through a
+        native channel where the server supports it, and the login user must
+        be allowed to connect to the server.
+
+        Be aware that most debian-systems install a "traditional" netcat by
+        default (package `netcat-traditional` instead of `netcat-openbsd`).
+        Using traditional netcat will result in errors proclaiming unexpected
+        closing of the socket.
         """
         with ExitStack() as stack:
             dtmp = stack.enter_context(volatile.dir())
@@ -66,6 +73,10 @@ class PostgreSQL(object):
                 query={'host': dtmp})
 
             engine = create_engine(url, echo=self.echo)
+
+            # pooled connections go through the forward and must be closed
+            # before it is torn down
+            stack.callback(engine.dispose)
             yield Manager(engine)
 
 
@@ -75,14 +86,108 @@ def pg_valid(s):
     return s
 
 
+_NAME = r'[A-Za-z_][A-Za-z0-9_]*'
+_IDENTIFIER_RE = re.compile(r'^{0}(\.{0})?$'.format(_NAME))
+
+
+def pg_identifier(s):
+    # table or column names, optionally qualified by a schema
+    if not _IDENTIFIER_RE.match(s):
+        raise ValueError('Invalid identifier (postgres): {!r}'.format(s))
+    return s
+
+
+_COPY_FORMATS = ('text', 'csv', 'binary')
+
+
+def _copy_options(format, header):
+    if format not in _COPY_FORMATS:
+        raise ValueError('Invalid COPY format: {!r}'.format(format))
+    opts = ['FORMAT ' + format]
+    if header:
+        opts.append('HEADER true')
+    return '({})'.format(', '.join(opts))
+
+
+class _ProgressFile(object):
+    # passes reads and writes on to ``f``, reporting the number of bytes
+    # transferred so far after each of them
+
+    def __init__(self, f, on_progress):
+        self.f = f
+        self.on_progress = on_progress
+        self.nbytes = 0
+
+    def _advance(self, n):
+        self.nbytes += n
+        if self.on_progress:
+            self.on_progress(self.nbytes)
+
+    def read(self, size=-1):
+        buf = self.f.read(size)
+        self._advance(len(buf))
+        return buf
+
+    def readline(self, size=-1):
+        buf = self.f.readline(size)
+        self._advance(len(buf))
+        return buf
+
+    def write(self, buf):
+        self.f.write(buf)
+        self._advance(len(buf))
+
+
 class Manager(object):
+    """Manages databases and roles through ``engine``.
+
+    The names of existing databases and roles are queried once and kept up
+    to date by the manager's own operations. Changes made by other means are
+    only picked up after calling :meth:`refresh`.
+    """
+
     def __init__(self, engine):
         self.engine = engine
         self.sessionmaker = sessionmaker(bind=engine)
+        self._catalog_prepared = False
+        self._databases = None
+        self._roles = None
 
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=sa_exc.SAWarning)
-            sc.prepare(self.engine)
+    @property
+    def catalog(self):
+        """The :mod:`sqlalchemy_pgcatalog` module, prepared for use with
+        sessions of this manager.
+
+        Reflecting the catalog is expensive and only done on first access.
+        """
+        if not self._catalog_prepared:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=sa_exc.SAWarning)
+                sc.prepare(self.engine)
+            self._catalog_prepared = True
+        return sc
+
+    @property
+    def databases(self):
+        """Names of all databases."""
+        if self._databases is None:
+            qry = 'SELECT datname FROM pg_database'
+            self._databases = {row[0] for row in self.engine.execute(qry)}
+        return self._databases
+
+    @property
+    def roles(self):
+        """Names of all roles."""
+        if self._roles is None:
+            qry = 'SELECT rolname FROM pg_roles'
+            self._roles = {row[0] for row in self.engine.execute(qry)}
+        return self._roles
+
+    def refresh(self):
+        """Discards the known databases and roles, they are queried again on
+        next use."""
+        self._databases = None
+        self._roles = None
 
     @contextmanager
     def session(self, *args, **kwargs):
@@ -91,51 +196,63 @@ class Manager(object):
             if session.is_active:
                 session.commit()
 
+    @contextmanager
+    def _autocommit(self):
+        # databases cannot be created or dropped inside a transaction. the
+        # driver would open a new one for every statement otherwise
+        with closing(self.engine.connect()) as con:
+            yield con.execution_options(isolation_level='AUTOCOMMIT')
+
     @operation()
     def create_database(self, name, owner):
         assert name.isalnum()
         assert owner.isalnum()
 
-        # check if database exists
-        qry = 'SELECT datname FROM pg_database'
-        dbs = [row[0] for row in self.engine.execute(qry)]
-
-        if name in dbs:
+        if name in self.databases:
             return Unchanged('Database {} already exists'.format(name))
 
-        sql = text(' '.join([
-            'CREATE DATABASE ' + pg_valid(name), 'WITH OWNER ' +
-            pg_valid(owner)
-        ]))
+        with self._autocommit() as con:
+            con.execute(_create_database_sql(name, owner))
+        self.databases.add(name)
 
-        # runs outside transaction
-        with self.session(autocommit=True) as sess:
-            con = sess.connection()
+        return Changed(msg='Created database {}'.format(name))
 
-            con.execute('COMMIT')
-            con.execute(sql)
+    @operation()
+    def ensure_databases(self, databases):
+        """Creates all missing databases.
 
-        return Changed(msg='Created database {}'.format(name))
+        All databases are created through a single connection. Databases
+        cannot be created inside a transaction, so those created before a
+        failure are kept.
+
+        :param databases: A dictionary mapping database names to their owners.
+        """
+        missing = sorted(name for name in databases
+                         if name not in self.databases)
+
+        if not missing:
+            return Unchanged('All {} databases exist'.format(len(databases)))
+
+        with self._autocommit() as con:
+            for name in missing:
+                con.execute(_create_database_sql(name, databases[name]))
+                self.databases.add(name)
+
+        return Changed(msg='Created databases {}'.format(', '.join(missing)))
 
     @operation()
     def drop_database(self, name):
         assert name.isalnum()
 
-        # check if database exists
-        qry = 'SELECT datname FROM pg_database'
-        dbs = [row[0] for row in self.engine.execute(qry)]
-
-        if name not in dbs:
+        if name not in self.databases:
             return Unchanged(
                 'Database {} already dropped/nonexistant'.format(name))
 
         sql = text('DROP DATABASE ' + pg_valid(name))
 
-        with self.session(autocommit=True) as sess:
-            con = sess.connection()
-
-            con.execute('COMMIT')
+        with self._autocommit() as con:
             con.execute(sql)
+        self.databases.discard(name)
 
         return Changed(msg='Dropped database {}'.format(name))
 
@@ -150,23 +267,151 @@ class Manager(object):
                     login=True,
                     connection_limit=-1):
         # FIXME: should update role if required
+        if name in self.roles:
+            return Unchanged(msg='Role {} already exists'.format(name))
+
         with self.session() as sess:
-            for role in sess.query(sc.Role):
-                if role.rolname == name:
-                    return Unchanged(msg='Role {} already exists'.format(name))
-
-            sql = text(' '.join([
-                'CREATE ROLE ' + pg_valid(name),
-                'SUPERUSER' if superuser else 'NOSUPERUSER',
-                'CREATEDB' if createdb else 'NOCREATEDB',
-                'CREATEROLE' if createrole else 'NOCREATEROLE',
-                'INHERIT' if inherit else 'NOINHERIT',
-                'LOGIN' if login else 'NOLOGIN',
-                'CONNECTION LIMIT :connection_limit',
-                'PASSWORD :pw' if password is not None else '',
-            ]))
-
-            sess.connection().execute(
-                sql, name=name, connection_limit=connection_limit, pw=password)
+            sess.connection().execute(*_create_role_sql(
+                name, password, superuser, createdb, createrole, inherit,
+                login, connection_limit))
+        self.roles.add(name)
 
         return Changed(msg='Created role {}'.format(name))
+
+    @operation()
+    def ensure_roles(self, roles):
+        """Creates all missing roles in a single transaction.
+
+        Existing roles are not updated.
+
+        :param roles: A dictionary mapping role names to dictionaries of
+                      keyword arguments for :meth:`create_role` (or
+                      ``None`` for its defaults).
+        """
+        missing = sorted(name for name in roles if name not in self.roles)
+
+        if not missing:
+            return Unchanged('All {} roles exist'.format(len(roles)))
+
+        with self.session() as sess:
+            con = sess.connection()
+            for name in missing:
+                con.execute(*_create_role_sql(name, **(roles[name] or {})))
+
+        self.roles.update(missing)
+        return Changed(msg='Created roles {}'.format(', '.join(missing)))
+
+    def _copy(self, sql, fileobj, on_progress):
+        # runs a COPY statement through psycopg2, which reads or writes the
+        # data in chunks of the given size. returns the number of bytes and
+        # rows copied
+        f = _ProgressFile(fileobj, on_progress)
+
+        con = self.engine.raw_connection()
+        try:
+            cursor = con.cursor()
+            cursor.copy_expert(sql, f, size=remote.buffer_size())
+            rows = cursor.rowcount
+            con.commit()
+        finally:
+            con.close()
+
+        return f.nbytes, rows
+
+    @operation()
+    def copy_in(self,
+                table,
+                fileobj,
+                columns=None,
+                format='csv',
+                header=False,
+                on_progress=None):
+        """Loads data into a table using ``COPY ... FROM STDIN``.
+
+        The data is streamed through the connection, only a single buffer is
+        held in memory at any time.
+
+        :param table: Table to load into, optionally qualified by a schema.
+        :param fileobj: File-like object to read the data from.
+        :param columns: Names of the columns present in the data. If
+                        ``None``, all columns of ``table`` in order.
+        :param format: One of ``'text'``, ``'csv'`` or ``'binary'``.
+        :param header: Whether the first line is a header to skip (``csv``
+                       only).
+        :param on_progress: Called with the number of bytes sent so far after
+                            every chunk.
+        :return: The number of bytes sent.
+        """
+        target = pg_identifier(table)
+        if columns is not None:
+            target += ' ({})'.format(', '.join(
+                pg_identifier(c) for c in columns))
+
+        sql = 'COPY {} FROM STDIN WITH {}'.format(
+            target, _copy_options(format, header))
+        nbytes, rows = self._copy(sql, fileobj, on_progress)
+
+        return Changed(
+            value=nbytes,
+            msg='Copied {} rows ({} bytes) into {}'.format(rows, nbytes,
+                                                          table))
+
+    @operation()
+    def copy_out(self,
+                 query,
+                 fileobj,
+                 format='csv',
+                 header=False,
+                 on_progress=None):
+        """Dumps the results of a query using ``COPY ... TO STDOUT``.
+
+        The data is streamed through the connection, only a single buffer is
+        held in memory at any time.
+
+        :param query: A ``SELECT`` statement or the name of a table to dump.
+        :param fileobj: File-like object to write the data to.
+        :param format: One of ``'text'``, ``'csv'`` or ``'binary'``.
+        :param header: Whether to write a header line (``csv`` only).
+        :param on_progress: Called with the number of bytes received so far
+                            after every chunk.
+        :return: The number of bytes received.
+        """
+        source = (query if _IDENTIFIER_RE.match(query) else
+                  '({})'.format(query))
+
+        sql = 'COPY {} TO STDOUT WITH {}'.format(
+            source, _copy_options(format, header))
+        nbytes, rows = self._copy(sql, fileobj, on_progress)
+
+        return Unchanged(
+            value=nbytes,
+            msg='Copied {} rows ({} bytes) out of the database'.format(
+                rows, nbytes))
+
+
+def _create_database_sql(name, owner):
+    return text(' '.join([
+        'CREATE DATABASE ' + pg_valid(name), 'WITH OWNER ' + pg_valid(owner)
+    ]))
+
+
+def _create_role_sql(name,
+                     password=None,
+                     superuser=False,
+                     createdb=False,
+                     createrole=False,
+                     inherit=True,
+                     login=True,
+                     connection_limit=-1):
+    # returns the statement and its parameters
+    sql = text(' '.join([
+        'CREATE ROLE ' + pg_valid(name),
+        'SUPERUSER' if superuser else 'NOSUPERUSER',
+        'CREATEDB' if createdb else 'NOCREATEDB',
+        'CREATEROLE' if createrole else 'NOCREATEROLE',
+        'INHERIT' if inherit else 'NOINHERIT',
+        'LOGIN' if login else 'NOLOGIN',
+        'CONNECTION LIMIT :connection_limit',
+        'PASSWORD :pw' if password is not None else '',
+    ]))
+    return sql, {'connection_limit': connection_limit, 'pw': password}
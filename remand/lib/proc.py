@@ -7,7 +7,7 @@ from time import time
 
 from remand import remote, log, config, util
 from remand.exc import RemoteFailureError
-from remand.remotes.ssh import SSHRemote
+from remand.remotes.sftp import SFTPRemote
 
 
 class RemoteProcessFailedError(RemoteFailureError):
@@ -74,7 +74,7 @@ def run(cmd,
 
 @contextmanager
 def sudo(user=None, password=None, timestamp_timeout=2 * 60):
-    if not isinstance(remote._get_current_object(), SSHRemote):
+    if not isinstance(remote._get_current_object(), SFTPRemote):
         raise NotImplementedError('sudo is only supported for SSH remotes.')
 
     # --preserve-env, --set-home and --non-interactive
@@ -144,14 +144,21 @@ def sudo(user=None, password=None, timestamp_timeout=2 * 60):
     sftp_cmd = ' '.join([shlex_quote(part)
                          for part in sudo_args] + [config['sftp_location']])
 
-    # override sftp subsystem
+    # override sftp subsystem. the remote keeps the previous client open, so
+    # leaving the context switches back to it without reconnecting
     prev_sftp_command = config['sftp_command']
     config['sftp_command'] = sftp_cmd
+    remote.set_sftp_invocation(sftp_cmd)
+
+    prev_sudo_user = remote.sudo_user
+    remote.sudo_user = user or 'root'
 
     try:
         yield
     finally:
+        remote.sudo_user = prev_sudo_user
         remote.popen = orig_popen
         config['sftp_command'] = prev_sftp_command
+        remote.set_sftp_invocation(prev_sftp_command)
 
     # FIXME: remove sudo credentials
@@ -60,11 +60,12 @@ def set_authorized_keys(files, user='root', fix_permissions=True):
         kf.add_from_file(fn)
 
     # directory is guaranteed to exist now, with correct permissions
-    upload = fs.upload_string(str(kf), ak_file)
-
-    if upload.changed and fix_permissions:
-        fs.chmod(ak_file, AK_FILE_PERMS)
-        fs.chown(ak_file, uid=user)
+    attrs = {}
+    if fix_permissions:
+        # owned by the user and their login group
+        attrs = dict(mode=AK_FILE_PERMS, owner=user,
+                     group=info['posix.users'][user].gid)
+    upload = fs.upload_string(str(kf), ak_file, **attrs)
 
     fps = ', '.join(k.readable_fingerprint for k in kf.keys)
 
@@ -86,17 +87,18 @@ def init_authorized_keys(user='root', fix_permissions=True):
     # ensure the directory exists
     changed |= fs.create_dir(ak_dir, mode=AK_DIR_PERMS).changed
 
+    login_gid = info['posix.users'][user].gid
     if fix_permissions:
-        changed |= fs.chmod(ak_dir, AK_DIR_PERMS).changed
-        changed |= fs.chown(ak_dir, uid=user).changed
+        changed |= fs.set_attrs(
+            ak_dir, mode=AK_DIR_PERMS, uid=user, gid=login_gid).changed
 
     # check if the authorized keys file exists
     if not remote.lstat(ak_file):
         changed |= fs.touch(ak_file).changed
 
     if fix_permissions:
-        changed |= fs.chmod(ak_file, AK_FILE_PERMS).changed
-        changed |= fs.chown(ak_dir, uid=user).changed
+        changed |= fs.set_attrs(
+            ak_file, mode=AK_FILE_PERMS, uid=user, gid=login_gid).changed
 
     # at this point, we have fixed permissions for file and dir, as well as
     # ensured they exist. however, they might still be owned by root
@@ -188,8 +190,8 @@ def install_private_key(key_file,
     changed |= fs.create_dir(
         remote.path.dirname(target_path), mode=AK_DIR_PERMS).changed
 
-    changed |= fs.upload_file(key_file, target_path).changed
-    changed |= fs.chmod(target_path, mode=KEY_FILE_PERMS).changed
+    changed |= fs.upload_file(
+        key_file, target_path, mode=KEY_FILE_PERMS).changed
 
     if changed:
         return Changed(msg='Installed private key {}'.format(target_path))
@@ -2,14 +2,14 @@ from __future__ import absolute_import
 
 from contextlib import contextmanager
 import os
-import SocketServer
-import select
+import socket
 import threading
 
 import contextlib2
 import volatile
 
 from .. import remote, log, keep_context
+from .forward import Forwarder
 
 
 @contextmanager
@@ -37,67 +37,58 @@ def remote_socket():
 
 @contextmanager
 def local_forward(remote_addr, local_addr=('127.0.0.1', 0)):
-    class Handler(SocketServer.BaseRequestHandler):
-        @keep_context
-        def handle(self):
-            log.debug('New connection to {} from {}'.format(
-                remote_addr, self.request.getpeername()))
-
-            if isinstance(remote_addr, tuple):
-                # remote is a tcp address
-                chan = my_remote.tcp_connect(remote_addr)
-            else:
-                # remote is a unix socket
-                chan = my_remote.unix_connect(remote_addr)
-
-            while True:
-                r, _, _ = select.select([self.request, chan], [], [])
-
-                if self.request in r:
-                    buf = self.request.recv(4096)
-                    if len(buf) == 0:
-                        # client closed connection, we're done
-                        break
-                    chan.send(buf)
-
-                if chan in r:
-                    buf = chan.recv(4096)
-                    if len(buf) == 0:
-                        # server closed connection
-                        break
-                    self.request.send(buf)
-
-            log.debug('Closed connection to {} from {}'.format(
-                remote_addr, self.request.getpeername()))
+    """Forwards connections to ``local_addr`` to ``remote_addr`` on the
+    remote.
+
+    All connections are handled by a single :class:`~.forward.Forwarder`
+    thread.
+
+    :param remote_addr: A ``(host, port)`` tuple or the path of a unix socket
+                        on the remote.
+    :param local_addr: A ``(host, port)`` tuple or the path of a unix socket.
+                       If empty, a unix socket in a temporary directory is
+                       used.
+    :return: The address the forward is listening on.
+    """
+    my_remote = remote._get_current_object()
+
+    # called from a fresh thread for every connection
+    @keep_context
+    def connect():
+        if isinstance(remote_addr, tuple):
+            # remote is a tcp address
+            return my_remote.tcp_connect(remote_addr)
+        # remote is a unix socket
+        return my_remote.unix_connect(remote_addr)
 
     with contextlib2.ExitStack() as stack:
         if isinstance(local_addr, tuple):
-            server = SocketServer.ThreadingTCPServer(local_addr, Handler)
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         else:
             # assume its a string, denoting a unix domain socket
             if not local_addr:
                 dtmp = stack.enter_context(volatile.dir())
                 local_addr = os.path.join(dtmp, 'remote.sock')
-            server = SocketServer.ThreadingUnixStreamServer(
-                local_addr, Handler)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stack.callback(listener.close)
 
-        server.allow_reuse_address = False
-        server.daemon_threads = True
+        listener.bind(local_addr)
+        listener.listen(128)
 
-        my_remote = remote._get_current_object()
+        forwarder = Forwarder(listener, connect, remote.buffer_size())
 
-        t = threading.Thread(target=keep_context(server.serve_forever))
+        t = threading.Thread(target=keep_context(forwarder.serve))
         t.daemon = True
         t.start()
 
-        # wait for the server to shutdown
+        # wait for the forwarder to shutdown
         stack.callback(t.join)
-        stack.callback(server.shutdown)
+        stack.callback(forwarder.stop)
         stack.callback(
             log.debug,
-            'Waiting for shutdown of {}'.format(server.server_address))
+            'Waiting for shutdown of {}'.format(listener.getsockname()))
 
         log.debug('Forward established: {} => {}'.format(
-            server.server_address, remote_addr))
+            listener.getsockname(), remote_addr))
 
-        yield server.server_address
+        yield listener.getsockname()
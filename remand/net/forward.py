@@ -0,0 +1,291 @@
+"""Single-threaded forwarding of local connections to a remote.
+
+A :class:`Forwarder` accepts connections on a listening socket and relays
+data between each of them and a connection opened to the remote, all from a
+single event loop. Every direction of a connection buffers at most a fixed
+amount of data; a side is not read from while the buffer towards the other
+side is full. When one side closes its sending direction, the other side's
+sending direction is shut down once all buffered data has been delivered,
+while the opposite direction keeps flowing.
+"""
+
+from __future__ import absolute_import
+
+from Queue import Queue, Empty
+import errno
+import select
+import socket
+import threading
+
+from .. import log
+
+# errors indicating that the peer went away
+_DISCONNECT_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN,
+                      errno.ECONNABORTED)
+
+
+def _is_channel(conn):
+    # paramiko channels are not sockets and need special treatment
+    return hasattr(conn, 'send_ready')
+
+
+def _wait_send_ready(chan):
+    # channels only signal readability through their file descriptor. paramiko
+    # notifies ``out_buffer_cv`` when the peer enlarges the send window or the
+    # channel is closed, its lock is the one guarding the conditions checked
+    # by ``send_ready``
+    with chan.out_buffer_cv:
+        while not (chan.closed or chan.eof_sent or chan.out_window_size > 0):
+            chan.out_buffer_cv.wait()
+
+
+def _shutdown_write(conn):
+    if _is_channel(conn):
+        conn.shutdown_write()
+    else:
+        conn.shutdown(socket.SHUT_WR)
+
+
+class _Pipe(object):
+    """One direction of a forwarded connection."""
+
+    def __init__(self, src, dst, bufsize, limit):
+        self.src = src
+        self.dst = dst
+        self.bufsize = bufsize
+        self.limit = limit
+        self.buf = b''
+        self.eof = False
+        self.done = False
+
+    @property
+    def wants_read(self):
+        return not self.eof and len(self.buf) < self.limit
+
+    @property
+    def wants_write(self):
+        return bool(self.buf)
+
+    def read(self):
+        try:
+            data = self.src.recv(self.bufsize)
+        except socket.timeout:
+            # non-blocking channel without data
+            return
+
+        if data:
+            self.buf += data
+        else:
+            self.eof = True
+            self._check_done()
+
+    def write(self):
+        if _is_channel(self.dst) and not self.dst.send_ready():
+            return
+
+        try:
+            n = self.dst.send(self.buf)
+        except socket.timeout:
+            return
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        self.buf = self.buf[n:]
+        self._check_done()
+
+    def _check_done(self):
+        # forward the half-close once everything has been delivered
+        if self.eof and not self.buf and not self.done:
+            self.done = True
+            _shutdown_write(self.dst)
+
+
+class _Connection(object):
+    def __init__(self, local, chan, bufsize, limit):
+        self.local = local
+        self.chan = chan
+        self.broken = False
+        self.pipes = (_Pipe(local, chan, bufsize, limit),
+                      _Pipe(chan, local, bufsize, limit))
+
+    @property
+    def finished(self):
+        return all(p.done for p in self.pipes)
+
+    def close(self):
+        for conn in (self.local, self.chan):
+            try:
+                conn.close()
+            except (socket.error, EOFError):
+                pass
+
+
+class Forwarder(object):
+    """Relays connections accepted on ``listener`` to the remote.
+
+    :param listener: A listening socket.
+    :param connect: Called without arguments from a separate thread for each
+                    accepted connection, must return a connected socket or
+                    channel.
+    :param bufsize: Size of individual reads.
+    :param limit: Maximum number of bytes buffered per direction and
+                  connection. Defaults to four times ``bufsize``.
+    """
+
+    def __init__(self, listener, connect, bufsize, limit=None):
+        self.listener = listener
+        self.connect = connect
+        self.bufsize = bufsize
+        self.limit = limit or 4 * bufsize
+
+        self.connections = []
+        self._blocked = set()
+        self._connected = Queue()
+        self._stopped = False
+        self._wake_r, self._wake_w = socket.socketpair()
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except socket.error:
+            pass
+
+    def stop(self):
+        """Stops the event loop, closing all connections. Can be called from
+        any thread."""
+        self._stopped = True
+        self._wake()
+
+    def _accept(self):
+        try:
+            local, addr = self.listener.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+
+        def connect():
+            try:
+                chan = self.connect()
+            except Exception as e:
+                self._connected.put((local, None, e))
+            else:
+                self._connected.put((local, chan, None))
+            self._wake()
+
+        t = threading.Thread(target=connect)
+        t.daemon = True
+        t.start()
+
+    def _watch_send_ready(self, chan):
+        # wakes up the event loop once ``chan`` can be written to again
+        if chan in self._blocked:
+            return
+        self._blocked.add(chan)
+
+        def watch():
+            _wait_send_ready(chan)
+            self._blocked.discard(chan)
+            self._wake()
+
+        t = threading.Thread(target=watch)
+        t.daemon = True
+        t.start()
+
+    def _add_connected(self):
+        while True:
+            try:
+                local, chan, exc = self._connected.get_nowait()
+            except Empty:
+                return
+
+            if exc is not None:
+                log.warning('Could not open forwarded connection: {}'.format(
+                    exc))
+                local.close()
+                continue
+
+            local.setblocking(0)
+            chan.setblocking(0)
+            self.connections.append(
+                _Connection(local, chan, self.bufsize, self.limit))
+            log.debug('Forwarding connection from {}'.format(
+                local.getpeername() or 'unix socket'))
+
+    def _guarded(self, conn, f):
+        # runs an operation on a connection, marking it broken on failure
+        try:
+            f()
+        except (socket.error, EOFError) as e:
+            if getattr(e, 'errno', None) not in _DISCONNECT_ERRNOS:
+                log.debug('Forwarded connection failed: {}'.format(e))
+            conn.broken = True
+
+    def _step(self):
+        rlist = [self.listener, self._wake_r]
+        wlist = []
+        readers = {}
+        timeout = None
+
+        for conn in self.connections:
+            for pipe in conn.pipes:
+                if pipe.wants_read:
+                    rlist.append(pipe.src)
+                    readers[pipe.src] = (conn, pipe)
+                if pipe.wants_write:
+                    if not _is_channel(pipe.dst):
+                        wlist.append(pipe.dst)
+                    elif pipe.dst.send_ready():
+                        # a send was cut short by the packet size, go on
+                        # without waiting
+                        timeout = 0
+                    else:
+                        # channels cannot be selected for writing, a full
+                        # window is waited for in a separate thread
+                        self._watch_send_ready(pipe.dst)
+
+        try:
+            r, w, _ = select.select(rlist, wlist, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        if self._wake_r in r:
+            self._wake_r.recv(4096)
+            self._add_connected()
+        if self.listener in r:
+            self._accept()
+
+        for src in r:
+            if src in readers:
+                conn, pipe = readers[src]
+                self._guarded(conn, pipe.read)
+
+        # data that has just been read is sent right away. sockets that
+        # cannot take it are selected for writing in the next round
+        for conn in self.connections:
+            for pipe in conn.pipes:
+                if pipe.wants_write and not conn.broken:
+                    self._guarded(conn, pipe.write)
+
+    def serve(self):
+        """Runs the event loop until :meth:`stop` is called."""
+        self.listener.setblocking(0)
+
+        try:
+            while not self._stopped:
+                self._step()
+
+                for conn in [c for c in self.connections
+                             if c.broken or c.finished]:
+                    conn.close()
+                    self.connections.remove(conn)
+        finally:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self._wake_r.close()
+            self._wake_w.close()
@@ -6,13 +6,12 @@ import os
 import re
 import requests
 import uuid
-import time
 
 import click
 from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 
-from . import config, log, info
-from .exc import RebootNeeded, ReconnectNeeded
+from . import config, log, info, remote
+from .exc import RebootNeeded, RebootInProgress
 from .configfiles import app_dirs
 from .util import ConfigParser
 from remand.lib import posix
@@ -124,7 +123,7 @@ class WebResourceHandler(ResourceHandlerMixin):
                 out, closing(requests.get(url, stream=True)) as resp:
             resp.raise_for_status()
 
-            for chunk in resp.iter_content(int(config['buffer_size'])):
+            for chunk in resp.iter_content(remote.buffer_size()):
                 h.update(chunk)
                 out.write(chunk)
 
@@ -233,12 +232,11 @@ class Plan(object):
             log.warning('A reboot has been request on behalf of {}'.format(e))
 
             if config.get_bool('auto_reboot'):
-                delay = int(config['reboot_delay'])
-                log.warning(
-                    'Rebooting, will reconnect after {} seconds'.format(delay))
+                # remembered to tell the rebooted host from the old one
+                boot_id = posix.info_boot_id()
+                log.warning('Rebooting, will reconnect once the host is back')
                 posix.reboot()
-                time.sleep(delay)
-                raise ReconnectNeeded(obj)
+                raise RebootInProgress(obj, boot_id)
             else:
                 log.error('Automatic reboots disabled, cannot continue.')
 
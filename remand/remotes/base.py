@@ -1,7 +1,11 @@
 from contextlib import contextmanager
+from functools import partial
+import hashlib
+import math
 import posixpath
+import threading
 
-from .. import util, config
+from .. import util, config, log, remote
 
 
 class RemoteProcess(object):
@@ -53,9 +57,8 @@ class RemoteProcess(object):
         collect_stdout = util.CollectThread(self.stdout)
         collect_stderr = util.CollectThread(self.stderr)
 
-        bufsize = int(config['buffer_size'])
         if input is not None:
-            util.write_all(self.stdin, input)
+            util.write_all(self.stdin, input, remote.buffer_size())
         self.stdin.close()
 
         # wait for stdout/stderr to finish
@@ -74,6 +77,93 @@ class RemoteProcess(object):
         raise NotImplementedError
 
 
+class LinkStats(object):
+    """Round trip time and throughput measured on the connection to a
+    remote. Used to size buffers if ``buffer_size`` is set to ``auto``.
+
+    Buffers are sized to hold the bandwidth-delay product of the link,
+    rounded up to a power of two and kept between ``MIN_BUFFER_SIZE`` and
+    ``MAX_BUFFER_SIZE``. Until a transfer has been measured,
+    ``MIN_BUFFER_SIZE`` is used.
+    """
+    MIN_BUFFER_SIZE = 32 * 1024
+    MAX_BUFFER_SIZE = 4 * 1024 * 1024
+
+    #: transfers smaller than this are dominated by latency and not recorded
+    MIN_SAMPLE_SIZE = 1024 * 1024
+
+    def __init__(self):
+        #: lowest round trip time seen, in seconds
+        self.rtt = None
+
+        #: moving average of the throughput, in bytes per second
+        self.throughput = None
+
+        self._buffer_size = self.MIN_BUFFER_SIZE
+        self._lock = threading.Lock()
+
+    def record_rtt(self, seconds):
+        with self._lock:
+            if self.rtt is None or seconds < self.rtt:
+                self.rtt = seconds
+                self._update()
+
+    def record_transfer(self, nbytes, seconds):
+        if nbytes < self.MIN_SAMPLE_SIZE or seconds <= 0:
+            return
+
+        with self._lock:
+            rate = nbytes / seconds
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput = (self.throughput + rate) / 2
+            self._update()
+
+    @property
+    def bdp(self):
+        """The bandwidth-delay product in bytes, or ``None`` if unknown."""
+        if self.rtt is None or self.throughput is None:
+            return None
+        return self.rtt * self.throughput
+
+    def _update(self):
+        bdp = self.bdp
+        if bdp is None:
+            return
+
+        size = 2**int(math.ceil(math.log(max(bdp, 1), 2)))
+        size = max(self.MIN_BUFFER_SIZE, min(size, self.MAX_BUFFER_SIZE))
+        if size != self._buffer_size:
+            self._buffer_size = size
+            log.debug('Buffer size is now {} bytes ({})'.format(size, self))
+
+    def buffer_size(self):
+        return self._buffer_size
+
+    def window_requests(self, request_size):
+        """Number of concurrent requests of ``request_size`` bytes needed to
+        keep the link busy, or ``None`` if unknown."""
+        bdp = self.bdp
+        if bdp is None:
+            return None
+        # twice the bdp, as requests are only refilled once answered
+        return max(4, min(1024, int(math.ceil(2 * bdp / request_size))))
+
+    def __nonzero__(self):
+        return self.rtt is not None or self.throughput is not None
+
+    def __str__(self):
+        parts = []
+        if self.rtt is not None:
+            parts.append('rtt {:.1f} ms'.format(self.rtt * 1000))
+        if self.throughput is not None:
+            parts.append('{:.1f} MiB/s'.format(self.throughput /
+                                                (1024 * 1024)))
+        parts.append('buffer size {}'.format(self._buffer_size))
+        return ', '.join(parts)
+
+
 class Remote(object):
     """Interface for transports to remote server.
 
@@ -85,6 +175,43 @@ class Remote(object):
     #: the path module to be used on the remote
     path = posixpath
 
+    #: whether an instance may be kept and reused by later runs, see
+    #: :class:`~remand.agent.TransportPool`
+    reusable = False
+
+    @property
+    def timings(self):
+        """Durations of connecting and other steps taken by the transport,
+        as a :class:`~remand.util.Timings` instance."""
+        if '_timings' not in self.__dict__:
+            self._timings = util.Timings()
+        return self._timings
+
+    @property
+    def link(self):
+        """Measurements of the connection to the remote, as a
+        :class:`LinkStats` instance."""
+        if '_link' not in self.__dict__:
+            self._link = LinkStats()
+        return self._link
+
+    def buffer_size(self):
+        """Size of individual reads and writes when transferring data.
+
+        Taken from the ``buffer_size`` setting. If set to ``auto``, the size
+        is picked based on ``link``."""
+        value = config.snapshot().buffer_size
+        if value == 'auto':
+            return self.link.buffer_size()
+        return value
+
+    def close(self):
+        """Close the connection to the remote."""
+
+    def is_active(self):
+        """Check whether the connection to the remote is still usable."""
+        return True
+
     def getcwd(self):
         """Returns the current working directory.
 
@@ -115,6 +242,23 @@ class Remote(object):
         """
         raise NotImplementedError
 
+    def copy(self, src, dst):
+        """Copy a file on the remote side, without transferring its contents.
+
+        The default implementation copies the data through
+        :func:`~remand.remotes.Remote.file`.
+
+        :param src: File to copy.
+        :param dst: Destination path. Will be overwritten if it exists.
+        """
+        bufsize = self.buffer_size()
+        with self.file(src, 'rb') as fsrc, self.file(dst, 'wb') as fdst:
+            while True:
+                buf = fsrc.read(bufsize)
+                if not buf:
+                    break
+                fdst.write(buf)
+
     def file(self, name, mode='r', bufsize=-1):
         """Open a file on the remote side.
 
@@ -128,6 +272,52 @@ class Remote(object):
         """
         raise NotImplementedError
 
+    @contextmanager
+    def file_session(self):
+        """Open an independent session for file access.
+
+        Sessions allow transferring data concurrently, each session may be
+        used by a different thread. The default implementation returns the
+        remote itself, which is sufficient for remotes whose file objects are
+        thread-safe.
+
+        :return: A context manager returning an object that has a ``file()``
+                 method with the same signature as
+                 :func:`~remand.remotes.Remote.file`.
+        """
+        yield self
+
+    def fsync(self, f):
+        """Flush a file opened through :func:`~remand.remotes.Remote.file`
+        and, if supported, make sure its contents reach the disk.
+
+        :param f: File object to sync.
+        """
+        f.flush()
+
+    def hardlink(self, target, path):
+        """Create a hard link.
+
+        :param target: Existing file the link will point to.
+        :param path: Path for the link.
+        """
+        raise NotImplementedError
+
+    def hash(self, path, algorithm='sha1'):
+        """Hash a file's contents on the remote side.
+
+        The default implementation reads the file through
+        :func:`~remand.remotes.Remote.file`.
+
+        :param path: File to hash.
+        :param algorithm: Name of the hash algorithm, as accepted by
+                          :func:`hashlib.new`.
+        :return: The hexdigest of the file's contents.
+        """
+        with self.file(path, 'rb') as f:
+            m = util.hash_file(f, partial(hashlib.new, algorithm))
+        return m.hexdigest()
+
     def listdir(self, path):
         """List directory contents.
 
@@ -201,6 +391,34 @@ class Remote(object):
         """
         raise NotImplementedError
 
+    def setstat(self, path, mode=None, uid=None, gid=None, atime=None,
+                mtime=None):
+        """Change several attributes of a file at once.
+
+        Only attributes that are not ``None`` are changed. The default
+        implementation calls :func:`~remand.remotes.Remote.chmod`,
+        :func:`~remand.remotes.Remote.chown` and
+        :func:`~remand.remotes.Remote.utime` as needed.
+
+        :param path: Path to change. Symbolic links are followed.
+        :param mode: New mode (as an integer).
+        :param uid: New numeric user id.
+        :param gid: New numeric group id.
+        :param atime: New access time. Must be given together with ``mtime``.
+        :param mtime: New modification time. Must be given together with
+                      ``atime``.
+        """
+        if (atime is None) != (mtime is None):
+            raise ValueError('atime and mtime must be set together')
+
+        if mode is not None:
+            self.chmod(path, mode)
+        if uid is not None or gid is not None:
+            self.chown(path, -1 if uid is None else uid,
+                       -1 if gid is None else gid)
+        if atime is not None:
+            self.utime(path, (atime, mtime))
+
     def stat(self, path):
         """Stat a file.
 
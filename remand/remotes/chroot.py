@@ -1,4 +1,5 @@
 import os
+import shutil
 import subprocess
 
 from .. import log, util, config
@@ -99,9 +100,20 @@ class ChrootRemote(Remote):
     def chown(self, path, uid=-1, gid=-1):
         return os.chown(self._lpath(path), uid, gid)
 
+    def copy(self, src, dst):
+        return shutil.copyfile(self._lpath(src), self._lpath(dst))
+
     def file(self, name, mode='r'):
         return open(self._lpath(name), mode)
 
+    def fsync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def hardlink(self, target, path):
+        return os.link(
+            self._lpath(target, follow_symlink=False), self._lpath(path))
+
     def listdir(self, path):
         return os.listdir(self._lpath(path))
 
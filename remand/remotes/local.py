@@ -1,4 +1,5 @@
 import os
+import shutil
 import socket
 import subprocess
 
@@ -17,8 +18,11 @@ class LocalRemote(Remote):
 
     chdir = os.chdir
     chmod = os.chmod
+    chown = os.chown
+    copy = lambda _, src, dst: shutil.copyfile(src, dst)
     file = open
     getcwd = os.getcwd
+    hardlink = lambda _, target, path: os.link(target, path)
     listdir = os.listdir
 
     def lstat(self, path):
@@ -35,7 +39,7 @@ class LocalRemote(Remote):
     mkdir = os.mkdir
     normalize = lambda _, path: os.path.abspath(os.path.realpath(path))
     readlink = os.readlink
-    rename = lambda oldpath, newpath: os.rename(oldpath, newpath)
+    rename = lambda _, oldpath, newpath: os.rename(oldpath, newpath)
 
     rmdir = os.rmdir
 
@@ -55,6 +59,10 @@ class LocalRemote(Remote):
     unlink = os.unlink
     utime = os.utime
 
+    def fsync(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+
     def popen(self, args, cwd=None, extra_env={}):
         env = {}
         env.update(os.environ)
@@ -0,0 +1,234 @@
+import os
+import shlex
+import socket
+import subprocess
+import tempfile
+import time
+
+from .. import config, log
+from .base import RemoteProcess
+from .sftp import SFTPRemote, RemandSFTPClient, wrap_sftp_errors
+from ..exc import ConfigurationError, TransportError
+
+# maps ``on_missing_host_key`` to values of OpenSSH's StrictHostKeyChecking.
+# OpenSSH always saves accepted keys, so 'ask' behaves like 'ask_to_save'
+_STRICT_HOST_KEY_CHECKING = {
+    'abort': 'yes',
+    'ask': 'ask',
+    'ask_to_save': 'ask',
+    'ignore': 'no',
+}
+
+
+class OpenSSHProcess(RemoteProcess):
+    def __init__(self, p):
+        self._p = p
+        self.stdin = p.stdin
+        self.stdout = p.stdout
+        self.stderr = p.stderr
+
+    def poll(self):
+        if self._p.poll() is not None:
+            self.returncode = self._p.returncode
+            return True
+
+    def wait(self):
+        self.returncode = self._p.wait()
+
+    def kill(self):
+        self._p.kill()
+
+
+class _PipeSFTPClient(RemandSFTPClient):
+    # SFTP client talking to an ssh process through one end of a socketpair
+
+    def __init__(self, sock, process):
+        super(_PipeSFTPClient, self).__init__(sock)
+        self._process = process
+
+    def close(self):
+        super(_PipeSFTPClient, self).close()
+        self._process.wait()
+
+
+class OpenSSHRemote(SFTPRemote):
+    """Transport using the system's ``ssh`` binary.
+
+    A master connection is started on first use (or an existing one reused)
+    and shared by every command, SFTP session and tunnel through OpenSSH's
+    connection multiplexing. The master keeps running for
+    ``openssh_control_persist`` seconds after its last client has gone away,
+    so later runs can skip connecting and authenticating.
+
+    Host keys, agents and keys are handled by OpenSSH, which also reads
+    ``~/.ssh/config``. Passwords are not supported."""
+    uri_prefix = 'openssh'
+    reusable = True
+
+    def __init__(self):
+        super(OpenSSHRemote, self).__init__()
+        uri = config['uri']
+        if uri.password:
+            raise ConfigurationError(
+                'The openssh transport does not support passwords, use keys '
+                'or an agent instead')
+
+        if self.is_active():
+            log.debug('Reusing OpenSSH master connection to {}'.format(
+                uri.host))
+        else:
+            with self.timings.measure('openssh_master'):
+                self._start_master()
+
+        self._check_environment()
+
+    def _ssh_args(self, *opts):
+        # returns an ssh command line for the current uri, ending with the
+        # host name. ``opts`` are added before the host name
+        uri = config['uri']
+
+        args = [
+            config['cmd_ssh'],
+            '-o', 'ControlPath={}'.format(
+                os.path.expanduser(config['openssh_control_path'])),
+            '-o', 'ConnectTimeout={}'.format(config['ssh_connect_timeout']),
+        ]
+
+        on_missing = config['on_missing_host_key']
+        if on_missing not in _STRICT_HOST_KEY_CHECKING:
+            raise ConfigurationError(
+                'Invalid on_missing_host_key: {!r}'.format(on_missing))
+        args.extend(['-o', 'StrictHostKeyChecking={}'.format(
+            _STRICT_HOST_KEY_CHECKING[on_missing])])
+
+        known_hosts = [
+            os.path.expanduser(p)
+            for p in config['load_known_hosts'].split(os.pathsep) if p
+        ]
+        if known_hosts:
+            args.extend(['-o', 'UserKnownHostsFile={}'.format(
+                ' '.join(known_hosts))])
+
+        if uri.port:
+            args.extend(['-p', str(uri.port)])
+        if uri.user:
+            args.extend(['-l', uri.user])
+        if config['ssh_private_key']:
+            args.extend(['-i', os.path.expanduser(config['ssh_private_key'])])
+        if config['openssh_options']:
+            args.extend(shlex.split(config['openssh_options']))
+
+        args.extend(opts)
+        args.extend(['--', uri.host])
+        return args
+
+    def _client_args(self, *opts):
+        # clients never become masters themselves. should the master be gone,
+        # they connect directly instead
+        return self._ssh_args('-T', '-o', 'ControlMaster=no', *opts)
+
+    def _start_master(self):
+        uri = config['uri']
+        args = self._ssh_args('-M', '-N', '-f', '-o', 'ControlPersist={}'
+                              .format(config['openssh_control_persist']))
+        interactive = config['on_missing_host_key'] in ('ask', 'ask_to_save')
+
+        attempt = 0
+        max_attempts = int(config['ssh_connect_retries'])
+        delay = int(config['ssh_connect_retry_delay'])
+
+        while True:
+            log.debug('Starting OpenSSH master: {}'.format(' '.join(args)))
+
+            # the backgrounded master inherits the standard streams. pipes
+            # would not be closed until it exits, so a file is used to
+            # capture errors instead
+            with tempfile.TemporaryFile() as errors,\
+                    open(os.devnull, 'r+b') as devnull:
+                returncode = subprocess.call(
+                    args,
+                    stdin=None if interactive else devnull,
+                    stdout=devnull,
+                    stderr=None if interactive else errors)
+                errors.seek(0)
+                msg = errors.read().strip()
+
+            if returncode == 0:
+                break
+
+            attempt += 1
+            log.warning('Connection to {} failed {} out of {} times: {}'
+                        .format(uri.host, attempt, max_attempts, msg))
+
+            if attempt < max_attempts and 'Host key verification' not in msg:
+                log.info('Retrying to connect in {} seconds'.format(delay))
+                time.sleep(delay)
+                continue
+
+            raise TransportError('Could not connect to {}: {}'.format(
+                uri.host, msg or 'ssh exited with status {}'.format(
+                    returncode)))
+
+        log.debug('OpenSSH master connection established')
+
+    def _spawn(self, args, **kwargs):
+        # runs an ssh client connected to one end of a socketpair, returning
+        # the other end and the process
+        ours, theirs = socket.socketpair()
+        try:
+            p = subprocess.Popen(args, stdin=theirs, stdout=theirs, **kwargs)
+        finally:
+            theirs.close()
+        return ours, p
+
+    def is_active(self):
+        with open(os.devnull, 'r+b') as devnull:
+            return subprocess.call(
+                self._ssh_args('-O', 'check'),
+                stdin=devnull,
+                stdout=devnull,
+                stderr=devnull) == 0
+
+    def close(self):
+        # the master is left running, it exits on its own after
+        # ``openssh_control_persist`` seconds and may be shared with others
+        super(OpenSSHRemote, self).close()
+
+    def _open_sftp(self, command):
+        if command is None:
+            log.debug('SFTP using Subsystem sftp')
+            args = self._client_args('-s') + ['sftp']
+        else:
+            log.debug('SFTP using {}'.format(command))
+            args = self._client_args() + [command]
+
+        sock, p = self._spawn(args)
+        return _PipeSFTPClient(sock, p)
+
+    @wrap_sftp_errors
+    def popen(self, args, cwd=None, extra_env={}):
+        cmd = self._command_line(args, cwd, extra_env)
+        log.debug('Executing {}'.format(cmd))
+
+        return OpenSSHProcess(
+            subprocess.Popen(
+                self._client_args() + [cmd],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE))
+
+    def tcp_connect(self, addr):
+        # cannot log here, must be callable by other threads. the ssh process
+        # exits once the socket is closed and is reaped by the subprocess
+        # module later on
+        sock, _ = self._spawn(self._client_args('-W', '{}:{}'.format(*addr)))
+        return sock
+
+    def unix_connect(self, addr):
+        if not config['cmd_nc-openbsd']:
+            raise ValueError('cmd.nc-openbsd is required for unix socket '
+                             'connections via SSH')
+
+        cmd = self._command_line([config['cmd_nc-openbsd'], '-U', addr])
+        sock, _ = self._spawn(self._client_args() + [cmd])
+        return sock
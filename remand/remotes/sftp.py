@@ -0,0 +1,503 @@
+from binascii import hexlify
+from contextlib import contextmanager
+from functools import wraps
+import struct
+import threading
+import time
+
+from future.utils import raise_from
+from paramiko.message import Message
+from paramiko.sftp import (CMD_INIT, CMD_VERSION, CMD_EXTENDED,
+                           CMD_EXTENDED_REPLY, CMD_SETSTAT, SFTPError,
+                           _VERSION)
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.sftp_client import SFTPClient
+from paramiko.ssh_exception import SSHException
+from six.moves import shlex_quote
+
+from .. import config, log, util
+from .base import Remote
+from ..exc import (TransportError, RemoteFailureError,
+                   RemoteFileDoesNotExistError, ConfigurationError)
+
+
+def wrap_ssh_errors(f):
+    @wraps(f)
+    def _(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except SSHException, e:
+            raise TransportError(
+                'SSH ({}): {}'.format(type(e).__name__, e.message))
+
+    return _
+
+
+def wrap_sftp_errors(f):
+    @wraps(f)
+    def _(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except IOError, e:
+            fargs = ', '.join(
+                map(repr, args[1:]) +
+                ['{}={!r}'.format(*v) for v in kwargs.items()])
+            if e.errno == 2:
+                raise RemoteFileDoesNotExistError(str(e))
+            raise RemoteFailureError(
+                'SFTP Failed {}({}): {}'.format(f.__name__, fargs, str(e)))
+
+    return wrap_ssh_errors(_)
+
+
+class RemandSFTPClient(SFTPClient):
+    """SFTP client that keeps track of the protocol extensions announced by
+    the server and supports some of them."""
+
+    def _send_version(self):
+        # same as the base version, but parses the extension pairs following
+        # the version number
+        self._send_packet(CMD_INIT, struct.pack('>I', _VERSION))
+        t, data = self._read_packet()
+        if t != CMD_VERSION:
+            raise SFTPError('Incompatible sftp protocol')
+
+        msg = Message(data)
+        version = msg.get_int()
+
+        #: maps names of extensions supported by the server to their data
+        self.server_extensions = {}
+        while msg.get_remainder():
+            name = msg.get_string()
+            self.server_extensions[name] = msg.get_string()
+
+        return version
+
+    def supports(self, extension):
+        return extension in self.server_extensions
+
+    def setstat(self, path, attr):
+        self._request(CMD_SETSTAT, self._adjust_cwd(path), attr)
+
+    def posix_rename(self, oldpath, newpath):
+        self._request(CMD_EXTENDED, 'posix-rename@openssh.com',
+                      self._adjust_cwd(oldpath), self._adjust_cwd(newpath))
+
+    def hardlink(self, target, path):
+        self._request(CMD_EXTENDED, 'hardlink@openssh.com',
+                      self._adjust_cwd(target), self._adjust_cwd(path))
+
+    def fsync(self, f):
+        f.flush()
+        self._request(CMD_EXTENDED, 'fsync@openssh.com', f.handle)
+
+    def copy_data(self, src, dst):
+        with self.file(src, 'rb') as fsrc, self.file(dst, 'wb') as fdst:
+            # a length of 0 copies everything up to the end of the file
+            self._request(CMD_EXTENDED, 'copy-data', fsrc.handle, long(0),
+                          long(0), fdst.handle, long(0))
+
+    def check_file_name(self, path, algorithm):
+        t, msg = self._request(CMD_EXTENDED, 'check-file-name',
+                               self._adjust_cwd(path), algorithm, long(0),
+                               long(0), 0)
+        if t != CMD_EXTENDED_REPLY:
+            raise SFTPError('Expected check-file reply')
+
+        msg.get_string()  # "check-file"
+        used = msg.get_string()
+        if used != algorithm:
+            raise SFTPError('Server hashed using {} instead of {}'.format(
+                used, algorithm))
+        return hexlify(msg.get_remainder())
+
+
+class SFTPFileSession(object):
+    def __init__(self, sftp, bufsize, pipelined):
+        self._sftp = sftp
+        self.bufsize = bufsize
+        self.pipelined = pipelined
+
+    @wrap_sftp_errors
+    def file(self, name, mode='r'):
+        fp = self._sftp.file(name, mode, self.bufsize)
+        fp.set_pipelined(self.pipelined)
+        return fp
+
+    def close(self):
+        self._sftp.close()
+
+
+class _ClientPool(object):
+    """Holds up to ``size`` SFTP clients for a single invocation. Each client
+    is used by one thread at a time.
+
+    :param open_client: Called to open a new client.
+    """
+
+    def __init__(self, open_client, size):
+        self._open_client = open_client
+        self.size = size
+        self._clients = []
+        self._idle = []
+        self._opening = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, block=True):
+        """Returns an idle client, opening a new one if the pool is not full.
+
+        :param block: If ``False``, ``None`` is returned instead of waiting
+                      for a client to be released.
+        """
+        with self._cond:
+            while (not self._idle and
+                   len(self._clients) + self._opening >= self.size):
+                if not block:
+                    return None
+                self._cond.wait()
+
+            if self._idle:
+                return self._idle.pop()
+            self._opening += 1
+
+        # opening takes a round trip, do not hold up other threads meanwhile
+        try:
+            client = self._open_client()
+        finally:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+
+        with self._cond:
+            self._clients.append(client)
+        return client
+
+    def release(self, client):
+        with self._cond:
+            # clients of a closed pool are not taken back
+            if client in self._clients:
+                self._idle.append(client)
+                self._cond.notify()
+
+    def clients(self):
+        with self._cond:
+            return list(self._clients)
+
+    def close(self):
+        with self._cond:
+            clients = self._clients
+            self._clients = []
+            self._idle = []
+
+        for client in clients:
+            client.close()
+
+
+class _Lease(object):
+    # a client taken from a pool by a thread. it is returned once the thread
+    # has finished and its thread-local data, which holds the lease, has been
+    # cleared
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.client = pool.acquire()
+
+    def __del__(self):
+        self.pool.release(self.client)
+
+
+class SFTPRemote(Remote):
+    """Base class for remotes that access files through SFTP and run
+    commands through a shell.
+
+    Subclasses must implement ``_open_sftp``, returning a new
+    :class:`RemandSFTPClient` for the given ``sftp_command``, and
+    :func:`~remand.remotes.Remote.popen`.
+    """
+
+    def __init__(self):
+        # client pools by invocation, see ``set_sftp_invocation``
+        self._sftp_pools = {}
+        self._sftp_pools_lock = threading.Lock()
+        self._sftp_invocation = config['sftp_command']
+        self._sftp_leases = threading.local()
+        self._sftp_cwd = None
+        # user commands run as while inside ``proc.sudo``
+        self.sudo_user = None
+
+    def _check_environment(self):
+        # verify umask
+        log.debug('Verifying umask')
+        p_umask = self.popen(['sh', '-c', 'umask'])
+        um, _ = p_umask.communicate()
+        assert p_umask.returncode == 0
+
+        umask = int(um.strip(), 8)
+        expected_umask = config.snapshot().reset_umask
+        if not umask == expected_umask:
+            log.warning('Host has unexpected umask of {:03o} (instead of '
+                        '{:03o}). Things might not work as you expect.'.format(
+                            umask, expected_umask))
+
+        # verify time
+        max_diff = config['max_time_diff']
+
+        if max_diff is not None:
+            local_timestamp = int(time.time())
+            p_ts = self.popen(['date', '+%s'])
+            try:
+                ts, _ = p_ts.communicate()
+            except IOError as e:
+                log.warning('Could not verify remote time. '
+                            'Is the date binary missing?')
+            timestamp = int(ts)
+            time_diff = timestamp - local_timestamp
+            log.debug('Local time: {} Remote time: {} Diff: {}'.format(
+                local_timestamp, timestamp, time_diff))
+            if time_diff > max_diff:
+                log.warning('Remote time differs by {} seconds (limit: {})'
+                            .format(time_diff, max_diff))
+
+        # estimate the link's latency from a few round trips, see
+        # ``buffer_size=auto``
+        sftp = self._sftp
+        for _ in range(3):
+            start = time.time()
+            sftp.normalize('.')
+            self.link.record_rtt(time.time() - start)
+        log.debug('Link: {}'.format(self.link))
+
+    @staticmethod
+    def _command_line(args, cwd=None, extra_env={}):
+        # builds a shell command line, as sent to the remote
+        envvars = [
+            '{}={}'.format(shlex_quote(k), shlex_quote(v))
+            for k, v in extra_env.items()
+        ]
+        chdir = ''
+
+        if cwd is not None:
+            chdir = 'cd {} &&'.format(shlex_quote(cwd))
+
+        return ' '.join([chdir] + envvars +
+                        [shlex_quote(part) for part in args])
+
+    def close(self):
+        with self._sftp_pools_lock:
+            pools = self._sftp_pools.values()
+            self._sftp_pools = {}
+        self._sftp_leases = threading.local()
+
+        for pool in pools:
+            pool.close()
+
+    def set_sftp_invocation(self, command):
+        """Switches file operations to the SFTP server started by
+        ``command``, or the sftp subsystem if ``command`` is ``None``.
+
+        Clients are kept open after switching away from them and are reused
+        when switching back, see :func:`~remand.lib.proc.sudo`."""
+        self._sftp_invocation = command
+
+    def _open_client(self, command):
+        client = self._open_sftp(command)
+        client._cwd = self._sftp_cwd
+        return client
+
+    def _sftp_pool(self, command):
+        with self._sftp_pools_lock:
+            pool = self._sftp_pools.get(command)
+            if pool is None:
+                channels = config.snapshot().sftp_channels
+                log.debug('Opening up to {} SFTP channels for {}'.format(
+                    channels, command or 'subsystem sftp'))
+                pool = _ClientPool(lambda: self._open_client(command),
+                                   channels)
+                self._sftp_pools[command] = pool
+            return pool
+
+    @property
+    def _sftp(self):
+        # every thread leases a client of its own, as a single SFTPClient
+        # cannot be shared between threads. at most ``sftp_channels`` threads
+        # perform file operations at the same time, others wait for one of
+        # them to finish
+        leases = self._sftp_leases.__dict__
+        lease = leases.get(self._sftp_invocation)
+        if lease is None:
+            lease = _Lease(self._sftp_pool(self._sftp_invocation))
+            leases[self._sftp_invocation] = lease
+        return lease.client
+
+    @contextmanager
+    def file_session(self):
+        # sessions use idle clients of the pool if possible. if none are
+        # available, a separate client is opened instead of waiting, as the
+        # calling thread may be holding on to one itself
+        pool = self._sftp_pool(self._sftp_invocation)
+        client = pool.acquire(block=False)
+        pooled = client is not None
+        if not pooled:
+            client = self._open_client(self._sftp_invocation)
+
+        session = SFTPFileSession(client,
+                                  self.buffer_size(),
+                                  config.snapshot().sftp_pipelined)
+        try:
+            yield session
+        finally:
+            if pooled:
+                pool.release(client)
+            else:
+                session.close()
+
+    def _exec(self, args):
+        # used as a fallback for SFTP extensions unsupported by the server
+        p = self.popen(args)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise RemoteFailureError('{} failed ({}): {}'.format(
+                args[0], p.returncode, stderr.strip()))
+        return stdout
+
+    @wrap_sftp_errors
+    def chdir(self, path):
+        # paramiko tracks the working directory on the client side. it is
+        # copied to all clients, so every thread sees the same one
+        self._sftp.chdir(path)
+        self._sftp_cwd = self._sftp._cwd
+
+        with self._sftp_pools_lock:
+            pools = self._sftp_pools.values()
+        for pool in pools:
+            for client in pool.clients():
+                client._cwd = self._sftp_cwd
+
+    @wrap_sftp_errors
+    def chmod(self, path, mode):
+        return self._sftp.chmod(path, mode)
+
+    @wrap_sftp_errors
+    def copy(self, src, dst):
+        if self._sftp.supports('copy-data'):
+            return self._sftp.copy_data(src, dst)
+        self._exec([config['cmd_cp'], '--', src, dst])
+
+    @wrap_sftp_errors
+    def fsync(self, f):
+        # the request must go through the client the file was opened with
+        client = getattr(f, 'sftp', None)
+        if (isinstance(client, RemandSFTPClient) and
+                client.supports('fsync@openssh.com')):
+            return client.fsync(f)
+        f.flush()
+
+    @wrap_sftp_errors
+    def hardlink(self, target, path):
+        if self._sftp.supports('hardlink@openssh.com'):
+            return self._sftp.hardlink(target, path)
+        self._exec([config['cmd_ln'], '--', target, path])
+
+    @wrap_sftp_errors
+    def hash(self, path, algorithm='sha1'):
+        if self._sftp.supports('check-file-name'):
+            return self._sftp.check_file_name(path, algorithm)
+
+        cmd = (config['cmd_sha1sum']
+               if algorithm == 'sha1' else algorithm + 'sum')
+        return self._exec([cmd, path]).split(None, 1)[0]
+
+    @wrap_sftp_errors
+    def getcwd(self):
+        return self._sftp.normalize('.')
+
+    @wrap_sftp_errors
+    def listdir(self, path):
+        return self._sftp.listdir(path)
+
+    @wrap_sftp_errors
+    def lstat(self, path):
+        try:
+            return self._sftp.lstat(path)
+        except IOError, e:
+            if e.errno == 2:
+                return None
+            raise
+
+    @wrap_sftp_errors
+    def mkdir(self, path, mode=0777):
+        return self._sftp.mkdir(path, mode)
+
+    @wrap_sftp_errors
+    def normalize(self, path):
+        return self._sftp.normalize(path)
+
+    @wrap_sftp_errors
+    def readlink(self, path):
+        return self._sftp.readlink(path)
+
+    @wrap_sftp_errors
+    def rename(self, oldpath, newpath):
+        # plain SFTP renames fail if newpath exists
+        if self._sftp.supports('posix-rename@openssh.com'):
+            return self._sftp.posix_rename(oldpath, newpath)
+        self._exec([config['cmd_mv'], '-f', '-T', '--', oldpath, newpath])
+
+    @wrap_sftp_errors
+    def rmdir(self, path):
+        return self._sftp.rmdir(path)
+
+    @wrap_sftp_errors
+    def setstat(self, path, mode=None, uid=None, gid=None, atime=None,
+                mtime=None):
+        if (atime is None) != (mtime is None):
+            raise ValueError('atime and mtime must be set together')
+
+        # everything is sent in a single SETSTAT request
+        attr = SFTPAttributes()
+        attr.st_mode = mode
+        if uid is not None or gid is not None:
+            # ids are sent in pairs. like with chown(2), an id of -1 (as an
+            # unsigned int) leaves it unchanged
+            attr.st_uid = 0xffffffff if uid is None else uid
+            attr.st_gid = 0xffffffff if gid is None else gid
+        attr.st_atime = atime
+        attr.st_mtime = mtime
+
+        return self._sftp.setstat(path, attr)
+
+    @wrap_sftp_errors
+    def stat(self, path):
+        try:
+            return self._sftp.stat(path)
+        except IOError, e:
+            if e.errno == 2:
+                return None
+            raise
+
+    @wrap_sftp_errors
+    def symlink(self, target, path):
+        return self._sftp.symlink(target, path)
+
+    @wrap_sftp_errors
+    def umask(self, umask):
+        try:
+            util.validate_umask(umask)
+        except ValueError as e:
+            raise_from(ConfigurationError(str(e)), e)
+        raise NotImplementedError('Currently, the SSH transport does not '
+                                  'support setting the umask')
+
+    @wrap_sftp_errors
+    def unlink(self, path):
+        return self._sftp.unlink(path)
+
+    @wrap_sftp_errors
+    def utime(self, path, times):
+        return self._sftp.utime(path, times)
+
+    @wrap_sftp_errors
+    def file(self, name, mode='r'):
+        fp = self._sftp.file(name, mode, self.buffer_size())
+        fp.set_pipelined(config.snapshot().sftp_pipelined)
+        return fp
@@ -1,23 +1,33 @@
 from binascii import hexlify
-from functools import wraps, partial
-from threading import Thread
+from functools import partial
+from threading import Thread, Lock, Event
+import json
 import os
 import socket
+import tempfile
 import time
 
 import click
-from future.utils import raise_from
+from paramiko.agent import Agent, AgentKey
+from paramiko.channel import Channel
 from paramiko.client import (SSHClient, AutoAddPolicy, RejectPolicy,
                              MissingHostKeyPolicy)
-from paramiko.sftp_client import SFTPClient
+from paramiko.common import cMSG_CHANNEL_OPEN
+from paramiko.dsskey import DSSKey
+from paramiko.ecdsakey import ECDSAKey
+from paramiko.ed25519key import Ed25519Key
+from paramiko.hostkeys import HostKeys
+from paramiko.message import Message
+from paramiko.rsakey import RSAKey
 from paramiko.ssh_exception import (SSHException, BadHostKeyException,
-                                    NoValidConnectionsError)
-from six.moves import shlex_quote
+                                    ChannelException, NoValidConnectionsError)
 
-from .. import config, log, util
-from .base import Remote, RemoteProcess
-from ..exc import (TransportError, RemoteFailureError,
-                   RemoteFileDoesNotExistError, ConfigurationError)
+from .. import config, log
+from .base import RemoteProcess
+from ..configfiles import app_dirs
+from .sftp import (SFTPRemote, RemandSFTPClient, wrap_ssh_errors,
+                   wrap_sftp_errors)
+from ..exc import TransportError, ConfigurationError
 
 _KNOWN_HOSTS_ERROR = (
     "The host '{}' was not found in your known_hosts file. "
@@ -76,51 +86,346 @@ class AskToSavePolicy(AskToAddPolicy):
         client._host_keys.add(hostname, key.get_name(), key)
 
         if client._host_keys_filename is not None:
-            client.save_host_keys(client._host_keys_filename)
+            # appended instead of saved through the client, which only holds
+            # the keys added during this connection (see ``known_hosts``)
+            with open(client._host_keys_filename, 'a') as f:
+                f.write('{} {} {}\n'.format(hostname, key.get_name(),
+                                            key.get_base64()))
             log.info('Added {} host key for {}: {}'.format(
                 key.get_name(), hostname, format_key(key)))
         else:
             log.warning('Did not save host, no known_hosts file loaded.')
 
 
-def format_key(key):
-    return ':'.join(hexlify(b) for b in key.get_fingerprint())
+#: transport settings selectable through ``ssh_profile``. ciphers and macs
+#: are listed in order of preference, those not supported by the installed
+#: version of paramiko are skipped. window sizes apply to data received, i.e.
+#: downloads and command output
+SSH_PROFILES = {
+    # paramiko's defaults
+    'default': {},
+    # fast, low latency links: cheap ciphers, large windows, no compression
+    'lan-bulk': {
+        'ciphers': ('aes128-gcm@openssh.com', 'aes128-ctr', 'aes256-ctr'),
+        'macs': ('hmac-sha1', 'hmac-sha2-256'),
+        'compress': False,
+        'window_size': 16 * 1024 * 1024,
+        'max_packet_size': 32768,
+    },
+    # slow or high latency links: compression and a window large enough to
+    # cover the bandwidth-delay product
+    'wan-compressed': {
+        'ciphers': ('aes128-ctr', 'aes256-ctr'),
+        'macs': ('hmac-sha2-256', 'hmac-sha1'),
+        'compress': True,
+        'window_size': 8 * 1024 * 1024,
+        'max_packet_size': 32768,
+    },
+    # devices without AES instructions (e.g. the Raspberry Pi): the cheapest
+    # cipher and mac available, no compression and moderate buffers.
+    # paramiko does not implement chacha20-poly1305, which would be cheaper,
+    # so aes128-ctr is used
+    'low-cpu-device': {
+        'ciphers': ('aes128-ctr', ),
+        'macs': ('hmac-sha1', 'hmac-sha2-256'),
+        'compress': False,
+        'window_size': 1024 * 1024,
+        'max_packet_size': 32768,
+    },
+}
+
+# parsed known_hosts files, see ``known_hosts``
+_known_hosts = {}
+_known_hosts_lock = Lock()
+
+# serializes updates of the auth memo file within this process
+_auth_memo_lock = Lock()
+
+
+def known_hosts(paths):
+    """Parses the known_hosts files at ``paths`` into a single
+    :class:`~paramiko.hostkeys.HostKeys` instance.
+
+    Files are parsed once per process and only parsed again after they have
+    been modified. The returned instance is shared between all connections
+    and must not be modified."""
+    cache_key = tuple((path, os.stat(path).st_mtime) for path in paths)
+
+    with _known_hosts_lock:
+        host_keys = _known_hosts.get(cache_key)
+        if host_keys is None:
+            host_keys = HostKeys()
+            for path in paths:
+                log.debug('Loading SSH known hosts from {}'.format(path))
+                host_keys.load(path)
+
+            # outdated versions of the same files are no longer needed
+            for key in [k for k in _known_hosts
+                        if [p for p, _ in k] == list(paths)]:
+                del _known_hosts[key]
+            _known_hosts[cache_key] = host_keys
+
+    return host_keys
+
+
+def apply_ssh_profile(t, profile):
+    """Applies an entry of ``SSH_PROFILES`` to the transport ``t``.
+
+    Must be called before the transport is started. Compression is not set
+    here, as :meth:`~paramiko.client.SSHClient.connect` resets it.
+    """
+    opts = t.get_security_options()
+
+    for key, attr in (('ciphers', 'ciphers'), ('macs', 'digests')):
+        if key in profile:
+            supported = getattr(opts, attr)
+            names = tuple(n for n in profile[key] if n in supported)
+            if len(names) < len(profile[key]):
+                log.debug('Not supported by paramiko: {}'.format(', '.join(
+                    n for n in profile[key] if n not in supported)))
+            if names:
+                setattr(opts, attr, names)
+
+    if 'window_size' in profile:
+        t.default_window_size = profile['window_size']
+    if 'max_packet_size' in profile:
+        t.default_max_packet_size = profile['max_packet_size']
+
+
+def _auth_memo_path():
+    return os.path.join(app_dirs.user_cache_dir, 'ssh_auth.json')
+
+
+def _load_auth_memo():
+    try:
+        with open(_auth_memo_path()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_auth_memo(host, method):
+    path = _auth_memo_path()
+
+    with _auth_memo_lock:
+        memo = _load_auth_memo()
+        if memo.get(host) == list(method):
+            return
+        memo[host] = method
+
+        memo_dir = os.path.dirname(path)
+        if not os.path.exists(memo_dir):
+            os.makedirs(memo_dir, 0o700)
+
+        # other processes may be updating the file at the same time, replace
+        # it atomically
+        fd, tmp_path = tempfile.mkstemp(dir=memo_dir, prefix='.ssh_auth')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(memo, f)
+        os.rename(tmp_path, path)
 
 
-def ssh_host_name(uri):
-    if uri.port is None or uri.port == 22:
-        return uri.host
-    else:
-        return '[{0.host}]:{0.port}'.format(uri)
+class RemandSSHClient(SSHClient):
+    """SSH client that tries the authentication method that succeeded for a
+    host the last time before all others.
 
+    Methods are described as ``(kind, ident)`` tuples: ``('agent',
+    fingerprint)`` for keys held by an agent, ``('key', filename)`` for key
+    files and ``('password', None)``.
 
-def wrap_ssh_errors(f):
-    @wraps(f)
-    def _(*args, **kwargs):
-        try:
-            return f(*args, **kwargs)
-        except SSHException, e:
-            raise TransportError(
-                'SSH ({}): {}'.format(type(e).__name__, e.message))
+    Transports are set up according to ``profile`` before connecting, see
+    ``SSH_PROFILES``."""
+
+    #: transport settings, set before connecting
+    profile = {}
+
+    #: method to try first, set before connecting
+    preferred_auth = None
+
+    #: method that succeeded, set after connecting
+    used_auth = None
+
+    #: number of seconds spent authenticating
+    auth_time = 0
+
+    _TWO_FACTOR = {'keyboard-interactive', 'password'}
+
+    # connect() creates the transport and starts it right away. it is set up
+    # when assigned, which happens in between
+    @property
+    def _transport(self):
+        return self.__dict__.get('_transport')
+
+    @_transport.setter
+    def _transport(self, t):
+        if t is not None:
+            apply_ssh_profile(t, self.profile)
+        self.__dict__['_transport'] = t
+
+    def _load_key(self, filename, passphrase):
+        for key_class in (RSAKey, DSSKey, ECDSAKey, Ed25519Key):
+            try:
+                return key_class.from_private_key_file(filename, passphrase)
+            except SSHException:
+                continue
+
+    def _auth_preferred(self, username, password, allow_agent):
+        kind, ident = self.preferred_auth
+
+        if kind == 'agent' and allow_agent:
+            if self._agent is None:
+                self._agent = Agent()
+            keys = [k for k in self._agent.get_keys()
+                    if hexlify(k.get_fingerprint()) == ident]
+            key = keys[0] if keys else None
+        elif kind == 'key':
+            key = self._load_key(ident, password)
+        elif kind == 'password' and password is not None:
+            self._transport.auth_password(username, password)
+            return True
+        else:
+            return False
+
+        if key is None:
+            return False
 
-    return _
+        log.debug('Trying last successful authentication method first: {}'
+                  .format(kind))
+        allowed = self._transport.auth_publickey(username, key)
 
+        # leave two-factor authentication to the regular process
+        return not (set(allowed) & self._TWO_FACTOR)
 
-def wrap_sftp_errors(f):
-    @wraps(f)
-    def _(*args, **kwargs):
+    def _auth(self, username, password, pkey, key_filenames, allow_agent,
+              look_for_keys, *args, **kwargs):
+        start = time.time()
+        try:
+            if self.preferred_auth is not None:
+                try:
+                    if self._auth_preferred(username, password, allow_agent):
+                        self.used_auth = self.preferred_auth
+                        return
+                except (SSHException, IOError) as e:
+                    log.debug('Last successful authentication method failed: '
+                              '{}'.format(e))
+
+            self._auth_recorded(username, password, pkey, key_filenames,
+                                allow_agent, look_for_keys, *args, **kwargs)
+        finally:
+            self.auth_time = time.time() - start
+
+    def _auth_recorded(self, *args, **kwargs):
+        # runs the regular authentication, recording the first method that
+        # succeeds by temporarily wrapping the transport's methods
+        t = self._transport
+        key_files = {}
+        orig_load = self._key_from_filepath
+        orig_publickey = t.auth_publickey
+        orig_password = t.auth_password
+
+        def load_key(filename, key_class, passphrase):
+            key = orig_load(filename, key_class, passphrase)
+            key_files[key.get_fingerprint()] = filename
+            return key
+
+        def auth_publickey(username, key):
+            rv = orig_publickey(username, key)
+            if self.used_auth is None:
+                if isinstance(key, AgentKey):
+                    self.used_auth = ('agent', hexlify(key.get_fingerprint()))
+                elif key.get_fingerprint() in key_files:
+                    self.used_auth = ('key',
+                                      key_files[key.get_fingerprint()])
+            return rv
+
+        def auth_password(username, password, *a, **kw):
+            rv = orig_password(username, password, *a, **kw)
+            if self.used_auth is None:
+                self.used_auth = ('password', None)
+            return rv
+
+        self._key_from_filepath = load_key
+        t.auth_publickey = auth_publickey
+        t.auth_password = auth_password
         try:
-            return f(*args, **kwargs)
-        except IOError, e:
-            fargs = ', '.join(
-                map(repr, args[1:]) +
-                ['{}={!r}'.format(*v) for v in kwargs.items()])
-            if e.errno == 2:
-                raise RemoteFileDoesNotExistError(str(e))
-            raise RemoteFailureError(
-                'SFTP Failed {}({}): {}'.format(f.__name__, fargs, str(e)))
+            super(RemandSSHClient, self)._auth(*args, **kwargs)
+        finally:
+            del self._key_from_filepath
+            del t.auth_publickey
+            del t.auth_password
+
+
+#: channel type for unix socket connections, supported by OpenSSH 6.7+
+STREAMLOCAL_CHANNEL = 'direct-streamlocal@openssh.com'
+
+
+def open_streamlocal(t, path, timeout=None):
+    """Opens a connection to the unix socket ``path`` on the server.
+
+    Paramiko's :meth:`~paramiko.transport.Transport.open_channel` cannot add
+    the request data for this channel type, so this is a copy of it doing
+    just that.
+
+    :param t: An authenticated transport.
+    :param path: Path of the socket on the server.
+    :param timeout: Seconds to wait for the server to answer. Defaults to an
+                    hour, like paramiko.
+    :raises paramiko.ssh_exception.ChannelException: If the server refuses
+                                                     the channel.
+    :return: A new :class:`~paramiko.channel.Channel`.
+    """
+    if not t.active:
+        raise SSHException('SSH session not active')
+    timeout = 3600 if timeout is None else timeout
+
+    with t.lock:
+        window_size = t._sanitize_window_size(None)
+        max_packet_size = t._sanitize_packet_size(None)
+        chanid = t._next_channel()
+
+        m = Message()
+        m.add_byte(cMSG_CHANNEL_OPEN)
+        m.add_string(STREAMLOCAL_CHANNEL)
+        m.add_int(chanid)
+        m.add_int(window_size)
+        m.add_int(max_packet_size)
+        m.add_string(path)
+        # reserved originator address and port
+        m.add_string('')
+        m.add_int(0)
+
+        chan = Channel(chanid)
+        t._channels.put(chanid, chan)
+        t.channel_events[chanid] = event = Event()
+        t.channels_seen[chanid] = True
+        chan._set_transport(t)
+        chan._set_window(window_size, max_packet_size)
+    t._send_user_message(m)
+
+    start = time.time()
+    while not event.is_set():
+        event.wait(0.1)
+        if not t.active:
+            raise t.get_exception() or SSHException('Unable to open channel.')
+        if start + timeout < time.time():
+            raise SSHException('Timeout opening channel.')
+
+    chan = t._channels.get(chanid)
+    if chan is None:
+        # a refused channel leaves a ChannelException behind
+        raise t.get_exception() or SSHException('Unable to open channel.')
+    return chan
 
-    return wrap_ssh_errors(_)
+
+def format_key(key):
+    return ':'.join(hexlify(b) for b in key.get_fingerprint())
+
+
+def ssh_host_name(uri):
+    if uri.port is None or uri.port == 22:
+        return uri.host
+    else:
+        return '[{0.host}]:{0.port}'.format(uri)
 
 
 class SSHRemoteProcess(RemoteProcess):
@@ -156,16 +461,18 @@ class _ShutdownWrap(object):
         return getattr(self._channelfile, key)
 
 
-class SSHRemote(Remote):
+class SSHRemote(SFTPRemote):
     uri_prefix = 'ssh'
-
-    _sftp_instance = None
+    reusable = True
 
     @wrap_ssh_errors
     def __init__(self):
-        self._client = SSHClient()
+        super(SSHRemote, self).__init__()
+        self._client = RemandSSHClient()
+        self._streamlocal_refused = False
 
         # load known_hosts
+        kh_paths = []
         for kh_path in config['load_known_hosts'].split(os.pathsep):
             path = os.path.expanduser(kh_path)
             if not path:
@@ -174,8 +481,15 @@ class SSHRemote(Remote):
                 log.warning('Skipping non-existant known_hosts file: {}'
                             .format(path))
                 continue
-            log.debug('Loading SSH known hosts from {}'.format(path))
-            self._client.load_host_keys(path)
+            kh_paths.append(path)
+
+        if kh_paths:
+            with self.timings.measure('known_hosts'):
+                # the shared keys take the place of the system host keys,
+                # which are never modified by the client. new keys are saved
+                # to the last file, as before
+                self._client._system_host_keys = known_hosts(kh_paths)
+                self._client._host_keys_filename = kh_paths[-1]
 
         on_missing_host_key = config['on_missing_host_key']
         policy = RejectPolicy()
@@ -196,10 +510,27 @@ class SSHRemote(Remote):
         max_attempts = int(config['ssh_connect_retries'])
         delay = int(config['ssh_connect_retry_delay'])
 
+        profile_name = config['ssh_profile']
+        if profile_name not in SSH_PROFILES:
+            raise ConfigurationError('Unknown ssh_profile: {!r}'.format(
+                profile_name))
+        log.debug('Using SSH profile {}'.format(profile_name))
+        self._client.profile = SSH_PROFILES[profile_name]
+
+        memo_host = '{}@{}'.format(uri.user, ssh_host_name(uri))
+        remember_auth = config.get_bool('ssh_remember_auth')
+        if remember_auth:
+            preferred = _load_auth_memo().get(memo_host)
+            if preferred:
+                self._client.preferred_auth = tuple(
+                    v.encode('utf8') if isinstance(v, unicode) else v
+                    for v in preferred)
+
         while True:
             if attempt == 0:
                 log.debug(
                     'First connection attempt to {}:{}'.format(uri.host, port))
+            start = time.time()
             try:
                 self._client.connect(
                     uri.host,
@@ -209,7 +540,8 @@ class SSHRemote(Remote):
                     key_filename=config['ssh_private_key'] or None,
                     timeout=timeout,
                     look_for_keys=True,
-                    allow_agent=True)
+                    allow_agent=True,
+                    compress=self._client.profile.get('compress', False))
                 break
             except BadHostKeyException, e:
                 raise TransportError(
@@ -241,127 +573,61 @@ class SSHRemote(Remote):
                     raise TransportError(_PRIVATE_KEY_ENCRYPTED)
                 raise
 
+        # connecting covers the tcp connection, key exchange and
+        # authentication
+        self.timings.add('ssh_handshake',
+                         time.time() - start - self._client.auth_time)
+        self.timings.add('ssh_auth', self._client.auth_time)
         log.debug('SSH connection established')
 
-        # verify umask
-        log.debug('Verifying umask')
-        p_umask = self.popen(['sh', '-c', 'umask'])
-        um, _ = p_umask.communicate()
-        assert p_umask.returncode == 0
-
-        umask = int(um.strip(), 8)
-        expected_umask = int(config['reset_umask'], 8)
-        if not umask == int(config['reset_umask'], 8):
-            log.warning('Host has unexpected umask of {:03o} (instead of '
-                        '{:03o}). Things might not work as you expect.'.format(
-                            umask, expected_umask))
-
-        # verify time
-        max_diff = config['max_time_diff']
-
-        if max_diff is not None:
-            local_timestamp = int(time.time())
-            p_ts = self.popen(['date', '+%s'])
-            try:
-                ts, _ = p_ts.communicate()
-            except IOError as e:
-                log.warning('Could not verify remote time. '
-                            'Is the date binary missing?')
-            timestamp = int(ts)
-            time_diff = timestamp - local_timestamp
-            log.debug('Local time: {} Remote time: {} Diff: {}'.format(
-                local_timestamp, timestamp, time_diff))
-            if time_diff > max_diff:
-                log.warning('Remote time differs by {} seconds (limit: {})'
-                            .format(time_diff, max_diff))
-
-    @property
-    def _sftp(self):
-        if self._sftp_instance:
-            # check if the command changed
-            if config['sftp_command'] != self._sftp_invocation:
-                self._sftp_instance.close()
-
-                self._sftp_invocation = None
-                self._sftp_instance = None
-                log.debug('SFTP command changed, reinitializing SFTP')
-
-        if not self._sftp_instance:
-            t = self._client._transport
-            chan = t.open_session()
-            if chan is None:
-                raise TransportError('Could not open channel for SFTP')
-
-            if config['sftp_command'] is None:
-                log.debug('SFTP using Subsystem sftp')
-                chan.invoke_subsystem('sftp')
-            else:
-                log.debug('SFTP using {}'.format(config['sftp_command']))
-                chan.exec_command(config['sftp_command'])
-            self._sftp_invocation = config['sftp_command']
-            self._sftp_instance = SFTPClient(chan)
-
-        return self._sftp_instance
+        # servers may not offer the cipher a profile is tuned for
+        t = self._client.get_transport()
+        intended = [n for n in self._client.profile.get('ciphers', ())
+                    if n in t.get_security_options().ciphers]
+        if intended and t.local_cipher != intended[0]:
+            log.warning('SSH profile {} prefers cipher {}, but {} was '
+                        'negotiated'.format(profile_name, intended[0],
+                                            t.local_cipher))
 
-    @wrap_sftp_errors
-    def chdir(self, path):
-        return self._sftp.chdir(path)
-
-    @wrap_sftp_errors
-    def chmod(self, path, mode):
-        return self._sftp.chmod(path, mode)
-
-    @wrap_sftp_errors
-    def getcwd(self):
-        return self._sftp.normalize('.')
-
-    @wrap_sftp_errors
-    def listdir(self, path):
-        return self._sftp.listdir(path)
+        if remember_auth and self._client.used_auth is not None:
+            try:
+                _save_auth_memo(memo_host, self._client.used_auth)
+            except (IOError, OSError) as e:
+                log.warning('Could not save authentication method: {}'.format(
+                    e))
 
-    @wrap_sftp_errors
-    def lstat(self, path):
-        try:
-            return self._sftp.lstat(path)
-        except IOError, e:
-            if e.errno == 2:
-                return None
-            raise
+        self._check_environment()
 
-    @wrap_sftp_errors
-    def mkdir(self, path, mode=0777):
-        return self._sftp.mkdir(path, mode)
+    def close(self):
+        super(SSHRemote, self).close()
+        self._client.close()
 
-    @wrap_sftp_errors
-    def normalize(self, path):
-        return self._sftp.normalize(path)
+    def is_active(self):
+        t = self._client.get_transport()
+        return t is not None and t.is_active()
 
-    @wrap_sftp_errors
-    def readlink(self, path):
-        return self._sftp.readlink(path)
+    def _open_sftp(self, command):
+        t = self._client._transport
+        chan = t.open_session()
+        if chan is None:
+            raise TransportError('Could not open channel for SFTP')
 
-    @wrap_sftp_errors
-    def rename(self, oldpath, newpath):
-        return self._sftp.rename(oldpath, newpath)
+        if command is None:
+            log.debug('SFTP using Subsystem sftp')
+            chan.invoke_subsystem('sftp')
+        else:
+            log.debug('SFTP using {}'.format(command))
+            chan.exec_command(command)
+        return RemandSFTPClient(chan)
 
     @wrap_sftp_errors
     def popen(self, args, cwd=None, extra_env={}):
-        envvars = [
-            '{}={}'.format(shlex_quote(k), shlex_quote(v))
-            for k, v in extra_env.items()
-        ]
-        chdir = ''
-
-        if cwd is not None:
-            chdir = 'cd {} &&'.format(shlex_quote(cwd))
-
         # get timeout from configuration
         timeout = config['ssh_command_timeout']
 
         if timeout:
             timeout = int(timeout)
-        cmd = ' '.join([chdir] + envvars +
-                       [shlex_quote(part) for part in args])
+        cmd = self._command_line(args, cwd, extra_env)
         log.debug('Executing {}'.format(cmd))
         stdin, stdout, stderr = self._client.exec_command(cmd, timeout=timeout)
 
@@ -370,23 +636,6 @@ class SSHRemote(Remote):
             stdout=_ShutdownWrap(stdout, 0),
             stderr=_ShutdownWrap(stderr, 0), )
 
-    @wrap_sftp_errors
-    def rmdir(self, path):
-        return self._sftp.rmdir(path)
-
-    @wrap_sftp_errors
-    def stat(self, path):
-        try:
-            return self._sftp.stat(path)
-        except IOError, e:
-            if e.errno == 2:
-                return None
-            raise
-
-    @wrap_sftp_errors
-    def symlink(self, target, path):
-        return self._sftp.symlink(target, path)
-
     def tcp_connect(self, addr):
         # cannot log here, must be callable by other threads
 
@@ -402,42 +651,43 @@ class SSHRemote(Remote):
 
         return chan
 
-    @wrap_sftp_errors
-    def umask(self, umask):
-        try:
-            util.validate_umask(umask)
-        except ValueError as e:
-            raise_from(ConfigurationError(str(e)), e)
-        raise NotImplementedError('Currently, the SSH transport does not '
-                                  'support setting the umask')
-
     def unix_connect(self, addr):
-        # FIXME: this could work directly on OpenSSH 6.7+
+        mode = config.snapshot().ssh_streamlocal
+
+        # a native connection would be made as the login user instead of the
+        # sudo user, so netcat is used as before while proc.sudo is active
+        native = mode == 'always' or (mode == 'auto' and
+                                      not self._streamlocal_refused and
+                                      self.sudo_user is None)
+
+        if native:
+            start = time.time()
+            try:
+                chan = open_streamlocal(self._client._transport, addr)
+            except ChannelException as e:
+                if mode == 'always':
+                    raise IOError('Could not open unix socket tunnel to {}: '
+                                  '{}'.format(addr, e.text))
+
+                # older servers do not know the channel type, others have
+                # disabled it. either way, there is no point in asking again
+                self._streamlocal_refused = True
+                log.info('Server refused unix socket forwarding ({}), '
+                         'falling back to netcat'.format(e.text))
+            else:
+                self.timings.add('streamlocal_connect', time.time() - start)
+                return chan
+
         if not config['cmd_nc-openbsd']:
             # FIXME: if the command is set, but not present on the remote
             #        side, this will cause a confusing error message
             #        (server unexpectedly closed the connection)
             #
-            #        maybe check once beforehand for the present of the tool?
-            #
             # FIXME: this issue will also occur if the wrong netcat is
             # installed (`netcat-traditional` vs `netcat-openbsd`)
             raise ValueError('cmd.nc-openbsd is required for unix socket '
                              'connections via SSH')
 
-        p = self.popen([config['cmd_nc-openbsd'], '-U', addr])
+        with self.timings.measure('netcat_connect'):
+            p = self.popen([config['cmd_nc-openbsd'], '-U', addr])
         return p._channel
-
-    @wrap_sftp_errors
-    def unlink(self, path):
-        return self._sftp.unlink(path)
-
-    @wrap_sftp_errors
-    def utime(self, path, times):
-        return self._sftp.utime(path, times)
-
-    @wrap_sftp_errors
-    def file(self, name, mode='r'):
-        fp = self._sftp.file(name, mode, int(config['buffer_size']))
-        fp.set_pipelined(config.get_bool('sftp_pipelined'))
-        return fp
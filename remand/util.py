@@ -1,14 +1,19 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from fcntl import fcntl, F_GETFL, F_SETFL
 from functools import partial
 import os
 import sys
 import threading
+import time
 
 import hashlib
 import inflection
 
 from stuf.collects import ChainMap
 
+from .exc import ConfigurationError
+
 if sys.version_info.major < 3:
     from backports.configparser import ConfigParser
 else:
@@ -34,11 +39,120 @@ class TypeConversionMixin(object):
         raise ValueError('Not a valid boolean value: {}'.format(rv))
 
 
+def _to_bool(value):
+    if value in TypeConversionMixin.BOOLEAN_TRUE:
+        return True
+    if value in TypeConversionMixin.BOOLEAN_FALSE:
+        return False
+    raise ValueError('Not a valid boolean value: {}'.format(value))
+
+
+def _to_int_or_auto(value):
+    return value if value == 'auto' else int(value)
+
+
+def _to_umask(value):
+    umask = int(value, 8)
+    validate_umask(umask)
+    return umask
+
+
+def _to_path(value):
+    # empty values mean "not set"
+    return value or None
+
+
+def _one_of(*choices):
+    def convert(value):
+        if value not in choices:
+            raise ValueError('Must be one of {}'.format(', '.join(choices)))
+        return value
+
+    return convert
+
+
+#: settings available on :class:`ConfigSnapshot` and their conversions
+SNAPSHOT_SCHEMA = {
+    'buffer_size': _to_int_or_auto,
+    'fs_compress_fast_link': int,
+    'fs_compress_min_size': int,
+    'fs_compress_slow_link': int,
+    'fs_mtime_multiplier': int,
+    'fs_prefetch_requests': _to_int_or_auto,
+    'fs_store_min_size': int,
+    'fs_transfer_chunk_size': int,
+    'fs_transfer_threshold': int,
+    'fs_transfer_workers': int,
+    'fs_update_mtime': _to_bool,
+    'info_cache': _to_bool,
+    'on_missing_host_key': _one_of('abort', 'ignore', 'ask', 'ask_to_save'),
+    'reset_umask': _to_umask,
+    'sftp_channels': int,
+    'sftp_command': _to_path,
+    'sftp_pipelined': _to_bool,
+    'ssh_streamlocal': _one_of('auto', 'always', 'never'),
+}
+
+
+class ConfigSnapshot(object):
+    """Converted values of the settings in :data:`SNAPSHOT_SCHEMA`, as
+    attributes.
+
+    Settings that are missing or have no value are ``None``.
+
+    :raises ~remand.exc.ConfigurationError: If a setting has an invalid
+                                            value.
+    """
+
+    def __init__(self, cfg):
+        for name, convert in SNAPSHOT_SCHEMA.items():
+            # settings left empty read as '' or, without a '=', as None
+            value = cfg.get(name) or None
+            if value is not None:
+                try:
+                    value = convert(value)
+                except ValueError as e:
+                    raise ConfigurationError('Invalid value for {}: {!r} ({})'
+                                             .format(name, value, e))
+            setattr(self, name, value)
+
+
 class TypeConversionChainMap(TypeConversionMixin, ChainMap):
     # backport of Py3 feature
     def new_child(self, m=None):
         return self.__class__({} if m is None else m, *self.maps)
 
+    def snapshot(self):
+        """Returns a :class:`ConfigSnapshot` of the current values.
+
+        The snapshot is reused until a value is set or deleted through this
+        map. Changes made to the underlying maps directly are not noticed.
+        """
+        snap = getattr(self, '_snapshot', None)
+        if snap is None:
+            snap = self._snapshot = ConfigSnapshot(self)
+        return snap
+
+    def __setitem__(self, key, value):
+        super(TypeConversionChainMap, self).__setitem__(key, value)
+        self._snapshot = None
+
+    def __delitem__(self, key):
+        super(TypeConversionChainMap, self).__delitem__(key)
+        self._snapshot = None
+
+    def pop(self, key, *args):
+        self._snapshot = None
+        return super(TypeConversionChainMap, self).pop(key, *args)
+
+    def popitem(self):
+        self._snapshot = None
+        return super(TypeConversionChainMap, self).popitem()
+
+    def clear(self):
+        self._snapshot = None
+        super(TypeConversionChainMap, self).clear()
+
 
 def validate_umask(umask):
     if not isinstance(umask, int):
@@ -52,8 +166,8 @@ def hash_file(file_obj, hashfunc=hashlib.sha1, bufsize=None):
     m = hashfunc()
 
     if bufsize is None:
-        from . import config
-        bufsize = int(config['buffer_size'])
+        from . import remote
+        bufsize = remote.buffer_size()
 
     # read full file in buffer sized chunks
     for chunk in iter(partial(file_obj.read, bufsize), b''):
@@ -104,6 +218,40 @@ class CollectThread(threading.Thread):
             self.input_source.close()
 
 
+class Timings(object):
+    """Accumulates the durations of named steps, in the order they first
+    occurred. Steps may be added from any thread."""
+
+    def __init__(self):
+        self._durations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._durations[name] = self._durations.get(name, 0) + seconds
+
+    @contextmanager
+    def measure(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def clear(self):
+        self._durations.clear()
+
+    def items(self):
+        return self._durations.items()
+
+    def __nonzero__(self):
+        return bool(self._durations)
+
+    def __str__(self):
+        return ', '.join('{}: {:.0f} ms'.format(name, seconds * 1000)
+                         for name, seconds in self._durations.items())
+
+
 def write_all(dest, input, bufsize=4096):
     if hasattr(input, 'read'):
         for chunk in iter(partial(input.read, bufsize), ''):
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+from remand.exc import ConfigurationError
+from remand.util import ConfigParser, TypeConversionChainMap
+
+DEFAULTS = os.path.join(os.path.dirname(__file__), '..', 'remand',
+                        'defaults.cfg')
+
+
+@pytest.fixture
+def defaults():
+    cfg = ConfigParser(allow_no_value=True)
+    cfg.read(DEFAULTS)
+    return dict(cfg['Match:.*'].items())
+
+
+def test_defaults_load(defaults):
+    TypeConversionChainMap({}, defaults).snapshot()
+
+
+@pytest.mark.parametrize('value', ['', None])
+def test_empty_values_are_unset(defaults, value):
+    snap = TypeConversionChainMap({'fs_prefetch_requests': value,
+                                   'buffer_size': value,
+                                   'fs_transfer_workers': value},
+                                  defaults).snapshot()
+
+    assert snap.fs_prefetch_requests is None
+    assert snap.buffer_size is None
+    assert snap.fs_transfer_workers is None
+
+
+def test_invalid_value_raises(defaults):
+    with pytest.raises(ConfigurationError):
+        TypeConversionChainMap({'fs_prefetch_requests': 'many'},
+                               defaults).snapshot()